@@ -1,4 +1,4 @@
-version_info = (1, 0, 10, 'final', 0)
+version_info = (1, 0, 11, 'final', 0)
 
 _specifier_ = {'alpha': 'a', 'beta': 'b', 'candidate': 'rc', 'final': ''}
 
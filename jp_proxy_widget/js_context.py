@@ -6,9 +6,15 @@ Utilities for loading CSS and Javascript text either from files or via HTTP.
 from __future__ import print_function
 
 import os
+import collections
+import hashlib
+import json
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
 from IPython.display import display, Javascript, HTML
 import time
 import requests
+from jupyter_ui_poll import run_ui_poll_loop
 
 # If files are not found try to look relative to the module location
 my_dir = os.path.dirname(__file__)
@@ -16,6 +22,26 @@ my_dir = os.path.dirname(__file__)
 LOADED_JAVASCRIPT = set()
 LOADED_FILES = set()
 
+# Process wide cache of file texts: resolved path --> ((mtime, size), text), least recently used first.
+FILE_CACHE = collections.OrderedDict()
+# Bound on the total length of cached texts.
+FILE_CACHE_LIMIT = 32 * 1024 * 1024
+FILE_CACHE_SIZE = [0]
+# Resolved paths by (filename, local, working directory).
+RESOLVED_PATHS = {}
+
+# If set, remote texts are kept in this folder and revalidated using ETag/Last-Modified.
+# The cache is opt-in: set JP_PROXY_WIDGET_HTTP_CACHE or call enable_http_cache().
+HTTP_CACHE_DIR = os.environ.get("JP_PROXY_WIDGET_HTTP_CACHE") or None
+DEFAULT_HTTP_CACHE_DIR = os.path.join(os.path.expanduser("~"), ".cache", "jp_proxy_widget", "http")
+# Set to serve remote texts only from the HTTP cache, without network access.
+OFFLINE = False
+# Seconds to wait for a remote server to connect or send data.
+HTTP_TIMEOUT = 30
+# Maximum number of concurrent remote fetches.
+HTTP_WORKERS = 8
+HTTP_SESSION = [None]
+
 def get_file_path(filename, local=True, relative_to_module=None, my_dir=my_dir):
     """
     Look for an existing path matching filename.
@@ -39,16 +65,160 @@ def get_file_path(filename, local=True, relative_to_module=None, my_dir=my_dir):
 if bytes != str:
     unicode = str  # Python 3
 
+def is_url(filename):
+    return filename.startswith("http") and "://" in filename
+
 def get_text_from_file_name(filename, local=True):
-    if filename.startswith("http") and "://" in filename:
-        r = requests.get(filename)
-        result = r.text
-    else:
-        path = get_file_path(filename, local)
-        LOADED_FILES.add(path)
-        result = open(path).read()
+    if is_url(filename):
+        return get_text_from_url(filename)
+    key = (filename, local, os.getcwd())
+    path = RESOLVED_PATHS.get(key)
+    if path is not None:
+        try:
+            return read_file_text(path)
+        except OSError:
+            # the file moved: resolve it again
+            del RESOLVED_PATHS[key]
+    path = get_file_path(filename, local)
+    RESOLVED_PATHS[key] = path
+    return read_file_text(path)
+
+def read_file_text(path):
+    """
+    Return the text of the file at the resolved path,
+    from the file cache if the modification time and size have not changed.
+    """
+    stat = os.stat(path)
+    signature = (stat.st_mtime_ns, stat.st_size)
+    LOADED_FILES.add(path)
+    entry = FILE_CACHE.get(path)
+    if entry is not None and entry[0] == signature:
+        FILE_CACHE.move_to_end(path)
+        return entry[1]
+    with open(path) as f:
+        result = f.read()
     if type(result) == bytes:
         result = unicode(result, "utf8")
+    if entry is not None:
+        del FILE_CACHE[path]
+        FILE_CACHE_SIZE[0] -= len(entry[1])
+    if len(result) <= FILE_CACHE_LIMIT:
+        FILE_CACHE[path] = (signature, result)
+        FILE_CACHE_SIZE[0] += len(result)
+        while FILE_CACHE_SIZE[0] > FILE_CACHE_LIMIT:
+            (_, (_, evicted)) = FILE_CACHE.popitem(last=False)
+            FILE_CACHE_SIZE[0] -= len(evicted)
+    return result
+
+def invalidate_file_cache(path=None):
+    "Forget the cached text for the file path, or for all files if path is None."
+    RESOLVED_PATHS.clear()
+    if path is None:
+        FILE_CACHE.clear()
+        FILE_CACHE_SIZE[0] = 0
+        return
+    entry = FILE_CACHE.pop(os.path.abspath(path), None)
+    if entry is not None:
+        FILE_CACHE_SIZE[0] -= len(entry[1])
+
+def get_texts_from_file_names(filenames, local=True):
+    "Return a dictionary of filename --> text, fetching remote texts concurrently."
+    result = {}
+    urls = [f for f in set(filenames) if is_url(f)]
+    if len(urls) > 1:
+        with ThreadPoolExecutor(max_workers=min(HTTP_WORKERS, len(urls))) as executor:
+            result.update(zip(urls, executor.map(get_text_from_url, urls)))
+    for filename in filenames:
+        if filename not in result:
+            result[filename] = get_text_from_file_name(filename, local)
+    return result
+
+def http_session():
+    "Shared requests session pooling connections to remote servers."
+    session = HTTP_SESSION[0]
+    if session is None:
+        session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=HTTP_WORKERS, pool_maxsize=HTTP_WORKERS)
+        session.mount("http://", adapter)
+        session.mount("https://", adapter)
+        HTTP_SESSION[0] = session
+    return session
+
+def http_cache_path(url):
+    if HTTP_CACHE_DIR is None:
+        return None
+    name = hashlib.sha1(url.encode("utf-8")).hexdigest() + ".json"
+    return os.path.join(HTTP_CACHE_DIR, name)
+
+def enable_http_cache(folder=DEFAULT_HTTP_CACHE_DIR):
+    "Keep remote texts in folder (None disables the cache)."
+    global HTTP_CACHE_DIR
+    HTTP_CACHE_DIR = folder
+
+def read_http_cache(url):
+    "Return the cached entry for the url as a dictionary, or None."
+    path = http_cache_path(url)
+    if path is None or not os.path.exists(path):
+        return None
+    try:
+        with open(path) as f:
+            entry = json.load(f)
+    except ValueError:
+        # damaged entry: fetch again
+        return None
+    if entry.get("url") != url:
+        return None
+    return entry
+
+def write_http_cache(url, response):
+    path = http_cache_path(url)
+    if path is None:
+        return
+    entry = dict(
+        url=url,
+        etag=response.headers.get("ETag"),
+        last_modified=response.headers.get("Last-Modified"),
+        text=response.text,
+    )
+    os.makedirs(HTTP_CACHE_DIR, exist_ok=True)
+    # write a temporary file and rename it so readers never see a partial entry.
+    (fd, temp_path) = tempfile.mkstemp(dir=HTTP_CACHE_DIR, suffix=".tmp")
+    with os.fdopen(fd, "w") as f:
+        json.dump(entry, f)
+    os.replace(temp_path, path)
+
+def get_text_from_url(url):
+    """
+    Fetch the text for the url using the pooled session, revalidating any cached copy.
+    Serve the cached copy if the server cannot be reached or answers with an error (or always, if OFFLINE).
+    """
+    entry = read_http_cache(url)
+    if OFFLINE:
+        if entry is None:
+            raise IOError("offline and not cached: " + repr(url))
+        return entry["text"]
+    headers = {}
+    if entry is not None:
+        if entry.get("etag"):
+            headers["If-None-Match"] = entry["etag"]
+        if entry.get("last_modified"):
+            headers["If-Modified-Since"] = entry["last_modified"]
+    try:
+        r = http_session().get(url, headers=headers, timeout=HTTP_TIMEOUT)
+    except requests.RequestException:
+        if entry is None:
+            raise
+        return entry["text"]
+    if r.status_code == 304 and entry is not None:
+        return entry["text"]
+    if r.status_code != 200:
+        # the body of an error response is not the requested text.
+        if entry is not None:
+            return entry["text"]
+        r.raise_for_status()
+    result = r.text
+    if r.status_code == 200:
+        write_http_cache(url, r)
     return result
 
 def display_javascript(widget, js_text):
@@ -68,17 +238,32 @@ def eval_javascript(widget, js_text):
 # global default evaluation method
 EVALUATOR = eval_javascript
 
-def load_if_not_loaded(widget, filenames, verbose=False, delay=0.1, force=False, local=True, evaluator=None):
+def load_if_not_loaded(widget, filenames, verbose=False, delay=0.1, force=False, local=True, evaluator=None,
+    on_loaded=None, wait=False, timeout=3000):
     """
     Load a javascript file to the Jupyter notebook context,
     unless it was already loaded.
+    By default sleep for delay seconds after each load to allow the JS interpreter to sync.
+    With on_loaded or wait=True the widget view acknowledges completion of the loads:
+    on_loaded() is called back when they are done and wait=True blocks until then,
+    for at most timeout milliseconds.  Waiting requires a rendered widget.
+    Loads through the widget (eval_javascript) skip the delays.
     """
     if evaluator is None:
         evaluator = EVALUATOR  # default if not specified.
+    acknowledge = widget is not None and (on_loaded is not None or wait)
+    if wait and acknowledge and not widget.rendered:
+        # the view would never acknowledge: commands wait in the buffer until it renders.
+        raise ValueError("cannot wait for javascript loads before the widget is displayed")
+    if acknowledge and evaluator is eval_javascript:
+        # the acknowledgement follows the loads only when they execute in the view.
+        delay = 0
+    texts = get_texts_from_file_names(
+        [f for f in filenames if force or not f in LOADED_JAVASCRIPT], local)
     for filename in filenames:
         loaded = False
         if force or not filename in LOADED_JAVASCRIPT:
-            js_text = get_text_from_file_name(filename, local)
+            js_text = texts[filename]
             if verbose:
                 print("loading javascript file", filename, "with", evaluator)
             evaluator(widget, js_text)
@@ -91,3 +276,21 @@ def load_if_not_loaded(widget, filenames, verbose=False, delay=0.1, force=False,
             if verbose:
                 print ("delaying to allow JS interpreter to sync.")
             time.sleep(delay)
+    if acknowledge:
+        # commands execute in order and the view acknowledges the batch after its loads
+        # complete (after notify_js_loaded), so these run when the loads are done.
+        acknowledged = []
+        if on_loaded is not None:
+            widget(widget.callable(on_loaded)())
+        widget.flush(acknowledged.append)
+        if wait and not acknowledged:
+            deadline = time.time() + timeout / 1000.0
+            def complete():
+                if acknowledged:
+                    return True
+                if time.time() > deadline:
+                    return False
+                return None  # only None continues the polling loop.
+            run_ui_poll_loop(complete)
+            if not acknowledged:
+                raise TimeoutError("javascript loads not acknowledged after %s milliseconds" % timeout)
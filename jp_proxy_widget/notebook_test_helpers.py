@@ -58,3 +58,18 @@ class ValidationSuite:
         """, validate_all=validate_all, delay_ms=delay_ms)
 
         return  validator_widget.debugging_display()
+
+
+def evaluate_latency(widget, count=100, command=None):
+    """
+    Micro-benchmark for synchronous reads: evaluate the command (default element.width())
+    count times in a displayed widget and return (mean, minimum, maximum) latency in seconds.
+    """
+    if command is None:
+        command = widget.get_element().width()
+    timings = []
+    for i in range(count):
+        start = time.time()
+        widget.evaluate(command)
+        timings.append(time.time() - start)
+    return (sum(timings) / count, min(timings), max(timings))
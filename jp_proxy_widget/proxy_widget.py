@@ -69,6 +69,7 @@ JAVASCRIPT ACTION: create a javascript callback function which triggers
    callback parameters to JSON when they are passed back to Python.
    The callback function should have the signature
        callback(untranslated_data, callback_arguments_json)
+   An optional final ["dict", policy] argument makes the view throttle or debounce the calls.
 PASSED TO PYTHON: should never be returned.
 
 WIDGET INTERFACE: target.attribute_name
@@ -93,6 +94,19 @@ JSON ENCODING: ["new", target, arg0, ... argn]
 JAVASCRIPT ACTION: thing = E(target); result = new E(arg0, ... argn)
 PASSED TO PYTHON: This should not be the end of the chain.
 
+WIDGET INTERFACE: not directly exposed (bytes, bytearray or memoryview values).
+JSON ENCODING: ["buffer", buffer_index]
+JAVASCRIPT ACTION/RESULT: Uint8Array view of message buffer number buffer_index.
+   The binary content is not JSON encoded but travels as an ipywidgets message buffer.
+   The older ["bytes", hex_string] encoding is still accepted by the view.
+PASSED TO PYTHON: This should not be the end of the chain.
+
+WIDGET INTERFACE: not directly exposed (numeric numpy arrays).
+JSON ENCODING: ["ndarray", ["buffer", buffer_index], dtype_name, shape]
+JAVASCRIPT ACTION/RESULT: typed array (Float64Array, Int32Array, ...) sharing the message buffer
+   with array.dtype = dtype_name and array.shape = shape attached.
+PASSED TO PYTHON: This should not be the end of the chain.
+
 WIDGET INTERFACE: <target>._null.
 JSON ENCODING: ["null", target]
 JAVASCRIPT ACTION: execute E(target) and discard the final value to prevent 
@@ -100,6 +114,34 @@ JAVASCRIPT ACTION: execute E(target) and discard the final value to prevent
    optimization to prevent unneeded communication.
 PASSED TO PYTHON: None
 
+WIDGET INTERFACE: widget.prepare(command_with_Param_slots) then prepared(arg0, ..., argn).
+JSON ENCODING: ["define", template_id, [name0, ..., namen], template]
+   and ["invoke", template_id, arg0, ..., argn] with ["param", name] slots in the template.
+JAVASCRIPT ACTION/RESULT: define compiles the template once per session in each view; invoke executes
+   the compiled template with E(arg0), ..., E(argn) bound to the parameter slots.  A view without
+   the definition (rendered after it was sent) gets it with a definition_request message first.
+PASSED TO PYTHON: This should not be the end of the chain.
+
+WIDGET INTERFACE: widget.load_js_files(...) and widget.load_css(...) when widget.cache_assets is set.
+JSON ENCODING: ["load_asset", loader_indicator, name, content_hash, persist]
+JAVASCRIPT ACTION/RESULT: load the asset text with the loader_indicator action, taking
+   the text from the page asset cache, from IndexedDB storage if persist is set,
+   or else requesting it from the kernel with an asset_request message.
+PASSED TO PYTHON: This should not be the end of the chain.
+
+WIDGET INTERFACE: widget.evaluate(command) and lazy_reference.sync_value().
+JSON ENCODING: ["reply", request_id, command, level]
+JAVASCRIPT ACTION/RESULT: execute E(command) and immediately send an evaluate_result
+   message [request_id, json_value, error_or_null] with the value converted to the level.
+PASSED TO PYTHON: the evaluate_result message, not the command result.
+
+WIDGET INTERFACE: widget.compiled_function(argument_names, body) (used by js_init).
+JSON ENCODING: ["js_function", content_hash, argument_names, body] the first time
+   the widget session sees the body and ["js_function", content_hash] afterwards.
+JAVASCRIPT ACTION/RESULT: new Function(argument_names..., body), compiled once per page
+   and cached by content hash.  A page without the function asks for it with a definition_request.
+PASSED TO PYTHON: This should not be the end of the chain.
+
 """
 
 import ipywidgets as widgets
@@ -109,9 +151,18 @@ import IPython
 from IPython.display import display, HTML
 import traitlets
 import json
+import zlib
+import itertools
+import collections
+import struct
+import hashlib
+import re
+import asyncio
+import inspect
 #import threading
 import types
 import traceback
+import warnings
 from . import js_context
 from .hex_codec import hex_to_bytearray, bytearray_to_hex
 from pprint import pprint
@@ -122,6 +173,10 @@ from jupyter_ui_poll import run_ui_poll_loop
 # get a reference to the IPython notebook object.
 #ip = IPython.get_ipython()   # not used
 
+# Widgets with commands waiting for the end of the cell, by id, and the shell with the flush hook.
+CELL_FLUSH_WIDGETS = {}
+CELL_FLUSH_SHELL = [None]
+
 # For creating unique DOM identities
 IDENTITY_COUNTER = [int(time.time() * 100) % 10000000]
 
@@ -138,6 +193,32 @@ COMMANDS_FINAL = "cm_final"
 LOAD_CSS = "load_css"
 LOAD_JS = "load_js"
 LOAD_INDICATORS = [LOAD_CSS, LOAD_JS]
+LOAD_ASSET = "load_asset"
+SESSION_RESET = "session_reset"
+SYMBOL_RESEND = "symbol_resend"
+EVALUATE_RESULT = "evaluate_result"
+ASSET_REQUEST = "asset_request"
+ASSET_TEXT = "asset_text"
+DEFINITION_REQUEST = "definition_request"
+DEFINITION_TEXT = "definition_text"
+
+# Content addressed asset texts by hash, shared by all widgets (see load_asset_command),
+# least recently registered first.  Views asking for an evicted hash get None.
+ASSETS = collections.OrderedDict()
+# Bound on the total length of registered asset texts.
+ASSETS_LIMIT = 32 * 1024 * 1024
+ASSETS_SIZE = [0]
+
+# Message key marking segmented messages whose fragments are compressed binary buffers.
+COMPRESSION = "compression"
+DEFLATE = "deflate"
+
+# Message key marking command messages sent as binary frames in the message buffers.
+FORMAT = "format"
+BINARY_FORMAT = "binary"
+JSON_FORMAT = "json"
+# Message format of command JSON text sent as UTF-8 binary buffers (pre-encoded queued batches).
+JSON_TEXT_FORMAT = "json_text"
 
 # This slot name is used to support D3-style chaining under some circumstances
 FRAGILE_JS_REFERENCE = "_FRAGILE_JS_REFERENCE"
@@ -145,11 +226,71 @@ FRAGILE_JS_REFERENCE = "_FRAGILE_JS_REFERENCE"
 # Reference used for method resolution
 FRAGILE_THIS = "_FRAGILE_THIS"
 
-SEND_FRAGILE_JS_REFERENCE = "_SEND_FRAGILE_JS_REFERENCE"
+
+# Seconds between checks for the reply while waiting for a synchronous evaluation.
+EVALUATE_POLL_SLEEP = 0.001
 
 # Message segmentation size default
 BIG_SEGMENT = 1000000
 
+# Values sent as binary message buffers rather than JSON.
+BINARY_TYPES = (bytes, bytearray, memoryview)
+
+# Values which need no validation or conversion in commands.
+SCALAR_TYPES = set([str, int, float, bool, type(None)])
+
+# Numpy dtypes which map directly to javascript typed arrays.
+TYPED_ARRAY_DTYPES = set("int8 uint8 int16 uint16 int32 uint32 float32 float64".split())
+
+# Other numeric dtypes are converted before sending (javascript numbers are doubles).
+NDARRAY_DTYPE_CONVERSIONS = {
+    "int64": "float64",
+    "uint64": "float64",
+    "float16": "float32",
+    "float96": "float64",
+    "float128": "float64",
+}
+# The extended precision dtype name depends on the platform (it is float64 on some).
+if np.dtype(np.longdouble).name not in TYPED_ARRAY_DTYPES:
+    NDARRAY_DTYPE_CONVERSIONS[np.dtype(np.longdouble).name] = "float64"
+
+# Key marking a binary buffer placeholder {BUFFER_REFERENCE: [index, dtype_name, shape]}
+# in values sent from javascript (dtype_name is null for raw ArrayBuffers and DataViews).
+BUFFER_REFERENCE = "__jp_proxy_buffer__"
+
+# Command indicators whose arguments never contain binary buffer references.
+OPAQUE_INDICATORS = set(["id", "bytes", "callback", "element", "window", "param", "js_function", LOAD_ASSET] + LOAD_INDICATORS)
+
+# Compact command encoding: indicators are sent as their index in this list.
+# This list must match OPCODES in proxy_implementation.js.
+OPCODES = [
+    "element", "window", "method", "function", "id", "list", "dict", "callback",
+    "get", "set", "null", LOAD_CSS, LOAD_JS, "bytes", "buffer", "ndarray", "symbol",
+    "param", "define", "invoke", "js_function", LOAD_ASSET, "reply",
+]
+OPCODE = dict((indicator, code) for (code, indicator) in enumerate(OPCODES))
+OP_SYMBOL = OPCODE["symbol"]
+
+# Maximum number of interned strings and target paths per widget session.
+SYMBOL_TABLE_LIMIT = 10000
+# Unacknowledged symbol encoded batches kept for resending to a view with a new table.
+SYMBOL_RESEND_LIMIT = 64
+
+# Binary command frames: a version byte followed by one tagged value (little endian).
+# Strings are a uint32 byte length and utf8 text, lists and dicts a uint32 length and items,
+# and commands an opcode byte, a uint32 argument count and arguments.
+# These constants must match the frame reader in proxy_implementation.js.
+FRAME_VERSION = 1
+FRAME_NULL = 0
+FRAME_FALSE = 1
+FRAME_TRUE = 2
+FRAME_INT32 = 3
+FRAME_FLOAT64 = 4
+FRAME_STRING = 5
+FRAME_LIST = 6
+FRAME_DICT = 7
+FRAME_COMMAND = 8
+
 class SyncTimeOutError(RuntimeError):
     "The sync operation between the kernel and Javascript timed out."
 
@@ -164,8 +305,8 @@ class JSProxyWidget(widgets.DOMWidget):
     _model_name = Unicode('JSProxyModel').tag(sync=True)
     _view_module = Unicode('jp_proxy_widget').tag(sync=True)
     _model_module = Unicode('jp_proxy_widget').tag(sync=True)
-    _view_module_version = Unicode('^1.0.10').tag(sync=True)
-    _model_module_version = Unicode('^1.0.10').tag(sync=True)
+    _view_module_version = Unicode('^1.0.11').tag(sync=True)
+    _model_module_version = Unicode('^1.0.11').tag(sync=True)
 
     # traitlet port to use for sending commands to javascript
     #commands = traitlets.List([], sync=True)
@@ -180,11 +321,39 @@ class JSProxyWidget(widgets.DOMWidget):
     # increment this after every flush to force a sync?
     _send_counter = traitlets.Integer(0, sync=True)
 
+    # Compress segmented messages (in both directions) with JSON text at least this long.
+    # Zero disables compression.
+    compress_threshold = traitlets.Integer(0, sync=True)
+
     verbose = False
 
     # Set to automatically flush messages to javascript side without buffering after render.
     auto_flush = True
 
+    # Policy deciding when automatic flushes happen (None flushes after every buffered command).
+    flush_policy = None
+
+    # Set to send commands in compact form using the session symbol table.
+    use_symbol_table = False
+
+    # Set to BINARY_FORMAT to send command batches as binary frames instead of JSON.
+    command_format = JSON_FORMAT
+
+    # Set to False to send buffered commands without the peephole optimization pass.
+    optimize_commands = True
+
+    # Set to fully validate command trees built by the command proxy classes (for debugging).
+    # Otherwise they are trusted and converted directly; raw lists are always fully validated.
+    strict_validation = False
+
+    # Flow control for command batches, disabled when all limits are None.
+    # Batches beyond the limits are queued until the view acknowledges earlier batches.
+    max_batches_in_flight = None
+    max_bytes_in_flight = None
+    max_bytes_per_second = None
+    # Seconds to wait for an acknowledgement before assuming it was lost.
+    ack_timeout = 30.0
+
     def __init__(self, *pargs, **kwargs):
         super(JSProxyWidget, self).__init__(*pargs, **kwargs)
         # top level access for element operations
@@ -202,8 +371,33 @@ class JSProxyWidget(widgets.DOMWidget):
         ##pr "registered on_msg(handle_custom_message)"
         self.on_msg(self.handle_custom_message_wrapper)
         self.buffered_commands = []
+        # strings and target paths already sent to the view in this session
+        self.symbols = SymbolTable()
+        # count --> (payload, segmented, buffers, symbol generation) for unacknowledged batches
+        self._symbol_batches = collections.OrderedDict()
+        # definitions already sent to the view session, kept for views which missed them:
+        # template identifier --> [parameters, template] and function hash --> [arguments, body]
+        self.templates_sent = {}
+        self.functions_sent = {}
+        # accumulators for segmented callback messages (per widget)
+        self._json_accumulator = []
+        self._binary_accumulator = []
+        # flow control state: queued batches and unacknowledged batches by counter
+        self._send_queue = collections.deque()
+        self._in_flight = {}
+        self._rate_allowance = 0
+        self._rate_time = None
+        self._drain_scheduled = False
         #self.commands_awaiting_render = []
         self.last_commands_sent = []
+        # number of commands removed by the peephole optimizer
+        self.commands_optimized_away = 0
+        self.evaluation_counter = 0
+        # evaluation request id --> None while outstanding, then (json_value, error)
+        self._evaluations = {}
+        # asyncio futures for evaluate_async and rendered_async awaiting the view
+        self._evaluation_futures = {}
+        self._render_futures = []
         self.last_callback_results = None
         self.results = []
         self.status = "Not yet rendered"
@@ -219,18 +413,7 @@ class JSProxyWidget(widgets.DOMWidget):
             // Initialize caching slots.
             element._FRAGILE_THIS = null;
             element._FRAGILE_JS_REFERENCE = null;
-
-            // The following is used for sending synchronous values.
-            element._SEND_FRAGILE_JS_REFERENCE = function(ms_delay) {
-                // xxxxx add a delay to allow the Python side to be ready for the response (???)
-                ms_delay = ms_delay || 100;
-                var ref = element._FRAGILE_JS_REFERENCE;
-                var delayed = function () {
-                    RECEIVE_FRAGILE_REFERENCE(ref);
-                };
-                setTimeout(delayed, ms_delay);
-            };
-        """, RECEIVE_FRAGILE_REFERENCE=self._RECEIVE_FRAGILE_REFERENCE, callable_level=5)
+        """)
 
     def set_element(self, slot_name, value):
         """
@@ -250,6 +433,30 @@ class JSProxyWidget(widgets.DOMWidget):
         code = "\n".join(codeList)
         self.js_init(code, callback=callback)
 
+    def prepare(self, command, parameters=None):
+        """
+        Register a command template containing Param(name) slots for repeated use.
+        Return a PreparedCommand which buffers an invocation when called with the parameter
+        values, positionally in the parameters order (by default the order of appearance)
+        or by keyword.  The template is validated once and sent to the view once per session;
+        invocations send only the template id and the argument values.
+
+        >>> update = widget.prepare(widget.get_element().update_point(Param("i"), Param("x"), Param("y")))
+        >>> for (i, (x, y)) in enumerate(points):
+        ...     update(i, x, y)
+        """
+        template = self.validate_command(quoteIfNeeded(command))
+        found = template_parameters(template)
+        if parameters is None:
+            parameters = found
+        else:
+            parameters = list(parameters)
+            missing = [name for name in found if name not in parameters]
+            assert not missing, "template parameters not listed: " + repr(missing)
+        identifier = self.counter
+        self.counter = identifier + 1
+        return PreparedCommand(self, identifier, parameters, template)
+
     def js_init(self, js_function_body, callable_level=3, **other_arguments):
         """
         Run special purpose javascript initialization code.
@@ -279,7 +486,10 @@ class JSProxyWidget(widgets.DOMWidget):
         #other_argument_values = self.wrap_callables(other_argument_values)
         argument_names = list(["element"] + other_argument_names)
         argument_values = list([self.get_element()] + other_argument_values)
-        function = self.function(argument_names, js_function_body)
+        if self.cache_js_functions:
+            function = self.compiled_function(argument_names, js_function_body)
+        else:
+            function = self.function(argument_names, js_function_body)
         function_call = function(*argument_values)
         # execute the function call on the javascript side.
         def action():
@@ -350,21 +560,31 @@ class JSProxyWidget(widgets.DOMWidget):
                 #("xxxx flushing on render")
                 self.flush()
             self.status= "Rendered."
+            if new:
+                futures = self._render_futures
+                self._render_futures = []
+                for future in futures:
+                    if not future.done():
+                        future.set_result(True)
         except Exception as e:
             self.error_msg = repr(e)
             raise
 
-    def send_custom_message(self, indicator, payload):
+    def send_custom_message(self, indicator, payload, buffers=None, compression=None, format=None):
         package = { 
             INDICATOR: indicator,
             PAYLOAD: payload,
         }
+        if compression:
+            package[COMPRESSION] = compression
+        if format:
+            package[FORMAT] = format
         self._last_payload = payload
         if self.verbose:
             print("sending")
             pprint(package)
         #debug_check_commands(package)
-        self.send(package)
+        self.send(package, buffers)
 
     # slot for last message data debugging
     _last_message_data = None
@@ -407,25 +627,56 @@ class JSProxyWidget(widgets.DOMWidget):
             self._last_message_data = data
             indicator = data[INDICATOR]
             payload = data[PAYLOAD]
+            # binary message buffers, if any, follow the message content
+            buffers = etcetera[0] if etcetera else None
+            if buffers and indicator in (RESULTS, CALLBACK_RESULTS, EVALUATE_RESULT):
+                payload = restore_buffers(payload, buffers)
             if indicator == RESULTS:
                 self.results = payload
                 self.status = "Got results."
                 self.handle_results(payload)
+            elif indicator == EVALUATE_RESULT:
+                self.handle_evaluate_result(payload)
             elif indicator == CALLBACK_RESULTS:
                 self.status = "got callback results"
                 self.last_callback_results = payload
                 self.handle_callback_results(payload)
+            elif indicator == SESSION_RESET:
+                self.status = "view session reset"
+                self.handle_session_reset()
+            elif indicator == SYMBOL_RESEND:
+                self.status = "view requested symbol resend"
+                self.handle_symbol_resend(payload)
+            elif indicator == ASSET_REQUEST:
+                self.status = "got asset request"
+                self.handle_asset_request(payload)
+            elif indicator == DEFINITION_REQUEST:
+                self.status = "got definition request"
+                self.handle_definition_request(payload)
             elif indicator == JSON_CB_FRAGMENT:
                 self.status = "got callback fragment"
-                self._json_accumulator.append(payload)
+                if data.get(COMPRESSION):
+                    self._binary_accumulator.append(buffers[0])
+                else:
+                    self._json_accumulator.append(payload)
             elif indicator == JSON_CB_FINAL:
                 self.status = "got callback final"
-                acc = self._json_accumulator
-                self._json_accumulator = []
-                acc.append(payload)
+                if data.get(COMPRESSION):
+                    # the first buffer is the last compressed fragment: others are data buffers.
+                    acc = self._binary_accumulator
+                    self._binary_accumulator = []
+                    acc.append(buffers[0])
+                    buffers = buffers[1:]
+                    acc = [inflate(acc)]
+                else:
+                    acc = self._json_accumulator
+                    self._json_accumulator = []
+                    acc.append(payload)
                 self._last_accumulated_json = acc
                 accumulated_json_str = u"".join(acc)
-                accumulated_json_ob = json.loads(accumulated_json_str)
+                accumulated_json_ob = JSON_BACKEND.loads(accumulated_json_str)
+                if buffers:
+                    accumulated_json_ob = restore_buffers(accumulated_json_ob, buffers)
                 self.handle_callback_results(accumulated_json_ob)
             else:
                 self.status = "Unknown indicator from custom message " + repr(indicator)
@@ -436,6 +687,56 @@ class JSProxyWidget(widgets.DOMWidget):
             self.error_msg = repr(e)
             raise
 
+    def handle_session_reset(self):
+        "A new javascript model was created for the widget: forget session state shared with the old one."
+        self.reset_session_state()
+        # batches sent to the old model will never be acknowledged
+        self._in_flight.clear()
+        self.drain_send_queue()
+
+    def reset_session_state(self):
+        "Start a new symbol table generation and forget templates and functions sent to the view."
+        self.symbols.reset()
+        self.templates_sent.clear()
+        self.functions_sent.clear()
+        # queued batches were encoded against the old symbol table
+        queue = self._send_queue
+        self._send_queue = collections.deque(self.queue_entry(*entry[:3]) for entry in queue)
+
+    def handle_symbol_resend(self, payload):
+        """
+        The view dropped batch count (and the batches after it) encoded against symbol table generation,
+        which it does not have (after a page reload).  Resend them encoded for a new table.
+        """
+        [count, generation] = payload
+        symbols = self.symbols
+        if generation == symbols.generation:
+            self.reset_session_state()
+        batches = self._symbol_batches
+        stale = [c for c in batches if c >= count and batches[c][3] < symbols.generation]
+        for c in stale:
+            (batch, segmented, buffers, batch_generation) = batches[c]
+            self.transmit_commands(batch, segmented, buffers)
+
+    def handle_asset_request(self, hashes):
+        "Send the texts of assets the view does not have (None for unknown hashes)."
+        self.send_custom_message(ASSET_TEXT, dict((h, ASSETS.get(h)) for h in hashes))
+
+    def handle_definition_request(self, payload):
+        """
+        A view (rendered after the definition was sent) lacks the "function" or "template" definition
+        a command refers to: send it again (None if it is not defined in this session).
+        """
+        [kind, key] = payload
+        definitions = self.templates_sent if kind == "template" else self.functions_sent
+        definition = definitions.get(key)
+        buffers = None
+        if definition is not None and kind == "template":
+            [parameters, template] = definition
+            ([template], buffers) = extract_buffers([template])
+            definition = [parameters, template]
+        self.send_custom_message(DEFINITION_TEXT, [kind, key, definition], buffers)
+
     def unique_id(self, prefix="jupyter_proxy_widget_id_"):
         IDENTITY_COUNTER[0] += 1
         return prefix + str(IDENTITY_COUNTER[0])
@@ -452,17 +753,33 @@ class JSProxyWidget(widgets.DOMWidget):
     def buffer_commands(self, commands):
         self.buffered_commands.extend(commands)
         if self.auto_flush:
-            self.flush()
+            policy = self.flush_policy
+            if policy is None:
+                self.flush()
+            else:
+                policy.buffered(self, commands)
         return commands
 
+    def set_flush_policy(self, policy):
+        """
+        Use policy (like CellFlushPolicy() or WindowFlushPolicy(5)) to decide when to send
+        automatically flushed commands.  None flushes after every buffered command.
+        """
+        if self.buffered_commands:
+            self.flush()
+        self.flush_policy = policy
+
     def seg_flush(self, results_callback=None, level=1, segmented=BIG_SEGMENT):
         "flush a potentially large command sequence, segmented."
         return self.flush(results_callback, level, segmented)
 
     error_on_flush = False  # Primarily for debugging
 
-    def flush(self, results_callback=None, level=1, segmented=None):
-        "send the buffered commands and clear the buffer. Convenience."
+    def flush(self, results_callback=None, level=1, segmented=None, results=None):
+        """
+        send the buffered commands and clear the buffer. Convenience.
+        results selects values returned to results_callback: see send_commands.
+        """
         if not self.rendered:
             #("XXXX not flushing before render", len(self.buffered_commands))
             self.status = "deferring flush until render"
@@ -472,7 +789,7 @@ class JSProxyWidget(widgets.DOMWidget):
         commands = self.buffered_commands
         self.buffered_commands = []
         #("XXXXX now flushing", len(commands))
-        result = self.send_commands(commands, results_callback, level, segmented=segmented)
+        result = self.send_commands(commands, results_callback, level, segmented=segmented, results=results)
         self._send_counter += 1
         return result
 
@@ -653,6 +970,28 @@ class JSProxyWidget(widgets.DOMWidget):
         klass = self.window().Function
         return self.get_element().New(klass, list(arguments) + [body])
 
+    # Set to False to compile js_init bodies with a fresh "new Function(...)" every call.
+    cache_js_functions = True
+
+    def compiled_function(self, arguments, body):
+        """
+        Proxy reference to a JS function compiled once per page and cached by content hash.
+        The body text is sent only the first time this widget session uses it.
+        """
+        arguments = list(arguments)
+        key = function_hash(arguments, body)
+        if key in FUNCTION_NAMES:
+            FUNCTION_NAMES.move_to_end(key)
+        else:
+            # later commands refer to the function by hash only: keep the names it may read
+            FUNCTION_NAMES[key] = frozenset(re.findall(r"[\w$]+", ",".join(arguments) + "\n" + body))
+            if len(FUNCTION_NAMES) > FUNCTION_NAMES_LIMIT:
+                FUNCTION_NAMES.popitem(last=False)
+        if key in self.functions_sent:
+            return CompiledFunction(key)
+        self.functions_sent[key] = [arguments, body]
+        return CompiledFunction(key, arguments, body)
+
     handle_results_exception = None
 
     def handle_results(self, new):
@@ -660,6 +999,10 @@ class JSProxyWidget(widgets.DOMWidget):
         if self.verbose:
             print ("got results", new)
         [identifier, json_value] = new
+        self._symbol_batches.pop(identifier, None)
+        # the view acknowledges each command batch when it finishes executing it
+        if self._in_flight.pop(identifier, None) is not None and self._send_queue:
+            self.drain_send_queue()
         i2c = self.identifier_to_callback
         results_callback = i2c.get(identifier)
         if results_callback is not None:
@@ -682,13 +1025,18 @@ class JSProxyWidget(widgets.DOMWidget):
         self.last_callback_results = new
         if self.verbose:
             print ("got callback results", new)
-        [identifier, json_value, arguments, counter] = new
+        [identifier, json_value, arguments, counter] = new[:4]
+        # rate limited callbacks may deliver several held back calls in one batch
+        batch = len(new) > 4 and new[4]
         i2c = self.identifier_to_callback
         results_callback = i2c.get(identifier)
         self.status = "call back to " + repr(results_callback)
         if results_callback is not None:
             try:
-                results_callback(json_value, arguments)
+                for call_arguments in (arguments if batch else [arguments]):
+                    result = results_callback(json_value, call_arguments)
+                    if inspect.isawaitable(result):
+                        self.run_soon(result)
             except Exception as e:
                 #pr ("handle results callback exception " +repr(e))
                 self.handle_callback_results_exception = e
@@ -699,35 +1047,47 @@ class JSProxyWidget(widgets.DOMWidget):
         "Send a single command to the JS View."
         return self.send_commands([command], results_callback, level)
 
-    def send_commands(self, commands_iter, results_callback=None, level=1, segmented=None, check=False):
+    def send_commands(self, commands_iter, results_callback=None, level=1, segmented=None, check=False, results=None):
         """Send several commands fo the JS View.
         If segmented is a positive integer then the commands payload will be pre-encoded
-        as a json string and sent in segments of that length
+        as a json string and sent in segments of that length.
+        By default results_callback only receives true when the batch executes (false on failure).
+        If results is True it receives the list of command values converted to depth level,
+        or if results is a sequence of command indices only those values (others are None).
         """
         count = self.counter
         self.counter = count + 1
         commands_iter = list(commands_iter)
         qcommands = list(map(quoteIfNeeded, commands_iter))
+        if self.rendered and self.buffered_commands:
+            # also send buffered commands (validated along with the new commands)
+            if results is not None and results is not True:
+                offset = len(self.buffered_commands)
+                results = [offset + index for index in results]
+            qcommands = self.buffered_commands + qcommands
+            self.buffered_commands = []
         commands = self.validate_commands(qcommands)
-        if check:
-            debug_check_commands(commands)
+        # the optimizer would move the command indices of requested results
+        if self.rendered and self.optimize_commands and len(commands) > 1 and results is None:
+            (commands, removed) = optimize_commands(commands)
+            self.commands_optimized_away += removed
         if self.rendered:
-            # also send buffered commands
-            #if self.commands_awaiting_render:
-            #    commands = commands + self.commands_awaiting_render
-            #    self.commands_awaiting_render = None
-            if self.buffered_commands:
-                commands = self.buffered_commands + commands
-                self.buffered_commands = []
+            # binary values travel as message buffers, not in the JSON payload
+            (commands, buffers) = extract_buffers(commands)
+            if check:
+                debug_check_commands(commands)
             payload = [count, commands, level]
+            if results is not None:
+                # only batches that ask for results pay for returning them
+                payload.append({"results": True if results is True else sorted(set(results))})
             if results_callback is not None:
                 self.identifier_to_callback[count] = results_callback
-            # send the command using the commands traitlet which is mirrored to javascript.
-            #self.commands = payload
-            if segmented and segmented > 0:
-                self.send_segmented_message(COMMANDS_FRAGMENT, COMMANDS_FINAL, payload, segmented)
+            if self.flow_controlled():
+                # encode once: the encoded length is the flow control size
+                self._send_queue.append(self.queue_entry(payload, segmented, buffers))
+                self.drain_send_queue()
             else:
-                self.send_custom_message(COMMANDS, payload)
+                self.transmit_commands(payload, segmented, buffers)
             self.last_commands_sent = payload
             return payload
         else:
@@ -737,83 +1097,364 @@ class JSProxyWidget(widgets.DOMWidget):
             self.buffered_commands.extend(commands)
             return ("awaiting render", commands)
 
-    def send_segmented_message(self, frag_ind, final_ind, payload, segmented):
-        "Send a message in fragments."
-        json_str = json.dumps(payload)
-        len_json = len(json_str)
-        cursor = 0
-        # don't reallocate large string tails...
-        while len_json - cursor > segmented:
-            next_cursor = cursor + segmented
-            json_fragment = json_str[cursor: next_cursor]
-            # send the fragment
-            self.send_custom_message(frag_ind, json_fragment)
-            cursor = next_cursor
-        json_tail = json_str[cursor:]
-        self.send_custom_message(final_ind, json_tail)
+    def transmitted_payload(self, payload):
+        "The [count, commands, level] or [count, commands, level, options] batch in the form sent to the view."
+        # payloads may carry an options dictionary requesting results
+        options = dict(payload[3]) if len(payload) > 3 else {}
+        payload = payload[:3]
+        if self.use_symbol_table:
+            # encode when sent (or queued) so batches use the current session table
+            (count, commands, level) = payload
+            payload = [count, self.symbols.encode_commands(commands), level]
+            # the view asks for a resend if it does not have this table generation
+            options["symbols"] = self.symbols.generation
+        if options:
+            payload = payload + [options]
+        return payload
+
+    def queue_entry(self, payload, segmented=None, buffers=None):
+        "Encode a batch for the flow control queue as (payload, segmented, buffers, size, encoded)."
+        transmitted = self.transmitted_payload(payload)
+        if self.command_format == BINARY_FORMAT:
+            encoded = encode_frame(transmitted)
+        else:
+            # sent as a binary buffer, so the text is not encoded again inside the comm message
+            encoded = "".join(json_iterencode(transmitted)).encode("utf-8")
+        size = len(encoded)
+        for buffer in buffers or ():
+            size += memoryview(buffer).nbytes
+        return (payload, segmented, buffers, size, encoded)
+
+    def transmit_commands(self, payload, segmented=None, buffers=None, encoded=None):
+        """
+        Send a [count, commands, level] or [count, commands, level, options] command batch to the view now.
+        encoded is the batch UTF-8 JSON text or binary frame if it was already encoded by queue_entry.
+        """
+        if self.use_symbol_table:
+            # keep the batch until acknowledged in case the view needs it resent
+            batches = self._symbol_batches
+            batches[payload[0]] = (payload, segmented, buffers, self.symbols.generation)
+            if len(batches) > SYMBOL_RESEND_LIMIT:
+                batches.popitem(last=False)
+        if encoded is not None:
+            format = BINARY_FORMAT if self.command_format == BINARY_FORMAT else JSON_TEXT_FORMAT
+            return self.send_binary_frame(COMMANDS_FRAGMENT, COMMANDS_FINAL, encoded, segmented, buffers, format)
+        payload = self.transmitted_payload(payload)
+        if self.command_format == BINARY_FORMAT:
+            return self.send_binary_frame(COMMANDS_FRAGMENT, COMMANDS_FINAL, encode_frame(payload), segmented, buffers)
+        # send the command using the commands traitlet which is mirrored to javascript.
+        #self.commands = payload
+        if segmented and segmented > 0:
+            self.send_segmented_message(COMMANDS_FRAGMENT, COMMANDS_FINAL, payload, segmented, buffers)
+        else:
+            self.send_custom_message(COMMANDS, payload, buffers)
+
+    def flow_controlled(self):
+        "Return True if any flow control limit is set."
+        return (self.max_batches_in_flight is not None or self.max_bytes_in_flight is not None
+            or self.max_bytes_per_second is not None)
+
+    def flow_status(self):
+        "Report the flow control queue depth and unacknowledged batches."
+        return dict(
+            queued=len(self._send_queue),
+            queued_bytes=sum(entry[3] for entry in self._send_queue),
+            in_flight=len(self._in_flight),
+            bytes_in_flight=sum(size for (size, sent) in self._in_flight.values()),
+        )
+
+    def drain_send_queue(self):
+        "Send queued command batches as far as the flow control limits allow."
+        queue = self._send_queue
+        in_flight = self._in_flight
+        now = time.time()
+        timeout = self.ack_timeout
+        if timeout is not None:
+            for (count, (size, sent)) in list(in_flight.items()):
+                if now - sent > timeout:
+                    # assume the acknowledgement was lost
+                    del in_flight[count]
+        max_batches = self.max_batches_in_flight
+        max_bytes = self.max_bytes_in_flight
+        rate = self.max_bytes_per_second
+        if rate is not None:
+            # refill the allowance for the elapsed time, allowing at most one second of burst.
+            if self._rate_time is not None:
+                self._rate_allowance = min(rate, self._rate_allowance + (now - self._rate_time) * rate)
+            else:
+                self._rate_allowance = rate
+            self._rate_time = now
+        while queue:
+            (payload, segmented, buffers, size, encoded) = queue[0]
+            if max_batches is not None and len(in_flight) >= max_batches:
+                break
+            if max_bytes is not None and in_flight:
+                # a batch larger than the limit may be sent alone
+                bytes_in_flight = sum(s for (s, sent) in in_flight.values())
+                if bytes_in_flight + size > max_bytes:
+                    break
+            if rate is not None:
+                if self._rate_allowance <= 0:
+                    self._schedule_drain(- self._rate_allowance / rate)
+                    break
+                self._rate_allowance -= size
+            queue.popleft()
+            in_flight[payload[0]] = (size, now)
+            self.transmit_commands(payload, segmented, buffers, encoded)
+        if queue and in_flight and timeout is not None:
+            # recheck when the oldest acknowledgement times out.
+            oldest = min(sent for (size, sent) in in_flight.values())
+            self._schedule_drain(max(0, oldest + timeout - now))
+
+    def _schedule_drain(self, delay):
+        if self._drain_scheduled:
+            return
+        self._drain_scheduled = True
+        def scheduled_drain():
+            self._drain_scheduled = False
+            self.drain_send_queue()
+        call_later(delay, scheduled_drain)
+
+    def wait_for_send_queue(self, max_queued=0):
+        "Process kernel messages until at most max_queued command batches are waiting to be sent."
+        def drained():
+            self.drain_send_queue()
+            if len(self._send_queue) <= max_queued:
+                return True
+            return None
+        if drained() is None:
+            run_ui_poll_loop(drained)
 
+    def send_segmented_message(self, frag_ind, final_ind, payload, segmented, buffers=None):
+        """
+        Send a message in fragments.  Binary buffers are attached to the final fragment.
+        The JSON text is encoded incrementally and each fragment is sent as soon as it fills,
+        so the whole JSON string is never held in memory.
+        """
+        return self.send_json_chunks(frag_ind, final_ind, json_iterencode(payload), segmented, buffers)
+
+    def send_json_chunks(self, frag_ind, final_ind, json_chunks, segmented=None, buffers=None):
+        "Send JSON text chunks in fragments of segmented characters (one message if segmented is None)."
+        threshold = self.compress_threshold
+        if threshold:
+            # look ahead up to the threshold to decide whether to compress
+            head = []
+            len_head = 0
+            for chunk in json_chunks:
+                head.append(chunk)
+                len_head += len(chunk)
+                if len_head >= threshold:
+                    break
+            json_chunks = itertools.chain(head, json_chunks)
+            if len_head >= threshold:
+                return self.send_compressed_message(frag_ind, final_ind, json_chunks, segmented, buffers)
+        if segmented and segmented > 0:
+            fragments = iter_segments(json_chunks, segmented, "")
+        else:
+            fragments = iter(["".join(json_chunks)])
+        json_tail = next(fragments)
+        for json_fragment in fragments:
+            self.send_custom_message(frag_ind, json_tail)
+            json_tail = json_fragment
+        self.send_custom_message(final_ind, json_tail, buffers)
+
+    def send_compressed_message(self, frag_ind, final_ind, json_chunks, segmented, buffers=None):
+        """
+        Send JSON text (a string or a sequence of string chunks) deflate compressed
+        in binary fragments of at most segmented bytes.
+        The final fragment is the first buffer of the final message, followed by any data buffers.
+        """
+        if isinstance(json_chunks, str):
+            json_chunks = [json_chunks]
+        self.send_binary_fragments(frag_ind, final_ind, iter_deflate(json_chunks), segmented, buffers, DEFLATE)
+
+    def send_binary_frame(self, frag_ind, final_ind, frame, segmented=None, buffers=None, format=BINARY_FORMAT):
+        """
+        Send a binary command frame (or UTF-8 JSON text with format JSON_TEXT_FORMAT),
+        compressed if it is at least compress_threshold bytes.
+        """
+        compression = None
+        threshold = self.compress_threshold
+        if threshold and len(frame) >= threshold:
+            frame = zlib.compress(frame)
+            compression = DEFLATE
+        self.send_binary_fragments(frag_ind, final_ind, [frame], segmented, buffers, compression, format)
+
+    def send_binary_fragments(self, frag_ind, final_ind, chunks, segmented, buffers=None, compression=None, format=None):
+        """
+        Send binary chunks regrouped in fragments of segmented bytes (one fragment if segmented is None).
+        The final fragment is the first buffer of the final message, followed by any data buffers.
+        """
+        if segmented and segmented > 0:
+            fragments = iter_segments(chunks, segmented, b"")
+        else:
+            fragments = iter([b"".join(chunks)])
+        tail = next(fragments)
+        for fragment in fragments:
+            self.send_custom_message(frag_ind, None, [tail], compression, format)
+            tail = fragment
+        final_buffers = [tail] + list(buffers or [])
+        self.send_custom_message(final_ind, None, final_buffers, compression, format)
+
+    # value of the latest completed synchronous evaluation
     _synced_command_result = None
-    _synced_command_evaluated = False
-    _synced_command_timed_out = False
-    _synced_command_timeout_time = None
 
-    def evaluate(self, command, level=3, timeout=3000, ms_delay=100):
-        "Evaluate the command and return the converted javascript value."
+    def evaluate(self, command, level=3, timeout=3000, ms_delay=None):
+        """
+        Evaluate the command and return the converted javascript value.
+        The view replies as soon as the command executes: ms_delay is deprecated and ignored.
+        """
+        if ms_delay is not None:
+            warnings.warn("ms_delay is deprecated and ignored: the view replies when the command executes",
+                DeprecationWarning, stacklevel=2)
+        request_id = self.request_evaluation(command, level)
+        return self.wait_for_evaluation(request_id, timeout)
+
+    def evaluate_many(self, commands, level=3, timeout=3000):
+        "Evaluate several commands in one round trip and return the list of converted values."
+        commands = [reference_of(c) for c in commands]
+        # the list adds one level of conversion depth
+        return self.evaluate(LiteralMaker(commands), level + 1, timeout)
+
+    def request_evaluation(self, command, level=3):
+        """
+        Send an evaluation request for the command and return its request id.
+        Any number of requests may be outstanding: see wait_for_evaluation.
+        """
+        command = reference_of(command)
+        self.evaluation_counter += 1
+        request_id = self.evaluation_counter
+        self._evaluations[request_id] = None
+        # the request executes in order after any buffered commands.
+        self.buffer_command(EvaluationRequest(request_id, command, level))
+        if self.buffered_commands:
+            self.flush()
+        return request_id
+
+    def wait_for_evaluation(self, request_id, timeout=3000):
+        "Wait for the reply to the evaluation request and return the converted value."
         # temporarily disable error prints
         print_on_error = self.print_on_error
         old_err = self.error_msg
+        evaluations = self._evaluations
+        start = time.time()
+        deadline = None
+        if timeout is not None and timeout > 0:
+            deadline = start + timeout
+        def complete():
+            if self._send_queue:
+                # scheduled drains may not run while polling
+                self.drain_send_queue()
+            if evaluations.get(request_id) is not None:
+                return True
+            if deadline is not None and time.time() > deadline:
+                return False
+            return None  # only None continues the polling loop.
         try:
             # Note: if the command buffer has not been flushed other operations may set the error_msg
             self.print_on_error = False
             self.error_msg = ""
-            self._synced_command_result = None
-            self._synced_command_timed_out = False
-            self._synced_command_evaluated = False
-            self._synced_command_timeout_time = None
-            start = time.time()
-            if timeout is not None and timeout > 0:
-                self._synced_command_timeout_time = start + timeout
-            start = self._synced_command_start_time = time.time()
-            self._send_synced_command(command, level, ms_delay=ms_delay)
-            run_ui_poll_loop(self._sync_complete)
-            if self._synced_command_timed_out:
+            if evaluations.get(request_id) is None:
+                run_ui_poll_loop(complete, EVALUATE_POLL_SLEEP)
+            reply = evaluations.pop(request_id, None)
+            if reply is None:
                 raise TimeoutError("wait: %s, started: %s; gave up %s" % (timeout, start, time.time()))
-            assert self._synced_command_evaluated, repr((self._synced_command_evaluated, self._synced_command_result))
+            (result, error) = reply
+            if error is not None:
+                raise JavascriptException("sync error: " + repr(error))
             error_msg = self.error_msg
-            result = self._synced_command_result
             if error_msg:
                 if error_msg == result:
                     raise JavascriptException("sync error: " + repr(error_msg))
                 else:
                     old_err = error_msg
+            self._synced_command_result = result
             return result
         finally:
             # restore error prints if formerly enabled
             self.error_msg = old_err
             self.print_on_error = print_on_error
 
-    def _send_synced_command(self, command, level, ms_delay=100):
-        if self.last_fragile_reference is not command:
-            set_ref = SetMaker(self.get_element(), FRAGILE_JS_REFERENCE, command)
-            self.buffer_command(set_ref)
-        #self.element._SEND_FRAGILE_JS_REFERENCE()
-        get_ref = CallMaker("method", self.get_element(), SEND_FRAGILE_JS_REFERENCE, ms_delay)
-        self.buffer_command(get_ref)
-        self.flush()
-
-    def _RECEIVE_FRAGILE_REFERENCE(self, value):
-        self._synced_command_result = value
-        self._synced_command_evaluated = True
-
-    def _sync_complete(self):
-        if self._synced_command_timeout_time is not None:
-            self._synced_command_timed_out = (time.time() > self._synced_command_timeout_time)
-        test = self._synced_command_evaluated or self._synced_command_timed_out
-        if test:
-            return test
-        else:
-            return None  # only None signals end of polling loop.
-    
+    def handle_evaluate_result(self, payload):
+        "The view replied to an evaluation request."
+        [request_id, json_value, error] = payload
+        if request_id not in self._evaluations:
+            return  # stale reply for an abandoned request
+        self.status = "got evaluate result"
+        self._evaluations[request_id] = (json_value, error)
+        future = self._evaluation_futures.pop(request_id, None)
+        if future is not None and not future.done():
+            future.set_result(True)
+
+    async def evaluate_async(self, command, level=3, timeout=3000):
+        """
+        Evaluate the command without blocking the event loop and return the converted javascript value.
+        Give up with TimeoutError after timeout milliseconds (None for no limit).
+        The reply arrives as a comm message handled by the running kernel event loop, so await this
+        from a task or callback on that loop (see run_soon): a cell awaiting it at top level blocks
+        comm message handling and only ends at the timeout.
+        """
+        request_id = self.request_evaluation(command, level)
+        evaluations = self._evaluations
+        try:
+            if evaluations.get(request_id) is None:
+                future = asyncio.get_running_loop().create_future()
+                self._evaluation_futures[request_id] = future
+                await asyncio.wait_for(future, timeout_seconds(timeout))
+        except asyncio.TimeoutError:
+            raise TimeoutError("no reply to evaluation request %s after %s milliseconds" % (request_id, timeout))
+        finally:
+            self._evaluation_futures.pop(request_id, None)
+            reply = evaluations.pop(request_id, None)
+        (result, error) = reply
+        if error is not None:
+            raise JavascriptException("async error: " + repr(error))
+        self._synced_command_result = result
+        return result
+
+    async def rendered_async(self, timeout=3000):
+        """
+        Wait until the view has rendered, at most timeout milliseconds (None for no limit).
+        Like evaluate_async this needs the running kernel event loop, not blocked by the awaiting cell.
+        """
+        if self.rendered:
+            return
+        future = asyncio.get_running_loop().create_future()
+        self._render_futures.append(future)
+        try:
+            await asyncio.wait_for(future, timeout_seconds(timeout))
+        except asyncio.TimeoutError:
+            raise TimeoutError("widget not rendered after %s milliseconds" % (timeout,))
+        finally:
+            if future in self._render_futures:
+                self._render_futures.remove(future)
+
+    async def flush_async(self, level=1, timeout=3000):
+        """
+        Wait for the render, flush buffered commands and return the view's acknowledgement.
+        The render and the acknowledgement each wait at most timeout milliseconds (None for no limit)
+        on the running kernel event loop, as for evaluate_async.
+        """
+        await self.rendered_async(timeout)
+        future = asyncio.get_running_loop().create_future()
+        def acknowledged(value):
+            if not future.done():
+                future.set_result(value)
+        self.flush(acknowledged, level)
+        try:
+            return await asyncio.wait_for(future, timeout_seconds(timeout))
+        except asyncio.TimeoutError:
+            raise TimeoutError("commands not acknowledged after %s milliseconds" % (timeout,))
+
+    def run_soon(self, awaitable):
+        "Schedule the awaitable as a task on the kernel event loop, reporting exceptions in error_msg."
+        task = asyncio.ensure_future(awaitable, loop=event_loop())
+        def done(task):
+            if not task.cancelled() and task.exception() is not None:
+                self.error_msg = "Async callback: " + repr(task.exception())
+        task.add_done_callback(done)
+        return task
+
     """ # doesn't work: not used.
     def evaluate(self, command, level=1, timeout=3000):
         "Send one command and wait for result.  Return result."
@@ -847,20 +1488,24 @@ class JSProxyWidget(widgets.DOMWidget):
         """
         return self.callback(callback_function, data, level, delay, segmented)
 
-    def callable(self, function_or_method, level=1, delay=False, segmented=None):
+    def callable(self, function_or_method, level=1, delay=False, segmented=None, **rate_options):
         """
         Simplified callback protocol.
         Map function_or_method to a javascript function js_function
         Calls to js_function(x, y, z)
         will trigger calls to function_or_method(x, y, z)
         where x, y, z are json compatible values.
+        rate_options (throttle_ms, debounce_ms, leading, trailing, latest_only) are described in callback.
         """
         # do not double wrap CallMakers
         if isinstance(function_or_method, CallMaker):
             return function_or_method
         # get existing wrapper value from cache, if available
         cache = self.callable_cache
-        result = cache.get(function_or_method)
+        key = function_or_method
+        if rate_options:
+            key = (function_or_method, tuple(sorted(rate_options.items())))
+        result = cache.get(key)
         if result is not None:
             return result
         data = repr(function_or_method)
@@ -876,13 +1521,25 @@ class JSProxyWidget(widgets.DOMWidget):
                     count += 1
                 else:
                     break
-            function_or_method(*py_arguments)
-        result = self.callback(callback_function, data, level, delay, segmented)
-        cache[function_or_method] = result
+            # coroutines from async functions are scheduled by handle_callback_results
+            return function_or_method(*py_arguments)
+        result = self.callback(callback_function, data, level, delay, segmented, **rate_options)
+        cache[key] = result
         return result
 
-    def callback(self, callback_function, data, level=1, delay=False, segmented=None):
-        "Create a 'proxy callback' to receive events detected by the JS View."
+    def callback(self, callback_function, data, level=1, delay=False, segmented=None,
+        throttle_ms=None, debounce_ms=None, leading=None, trailing=True, latest_only=False):
+        """
+        Create a 'proxy callback' to receive events detected by the JS View.
+        The view limits the messages sent for frequent events (like mousemove) if requested:
+        throttle_ms sends at most one message per interval and
+        debounce_ms sends once calls stop for the interval.
+        leading sends the first call of an interval or burst at once
+        (default True for throttle_ms and False for debounce_ms) and
+        trailing sends the calls held back at the end of the interval or burst.
+        Held back calls arrive in one message and callback_function is called for each,
+        or only for the most recent call if latest_only.
+        """
         assert level > 0, "level must be positive " + repr(level)
         assert level <= 5, "level cannot exceed 5 " + repr(level)
         assert segmented is None or (type(segmented) is int and segmented > 0), "bad segment " + repr(segmented)
@@ -890,7 +1547,11 @@ class JSProxyWidget(widgets.DOMWidget):
         self.counter = count + 1
         assert not isinstance(callback_function, CommandMakerSuperClass), "can't callback command maker " + type(callback_function)
         assert not str(data).startswith("Fragile"), "DEBUG::" + repr(data)
-        command = CallMaker("callback", count, data, level, segmented)
+        policy = rate_policy(throttle_ms, debounce_ms, leading, trailing, latest_only)
+        if policy is None:
+            command = CallMaker("callback", count, data, level, segmented)
+        else:
+            command = CallMaker("callback", count, data, level, segmented, policy)
         #if delay:
         #    callback_function = delay_in_thread(callback_function)
         self.identifier_to_callback[count] = callback_function
@@ -925,17 +1586,23 @@ class JSProxyWidget(widgets.DOMWidget):
 
     def get_element(self):
         "Return a proxy reference to the Widget JQuery element this.$el."
-        return CommandMaker("element")
+        return ELEMENT
 
     def window(self):
         "Return a proxy reference to the browser window top level name space."
-        return CommandMaker("window")
+        return WINDOW
 
     def load_js_files(self, filenames, force=True, local=True):
+        texts = {}
+        if force:
+            # fetch any remote files concurrently
+            texts = js_context.get_texts_from_file_names(filenames, local=True)
         for filepath in filenames:
             def load_the_file(filepath=filepath):
                 # pr ("loading " + filepath)
-                filetext = js_context.get_text_from_file_name(filepath, local=True)
+                filetext = texts.get(filepath)
+                if filetext is None:
+                    filetext = js_context.get_text_from_file_name(filepath, local=True)
                 cmd = self.load_js_command(filepath, filetext)
                 self(cmd)
             if force:
@@ -947,12 +1614,28 @@ class JSProxyWidget(widgets.DOMWidget):
                 # pr ("test/loading " + filepath + " " + repr(load_callback))
                 self.element.test_js_loaded([filepath], None, load_callback)
 
+    # Set to send asset texts by content hash: the view requests texts it does not have.
+    cache_assets = False
+
+    # Set to make the view keep cached assets in IndexedDB across page reloads.
+    persist_assets = False
+
     def load_js_command(self, js_name, js_text):
+        if self.cache_assets:
+            return self.load_asset_command(LOAD_JS, js_name, js_text)
         return Loader(LOAD_JS, js_name, js_text)
 
     def load_css_command(self, css_name, css_text):
+        if self.cache_assets:
+            return self.load_asset_command(LOAD_CSS, css_name, css_text)
         return Loader(LOAD_CSS, css_name, css_text)
 
+    def load_asset_command(self, indicator, name, text):
+        "Register the text by content hash and return a command loading it by hash."
+        key = asset_hash(text)
+        register_asset(key, text)
+        return AssetLoader(indicator, name, key, self.persist_assets)
+
 
     def validate_commands(self, commands, top=True):
         """
@@ -961,6 +1644,14 @@ class JSProxyWidget(widgets.DOMWidget):
         return [self.validate_command(c, top) for c in commands]
 
     def validate_command(self, command, top=True):
+        if type(command) is ValidatedCommand:
+            return command.command
+        if not self.strict_validation and isinstance(command, CommandMakerSuperClass):
+            # trusted fast path: library command trees are valid by construction.
+            command = command._validated(self)
+            if top and type(command) is not list:
+                raise ValueError("top level command must be a list " + repr(command))
+            return command
         # convert CommandMaker to list format.
         if isinstance(command, CommandMakerSuperClass):
             command = command._cmd()
@@ -990,8 +1681,21 @@ class JSProxyWidget(widgets.DOMWidget):
                 remainder = [target] + args
             elif indicator == "id" or indicator == "bytes":
                 assert len(remainder) == 1, "id or bytes takes one argument only " + repr(remainder)
+            elif indicator == "buffer":
+                [data] = remainder
+                assert isinstance(data, BINARY_TYPES), "buffer takes binary data only " + repr(type(data))
+            elif indicator == "ndarray":
+                [data, dtype_name, shape] = remainder
+                data = self.validate_command(data, top=False)
+                assert dtype_name in TYPED_ARRAY_DTYPES, "unsupported ndarray dtype " + repr(dtype_name)
+                assert type(shape) is list, "ndarray shape must be a list " + repr(shape)
+                remainder = [data, dtype_name, shape]
             elif indicator in LOAD_INDICATORS:
                 assert len(remainder) == 2, "loaders take exactly 2 arguments" + repr(len(remainder))
+            elif indicator == LOAD_ASSET:
+                [loader, name, key, persist] = remainder
+                assert loader in LOAD_INDICATORS, "bad asset loader " + repr(loader)
+                assert type(key) is str, "asset hash must be a string " + repr(key)
             elif indicator == "list":
                 remainder = self.validate_commands(remainder, top=False)
             elif indicator == "dict":
@@ -999,13 +1703,17 @@ class JSProxyWidget(widgets.DOMWidget):
                 d = dict((k, self.validate_command(d[k], top=False)) for k in d)
                 remainder = [d]
             elif indicator == "callback":
-                [numerical_identifier, untranslated_data, level, segmented] = remainder
+                [numerical_identifier, untranslated_data, level, segmented] = remainder[:4]
                 assert type(numerical_identifier) is int, \
                     "must be integer " + repr(numerical_identifier)
                 assert type(level) is int, \
                     "must be integer " + repr(level)
                 assert (segmented is None) or (type(segmented) is int and segmented > 0), \
                     "must be None or positive integer " + repr(segmented)
+                if len(remainder) > 4:
+                    # rate limiting policy
+                    [policy] = remainder[4:]
+                    remainder = remainder[:4] + [self.validate_command(policy, top=False)]
             elif indicator == "get":
                 [target, name] = remainder
                 target = self.validate_command(target, top=True)
@@ -1020,6 +1728,25 @@ class JSProxyWidget(widgets.DOMWidget):
             elif indicator == "null":
                 [target] = remainder
                 remainder = [self.validate_command(target, top=False)]
+            elif indicator == "param":
+                [name] = remainder
+                assert type(name) is str, "parameter name must be a string " + repr(name)
+            elif indicator == "define":
+                # the template was validated by prepare
+                [identifier, parameters, template] = remainder
+                assert type(identifier) is int, "must be integer " + repr(identifier)
+                assert type(parameters) is list, "parameters must be a list " + repr(parameters)
+            elif indicator == "invoke":
+                identifier = remainder[0]
+                assert type(identifier) is int, "must be integer " + repr(identifier)
+                remainder = [identifier] + self.validate_commands(remainder[1:], top=False)
+            elif indicator == "reply":
+                [request_id, target, level] = remainder
+                assert type(request_id) is int, "must be integer " + repr(request_id)
+                remainder = [request_id, self.validate_command(target, top=False), level]
+            elif indicator == "js_function":
+                assert len(remainder) in (1, 3), "js_function takes a hash and optionally arguments and body"
+                assert type(remainder[0]) is str, "function hash must be a string " + repr(remainder[0])
             else:
                 raise ValueError("bad indicator " + repr(indicator))
             command = [indicator] + remainder
@@ -1028,6 +1755,14 @@ class JSProxyWidget(widgets.DOMWidget):
         # Non-lists are untranslated (but should be JSON compatible).
         return command
 
+    def validate_trusted(self, x):
+        "Validate a component of a trusted command tree: only raw lists, dicts and callables are checked."
+        if type(x) in SCALAR_TYPES:
+            return x
+        if isinstance(x, CommandMakerSuperClass):
+            return x._validated(self)
+        return self.validate_command(x, top=False)
+
     def delay_flush(self):
         """
         Context manager to group a large number of operations into one message.
@@ -1057,17 +1792,143 @@ def to_javascript(thing, level=0, indent=None, comma=","):
         elif ty is list or ty is tuple:
             L = [to_javascript(x) for x in thing]
             json_value = "[%s]" % (comma.join(L))
-        elif ty is bytearray:
-            inner = list(map(int, thing))
+        elif ty is np.ndarray:
+            json_value = to_javascript(thing.tolist())
+        elif ty in BINARY_TYPES:
+            inner = list(bytearray(thing))
             # Note: no line breaks for binary data.
             json_value = "Uint8Array(%s)" % inner
         elif json_value is None:
-            json_value = json.dumps(thing, indent=indent)
+            json_value = json.dumps(thing, indent=indent, default=json_default)
         result = indent_string(json_value, level)
     assert type(result) is str, repr((thing, result))
     return result
 
 
+class FlushPolicy(object):
+    """
+    Decide when buffered commands are sent while auto_flush is set.
+    This base policy flushes immediately.
+    """
+
+    def buffered(self, widget, commands):
+        "Called after commands are added to the widget buffer."
+        widget.flush()
+
+
+class CellFlushPolicy(FlushPolicy):
+    """
+    Flush buffered commands when the current notebook cell finishes executing,
+    using the IPython post_execute event.  Flush immediately outside of IPython.
+    """
+
+    def buffered(self, widget, commands):
+        if register_cell_flush_hook():
+            CELL_FLUSH_WIDGETS[id(widget)] = widget
+        else:
+            widget.flush()
+
+
+class WindowFlushPolicy(FlushPolicy):
+    """
+    Flush buffered commands after a time window of ms milliseconds on the kernel event loop.
+    Note that the event loop does not run until the executing cell completes.
+    """
+
+    def __init__(self, ms=5):
+        self.ms = ms
+        self.scheduled = set()
+
+    def buffered(self, widget, commands):
+        key = id(widget)
+        if key in self.scheduled:
+            return
+        self.scheduled.add(key)
+        def window_flush():
+            self.scheduled.discard(key)
+            widget.flush()
+        call_later(self.ms / 1000.0, window_flush)
+
+
+class SizeFlushPolicy(FlushPolicy):
+    """
+    Flush when the buffer holds at least max_commands commands or about max_bytes bytes,
+    otherwise defer to the otherwise policy (by default at the end of the cell).
+    """
+
+    def __init__(self, max_commands=None, max_bytes=None, otherwise=None):
+        assert max_commands is not None or max_bytes is not None, "no size limit given"
+        self.max_commands = max_commands
+        self.max_bytes = max_bytes
+        if otherwise is None:
+            otherwise = CellFlushPolicy()
+        self.otherwise = otherwise
+        # estimated bytes buffered, by widget id
+        self.sizes = {}
+
+    def buffered(self, widget, commands):
+        key = id(widget)
+        full = False
+        max_commands = self.max_commands
+        if max_commands is not None and len(widget.buffered_commands) >= max_commands:
+            full = True
+        max_bytes = self.max_bytes
+        if max_bytes is not None and not full:
+            if len(widget.buffered_commands) <= len(commands):
+                # the buffer was flushed since the last estimate.
+                self.sizes[key] = 0
+            buffered = widget.buffered_commands
+            validated = [ValidatedCommand(c) for c in widget.validate_commands(list(map(quoteIfNeeded, commands)))]
+            # the flush reuses the validated commands
+            buffered[len(buffered) - len(commands):] = validated
+            size = self.sizes.get(key, 0)
+            for command in validated:
+                size += command.size()
+            self.sizes[key] = size
+            full = (size >= max_bytes)
+        if full:
+            self.sizes.pop(key, None)
+            widget.flush()
+        else:
+            self.otherwise.buffered(widget, commands)
+
+
+class ValidatedCommand(object):
+    "A buffered command already validated (by a SizeFlushPolicy estimate) and not validated again."
+
+    __slots__ = ("command",)
+
+    def __init__(self, command):
+        self.command = command
+
+    def size(self):
+        "Approximate number of bytes sent for the command."
+        try:
+            return len(JSON_BACKEND.dumps(self.command))
+        except TypeError:
+            # binary data travels in message buffers
+            ([command], buffers) = extract_buffers([self.command])
+            return payload_size(command, buffers)
+
+
+def register_cell_flush_hook():
+    "Register the post_execute hook flushing widgets after each cell.  Return False outside of IPython."
+    ip = IPython.get_ipython()
+    if ip is None or not hasattr(ip, "events"):
+        return False
+    if CELL_FLUSH_SHELL[0] is not ip:
+        ip.events.register("post_execute", flush_cell_widgets)
+        CELL_FLUSH_SHELL[0] = ip
+    return True
+
+def flush_cell_widgets():
+    "Flush widgets with commands buffered during the cell that just executed."
+    widgets = list(CELL_FLUSH_WIDGETS.values())
+    CELL_FLUSH_WIDGETS.clear()
+    for widget in widgets:
+        widget.flush()
+
+
 # Adapted from jp_doodle.dual_canvas.DisableRedrawContextManager
 
 class DisableFlushContextManager(object):
@@ -1130,6 +1991,11 @@ class ElementWrapper(object):
         self.widget.buffer_commands([command])
         return LazyGet(self.widget, self.widget_element, name)
 
+# Lazy chains: attribute access (LazyGet) is symbolic and sends nothing.  A call
+# (LazyCall, LazyMethodCall) sends its whole chain as one nested command which saves
+# the result in the fragile reference slot, so that chains continuing from the most
+# recent call use the slot instead of executing the call again.
+
 class StaleFragileJavascriptReference(ValueError):
     "Stale Javascript value reference"
 
@@ -1137,12 +2003,21 @@ class CommandMakerSuperClass(object):
     """
     Superclass for command proxy objects.
     """
+    # Command nodes are allocated in bulk: no instance __dict__ anywhere in the hierarchy.
+    __slots__ = ()
+
     def reference(self):
         "return cached value if available"
         return self # default -- not cached
 
+    def _validated(self, widget):
+        "Return the validated list form of the command (subclasses may trust their own structure)."
+        return widget.validate_command(self._cmd(), top=False)
+
 class LazyCommandSuperClass(CommandMakerSuperClass):
 
+    __slots__ = ()
+
     fragile_reference = "invalid"
 
     def __repr__(self):
@@ -1156,9 +2031,6 @@ class LazyCommandSuperClass(CommandMakerSuperClass):
         else:
             return self
 
-    def this_reference(self):
-        raise ValueError("this_reference only makes sense for Get")
-
     def javascript(self, *args):
         raise NotImplementedError("don't convert lazy commands to javascript for now.")
         #return repr("Javascript disabled for lazy commands: " + repr(type(self)))
@@ -1183,33 +2055,27 @@ class LazyCommandSuperClass(CommandMakerSuperClass):
             return f(*args)
         return result
 
-    def sync_value(self, timeout=3000, level=3, ms_delay=100):
+    def sync_value(self, timeout=3000, level=3, ms_delay=None):
         """
         Return the converted javascript-side value for this command.
+        ms_delay is deprecated and ignored (see JSProxyWidget.evaluate).
         """
-        for_widget = self.for_widget
-        for_widget.evaluate(self, timeout=timeout, level=level, ms_delay=ms_delay)
-        return for_widget._synced_command_result
+        return self.for_widget.evaluate(self, timeout=timeout, level=level, ms_delay=ms_delay)
 
 
 class LazyGet(LazyCommandSuperClass):
 
+    __slots__ = ("for_target", "for_widget", "attribute")
+
     def __init__(self, for_widget, for_target, attribute):
+        # symbolic: nothing is sent until the chain is called or used.
         self.for_target = for_target
         self.for_widget = for_widget
         self.attribute = attribute
-        # when executing immediately put target ref in fragile_this and attr value in fragile_ref
-        set_this = SetMaker(for_widget.get_element(), FRAGILE_THIS, for_target.reference())
-        # get attr value as element.fragile_this.attr
-        attr_ref = MethodMaker(MethodMaker(for_widget.get_element(), FRAGILE_THIS), attribute)
-        set_ref = SetMaker(for_widget.get_element(), FRAGILE_JS_REFERENCE, attr_ref)
-        # execute immediately on init
-        for_widget.buffer_commands([set_this, set_ref])
-        # use fragile ref to find value, until the cached value is replaced
-        for_widget.last_fragile_reference = self
 
     def _cmd(self):
-        m = MethodMaker(self.for_target, self.attribute)
+        # the target reference is resolved when the command is sent.
+        m = MethodMaker(self.for_target.reference(), self.attribute)
         return m._cmd()
 
     def __call__(self, *args):
@@ -1219,22 +2085,16 @@ class LazyGet(LazyCommandSuperClass):
             m = MethodMaker(self.for_target, self.attribute)
             return LazyCall(self.for_widget, m, *args)
 
-    def this_reference(self):
-        for_widget = self.for_widget
-        if for_widget.last_fragile_reference is self:
-            #return this.fragile_reference
-            return MethodMaker(for_widget.get_element(), FRAGILE_THIS)
-        else:
-            return self.for_target
-
 class LazyCall(LazyCommandSuperClass):
 
+    __slots__ = ("for_target", "for_widget", "args")
+
     def __init__(self, for_widget, for_target, *args):
         self.for_target = for_target
         self.for_widget = for_widget
         args = for_widget.wrap_callables(args)
         self.args = args
-        # when executing immediately save result of call in fragile_ref
+        # execute immediately and save result of call in fragile_ref
         set_ref = SetMaker(
             for_widget.get_element(),
             FRAGILE_JS_REFERENCE,
@@ -1245,20 +2105,23 @@ class LazyCall(LazyCommandSuperClass):
 
     def _cmd(self):
         c = CallMaker("function", self.for_target, *self.args)
-        return c.cmd()
+        return c._cmd()
         
 class LazyMethodCall(LazyCommandSuperClass):
 
+    __slots__ = ("for_method", "for_widget", "args")
+
     def __init__(self, for_widget, for_method, *args):
         self.for_method = for_method
         self.for_widget = for_widget
         args = for_widget.wrap_callables(args)
         self.args = args
-        # when executing immediately save result of call in fragile_ref
+        # execute immediately and save result of call in fragile_ref
+        # (the method is called on its target directly, with no intermediate slot writes)
         set_ref = SetMaker(
             for_widget.get_element(),
             FRAGILE_JS_REFERENCE,
-            CallMaker("method", for_method.this_reference(), for_method.attribute, *args)
+            CallMaker("method", for_method.for_target.reference(), for_method.attribute, *args)
         )
         for_widget.buffer_commands([set_ref])
         for_widget.last_fragile_reference = self
@@ -1275,6 +2138,8 @@ class CommandMaker(CommandMakerSuperClass):
     Directly implements top level objects like "window" and "element".
     """
 
+    __slots__ = ("name",)
+
     top_level_names = "window element".split()
 
     def __init__(self, name="window"):
@@ -1293,6 +2158,12 @@ class CommandMaker(CommandMakerSuperClass):
         "Translate self to JSON representation for transmission to view."
         return [self.name]
 
+    def _validated(self, widget):
+        if type(self) is CommandMaker:
+            return [self.name]
+        # subclasses without their own conversion are validated in full
+        return widget.validate_command(self._cmd(), top=False)
+
     def __getattr__(self, name):
         "Proxy to get a property of a jS object."
         return MethodMaker(self, name)
@@ -1316,6 +2187,12 @@ class CommandMaker(CommandMakerSuperClass):
         return ["null", self]
 
 
+# Shared top level references returned by get_element() and window().
+# Commands never modify their parts, so every widget can use the same objects.
+ELEMENT = CommandMaker("element")
+WINDOW = CommandMaker("window")
+
+
 # For attribute access use target[value] instead of target.name
 # because sometimes the value will not be a string.
 
@@ -1337,6 +2214,8 @@ class SetMaker(CommandMaker):
     Proxy container to set target.name = value.
     """
 
+    __slots__ = ("target", "value")
+
     def __init__(self, target, name, value):
         self.target = target
         self.name = name
@@ -1357,12 +2236,18 @@ class SetMaker(CommandMaker):
         value = self.value
         return ["set", target, self.name, value]
 
+    def _validated(self, widget):
+        v = widget.validate_trusted
+        return ["set", v(self.target), v(self.name), v(self.value)]
+
 
 class Loader(CommandMaker):
     """
     Special commands for loading css and js async.
     """
 
+    __slots__ = ("indicator", "text_content")
+
     def __init__(self, indicator, name, text_content):
         assert indicator in LOAD_INDICATORS
         self.indicator = indicator
@@ -1375,15 +2260,213 @@ class Loader(CommandMaker):
     def _cmd(self):
         return [self.indicator, self.name, self.text_content]
 
+    def _validated(self, widget):
+        return self._cmd()
+
+
+def asset_hash(text):
+    "Content hash identifying an asset text."
+    return hashlib.sha1(text.encode("utf-8")).hexdigest()
+
+def register_asset(key, text):
+    "Keep the asset text by hash, evicting the least recently registered texts beyond ASSETS_LIMIT."
+    if key in ASSETS:
+        ASSETS.move_to_end(key)
+        return
+    ASSETS[key] = text
+    ASSETS_SIZE[0] += len(text)
+    while ASSETS_SIZE[0] > ASSETS_LIMIT and len(ASSETS) > 1:
+        (_, evicted) = ASSETS.popitem(last=False)
+        ASSETS_SIZE[0] -= len(evicted)
+
+
+class AssetLoader(CommandMaker):
+    """
+    Load a css or js asset by content hash.
+    """
+
+    __slots__ = ("indicator", "key", "persist")
+
+    def __init__(self, indicator, name, key, persist=False):
+        assert indicator in LOAD_INDICATORS
+        self.indicator = indicator
+        self.name = name
+        self.key = key
+        self.persist = persist
+
+    def _cmd(self):
+        return [LOAD_ASSET, self.indicator, self.name, self.key, self.persist]
+
+    def _validated(self, widget):
+        return self._cmd()
+
+
+class Param(CommandMaker):
+    """
+    Named parameter slot in a prepared command template (see JSProxyWidget.prepare).
+    """
+
+    __slots__ = ()
+
+    def __init__(self, name):
+        assert type(name) is str, "parameter name must be a string " + repr(name)
+        self.name = name
+
+    def _cmd(self):
+        return ["param", self.name]
+
+
+class TemplateDefinition(CommandMaker):
+    """
+    Define a prepared command template in the view session.
+    """
+
+    __slots__ = ("identifier", "parameters", "template")
+
+    def __init__(self, identifier, parameters, template):
+        self.identifier = identifier
+        self.parameters = parameters
+        self.template = template
+
+    def _cmd(self):
+        return ["define", self.identifier, self.parameters, self.template]
+
+
+class TemplateInvocation(CommandMaker):
+    """
+    Execute a prepared command template with argument values.
+    """
+
+    __slots__ = ("identifier", "values")
+
+    def __init__(self, identifier, values):
+        self.identifier = identifier
+        self.values = quoteLists(values)
+
+    def _cmd(self):
+        return ["invoke", self.identifier] + self.values
+
+
+# Identifiers in compiled JS function texts by hash, for the command dependency analysis,
+# least recently used first.  Evicted hashes are treated as reading anything.
+FUNCTION_NAMES = collections.OrderedDict()
+FUNCTION_NAMES_LIMIT = 1024
+
+def function_hash(arguments, body):
+    "Content hash identifying a compiled JS function."
+    text = ",".join(arguments) + "\n" + body
+    return hashlib.sha1(text.encode("utf-8")).hexdigest()
+
+
+class EvaluationRequest(CommandMaker):
+    """
+    Execute a command and reply to the widget with its value (see JSProxyWidget.evaluate).
+    """
+
+    __slots__ = ("request_id", "command", "level")
+
+    def __init__(self, request_id, command, level):
+        self.request_id = request_id
+        self.command = command
+        self.level = level
+
+    def _cmd(self):
+        return ["reply", self.request_id, self.command, self.level]
+
+    def _validated(self, widget):
+        return ["reply", self.request_id, widget.validate_trusted(self.command), self.level]
+
+
+class CompiledFunction(CommandMaker):
+    """
+    Reference to a JS function in the page level compiled function cache.
+    """
+
+    __slots__ = ("key", "arguments", "body")
+
+    def __init__(self, key, arguments=None, body=None):
+        self.key = key
+        self.arguments = arguments
+        self.body = body
+
+    def _cmd(self):
+        if self.body is None:
+            return ["js_function", self.key]
+        return ["js_function", self.key, self.arguments, self.body]
+
+    def _validated(self, widget):
+        return self._cmd()
+
+    def __call__(self, *args):
+        return CallMaker("function", self, *args)
+
+
+class PreparedCommand(object):
+    """
+    Command template created by JSProxyWidget.prepare.
+    Call with the parameter values to buffer an invocation.
+    """
+
+    def __init__(self, widget, identifier, parameters, template):
+        self.widget = widget
+        self.identifier = identifier
+        self.parameters = parameters
+        self.template = template
+
+    def bind(self, args, kwargs):
+        "Return the argument values in parameter order."
+        parameters = self.parameters
+        if len(args) > len(parameters):
+            raise TypeError("too many arguments for template parameters " + repr(parameters))
+        values = list(args)
+        for name in parameters[len(args):]:
+            if name not in kwargs:
+                raise TypeError("missing template argument " + repr(name))
+            values.append(kwargs.pop(name))
+        if kwargs:
+            raise TypeError("unexpected template arguments " + repr(list(kwargs)))
+        return values
+
+    def __call__(self, *args, **kwargs):
+        widget = self.widget
+        identifier = self.identifier
+        commands = [TemplateInvocation(identifier, self.bind(args, kwargs))]
+        if identifier not in widget.templates_sent:
+            widget.templates_sent[identifier] = [self.parameters, self.template]
+            commands.insert(0, TemplateDefinition(identifier, self.parameters, self.template))
+        widget.buffer_commands(commands)
+
+
+def template_parameters(command, found=None):
+    "List the names of parameter slots in a validated command, in order of appearance."
+    if found is None:
+        found = []
+    ty = type(command)
+    if ty is list:
+        if command and command[0] == "param":
+            if command[1] not in found:
+                found.append(command[1])
+        else:
+            for x in command:
+                template_parameters(x, found)
+    elif ty is dict:
+        for x in command.values():
+            template_parameters(x, found)
+    return found
+
 
 class MethodMaker(CommandMaker):
     """
     Proxy reference to a property or method of a JS object.
     """
 
+    # validated_cache holds the validated form of pure attribute paths like element.a.b
+    __slots__ = ("target", "validated_cache")
+
     def __init__(self, target, name):
         self.target = target
         self.name = name
+        self.validated_cache = None
 
     def javascript(self, level=0):
         # use target[value] notation (see comment above)
@@ -1398,11 +2481,30 @@ class MethodMaker(CommandMaker):
         target = self.target
         return ["get", target, self.name]
 
+    def _validated(self, widget):
+        cached = self.validated_cache
+        if cached is not None:
+            return cached
+        target = self.target
+        v = widget.validate_trusted
+        result = ["get", v(target), v(self.name)]
+        if type(self.name) is str and (type(target) is CommandMaker or
+            (type(target) is MethodMaker and target.validated_cache is not None)):
+            self.validated_cache = result
+        return result
+
     def __call__(self, *args):
         return CallMaker("method", self.target, self.name, *args)
 
 
 
+def reference_of(command):
+    "Use the cached value of the latest lazy call rather than executing it again."
+    if isinstance(command, CommandMakerSuperClass):
+        return command.reference()
+    return command
+
+
 def format_args(args):
     args_js = [to_javascript(a, 1) for a in args]
     args_inner = ",\n".join(args_js)
@@ -1416,6 +2518,8 @@ class CallMaker(CommandMaker):
     Then proxy value is target.name(arg0, ..., argn)
     """
 
+    __slots__ = ("kind", "args")
+
     def __init__(self, kind, *args):
         self.kind = kind
         self.args = quoteLists(args)
@@ -1453,46 +2557,66 @@ class CallMaker(CommandMaker):
     def _cmd(self):
         return [self.kind] + self.args #+ validate_commands(self.args, False)
 
+    def _validated(self, widget):
+        v = widget.validate_trusted
+        return [self.kind] + [x if type(x) in SCALAR_TYPES else v(x) for x in self.args]
+
 
 def np_array_to_list(a):
     return a.tolist()
 
 
+def np_array_to_literal(a):
+    "Keep arrays that can travel as javascript typed arrays, otherwise convert to a list."
+    dtype_name = a.dtype.name
+    if dtype_name in TYPED_ARRAY_DTYPES or dtype_name in NDARRAY_DTYPE_CONVERSIONS:
+        return a
+    return a.tolist()
+
+
+def ndarray_command(a, downcast_float64=False):
+    """
+    Encode a numeric numpy array as ["ndarray", ["buffer", data], dtype_name, shape].
+    The data is the raw little endian array memory -- no copy is made if
+    the array is already contiguous with a supported dtype.
+    """
+    dtype_name = a.dtype.name
+    dtype_name = NDARRAY_DTYPE_CONVERSIONS.get(dtype_name, dtype_name)
+    if downcast_float64 and dtype_name == "float64":
+        dtype_name = "float32"
+    dtype = np.dtype(dtype_name).newbyteorder("<")
+    shape = list(a.shape)
+    flat = np.ascontiguousarray(a, dtype=dtype).reshape(-1)
+    return ["ndarray", ["buffer", memoryview(flat).cast("B")], dtype_name, shape]
+
+
 class LiteralMaker(CommandMaker):
     """
     Proxy to make a literal dictionary or list which may contain other
     proxy references.
     """
 
+    # Numpy scalars need no translation: the JSON encoders convert them (see json_default).
     translators = {
-        np.ndarray: np_array_to_list,
-        #np.float128: float,
-        #np.float16: float,
-        #np.float32: float,
-        #np.float64: float,
-        #np.int0: int,
-        #np.int16: int,
-        #np.int32: int,
-        #np.int64: int,
+        np.ndarray: np_array_to_literal,
     }
-    for type_name in "float float128 float16 float32 float64".split():
-        if hasattr(np, type_name):
-            ty = getattr(np, type_name)
-            translators[ty] = float
-    for type_name in "int int0 int16 int32 int64".split():
-        if hasattr(np, type_name):
-            ty = getattr(np, type_name)
-            translators[ty] = int
 
     indicators = {
         # things we can translate
-        dict: "dict", list: "list", bytearray: "bytes",
+        dict: "dict", list: "list",
+        bytearray: "buffer", bytes: "buffer", memoryview: "buffer",
+        np.ndarray: "ndarray",
         # we can't translate non-specific types, modules, etc.
         type: "don't translate non-specific types, like classes",
         type(json): "don't translate modules",
         # xxxx should improve sanity checking on types...
         }
 
+    # Set to send float64 (and int64) arrays as float32 typed arrays, halving the payload.
+    downcast_float64 = False
+
+    __slots__ = ("thing",)
+
     def __init__(self, thing):
         self.thing = thing
 
@@ -1511,12 +2635,26 @@ class LiteralMaker(CommandMaker):
                 return [indicator] + quoteLists(thing)
             elif ty is dict:
                 return [indicator, dict((k, quoteIfNeeded(thing[k])) for k in thing)]
-            elif ty is bytearray:
-                return [indicator, bytearray_to_hex(thing)]
+            elif indicator == "buffer":
+                return [indicator, thing]
+            elif indicator == "ndarray":
+                return ndarray_command(thing, self.downcast_float64)
             else:
                 raise ValueError("can't translate " + repr(ty))
         return thing
 
+    def _validated(self, widget):
+        thing = self.thing
+        ty = type(thing)
+        v = widget.validate_trusted
+        if ty is list:
+            return ["list"] + [v(quoteIfNeeded(x)) for x in thing]
+        elif ty is dict:
+            return ["dict", dict((k, v(quoteIfNeeded(thing[k]))) for k in thing)]
+        elif ty in BINARY_TYPES or ty is np.ndarray:
+            return self._cmd()
+        return widget.validate_command(self._cmd(), top=False)
+
 
 def quoteIfNeeded(arg):
     ty = type(arg)
@@ -1533,6 +2671,576 @@ def quoteLists(args):
     return [quoteIfNeeded(x) for x in args]
 
 
+# Element slots used internally for chained references.
+FRAGILE_SLOTS = (FRAGILE_THIS, FRAGILE_JS_REFERENCE)
+
+def optimize_commands(commands):
+    """
+    Peephole optimization of a validated top level command sequence.
+    Return the optimized commands and the number of commands removed.
+
+    - Repeated identical load_css/load_js commands are dropped.
+    - Fragile slot writes overwritten before any read are dropped
+      (or reduced to their value if evaluating it may have side effects).
+    - Consecutive property sets on the same pure target are merged into one
+      nested set chain, dropping sets of a property with a pure value which
+      are overwritten before any read.
+    """
+    # drop repeated loads
+    loads = set()
+    result = []
+    for command in commands:
+        if command[0] in LOAD_INDICATORS or command[0] == LOAD_ASSET:
+            key = tuple(command)
+            if key in loads:
+                continue
+            loads.add(key)
+        result.append(command)
+    # find dead fragile slot writes
+    dead = set()
+    unread = {}
+    for (index, command) in enumerate(result):
+        slot = fragile_slot_written(command)
+        checked = command[3] if slot else command
+        for name in list(unread):
+            if mentions(checked, name):
+                del unread[name]
+        if slot:
+            if slot in unread:
+                dead.add(unread[slot])
+            unread[slot] = index
+    if dead:
+        reduced = []
+        for (index, command) in enumerate(result):
+            if index in dead:
+                value = command[3]
+                if pure_command(value):
+                    continue
+                command = value
+            reduced.append(command)
+        result = reduced
+    # merge consecutive property sets on the same pure target
+    merged = []
+    chain_target = chain = None
+    for command in result:
+        if not (command[0] == "set" and pure_command(command[1]) and pure_command(command[2])):
+            chain_target = chain = None
+            merged.append(command)
+            continue
+        [target, name, value] = command[1:]
+        if chain is None or target != chain_target:
+            chain_target = target
+            chain = [(name, value)]
+            merged.append(command)
+            continue
+        for (i, (chain_name, chain_value)) in enumerate(chain):
+            later = [v for (n, v) in chain[i+1:]] + [value]
+            if (chain_name == name and pure_command(chain_value) and
+                all(pure_command(v) and not mentions(v, name) for v in later)):
+                # overwritten before any read
+                del chain[i]
+                break
+        chain.append((name, value))
+        # each set returns its target
+        nested = target
+        for (n, v) in chain:
+            nested = ["set", nested, n, v]
+        merged[-1] = nested
+    result = merged
+    return (result, len(commands) - len(result))
+
+def fragile_slot_written(command):
+    "Return the fragile slot name if command is a top level write to a fragile slot, else None."
+    if command[0] == "set" and command[1] == ["element"] and command[2] in FRAGILE_SLOTS:
+        return command[2]
+    return None
+
+def mentions(command, name):
+    "Return True if any string in the command contains name (which may indicate a read)."
+    ty = type(command)
+    if ty is str:
+        return name in command
+    if ty is list:
+        if command and command[0] == "js_function" and len(command) == 2:
+            # the function text was sent earlier: look up its names by hash
+            names = FUNCTION_NAMES.get(command[1])
+            if names is None:
+                return True  # unknown text may read anything
+            return any(name in n for n in names)
+        return any(mentions(x, name) for x in command)
+    if ty is dict:
+        return any(mentions(x, name) for x in command.values())
+    return False
+
+def pure_command(command):
+    "Return True if evaluating the validated command can have no side effects (ignoring getters)."
+    if type(command) is not list:
+        return True
+    indicator = command[0]
+    if indicator in ("element", "window", "id", "bytes", "buffer"):
+        return True
+    if indicator == "get" or indicator == "list":
+        return all(pure_command(x) for x in command[1:])
+    if indicator == "dict":
+        return all(pure_command(x) for x in command[1].values())
+    if indicator == "ndarray":
+        return pure_command(command[1])
+    return False
+
+def extract_buffers(commands):
+    """
+    Replace binary data in validated commands with ["buffer", index] references.
+    Return the rewritten commands and the list of binary buffers to attach to the message.
+    Command lists without binary content are returned unchanged (not copied).
+    """
+    buffers = []
+    def extract(command):
+        if type(command) is not list or not command:
+            return command
+        indicator = command[0]
+        if indicator == "buffer":
+            buffers.append(command[1])
+            return ["buffer", len(buffers) - 1]
+        if indicator in OPAQUE_INDICATORS:
+            return command
+        if indicator == "dict":
+            d = command[1]
+            extracted = dict((k, extract(v)) for (k, v) in d.items())
+            if any(extracted[k] is not d[k] for k in d):
+                return [indicator, extracted]
+            return command
+        extracted = [extract(x) for x in command]
+        if any(x is not y for (x, y) in zip(extracted, command)):
+            return extracted
+        return command
+    return ([extract(c) for c in commands], buffers)
+
+
+def json_default(value):
+    "Convert values the JSON encoders do not handle natively (numpy scalars and arrays)."
+    if isinstance(value, np.generic):
+        return value.item()
+    if isinstance(value, np.ndarray):
+        return value.tolist()
+    raise TypeError("%r is not JSON serializable" % (value,))
+
+
+class JSONBackend(object):
+    """
+    JSON encoder and decoder used for the message encoding paths.
+    dumps(value) returns compact JSON text and handles numpy scalars; loads(text) parses JSON text.
+    """
+
+    def __init__(self, name, dumps, loads):
+        self.name = name
+        self.dumps = dumps
+        self.loads = loads
+
+
+def stdlib_json_backend():
+    encoder = json.JSONEncoder(separators=(",", ":"), default=json_default)
+    return JSONBackend("json", encoder.encode, json.loads)
+
+def orjson_json_backend():
+    import orjson
+    options = orjson.OPT_SERIALIZE_NUMPY | orjson.OPT_NON_STR_KEYS
+    # orjson rejects deep nesting (like long command chains) and ints wider than 64 bits.
+    fallback = stdlib_json_backend().dumps
+    def dumps(value):
+        try:
+            return orjson.dumps(value, default=json_default, option=options).decode("utf8")
+        except (TypeError, orjson.JSONEncodeError):
+            return fallback(value)
+    return JSONBackend("orjson", dumps, orjson.loads)
+
+JSON_BACKENDS = {
+    "json": stdlib_json_backend,
+    "orjson": orjson_json_backend,
+}
+
+def set_json_backend(backend=None):
+    """
+    Set the module JSON backend by name ("orjson" or "json") or as a JSONBackend instance.
+    By default use the fastest installed backend.
+    """
+    global JSON_BACKEND
+    if backend is None:
+        try:
+            backend = orjson_json_backend()
+        except ImportError:
+            backend = stdlib_json_backend()
+    elif not isinstance(backend, JSONBackend):
+        backend = JSON_BACKENDS[backend]()
+    JSON_BACKEND = backend
+    return backend
+
+JSON_BACKEND = set_json_backend()
+
+# Lists and dicts at most this long (with no larger containers inside) are encoded in one call.
+JSON_ATOM_LENGTH = 64
+# Number of consecutive small list elements encoded in one call.
+JSON_BATCH_LENGTH = 1024
+
+def json_large(value):
+    "Return True if value is a list or dict too large to encode in one piece when streaming."
+    ty = type(value)
+    if ty is list or ty is tuple:
+        return len(value) > JSON_ATOM_LENGTH or any(json_large(x) for x in value)
+    if ty is dict:
+        return len(value) > JSON_ATOM_LENGTH or any(json_large(x) for x in value.values())
+    return False
+
+def json_iterencode(value):
+    """
+    Generate JSON text chunks for value using the JSON backend.
+    Large lists and dicts are streamed while small parts are encoded in batches,
+    so the full JSON text is never held in memory.
+    """
+    if not json_large(value):
+        yield JSON_BACKEND.dumps(value)
+        return
+    dumps = JSON_BACKEND.dumps
+    if type(value) is dict:
+        separator = "{"
+        for (key, item) in value.items():
+            if not isinstance(key, str):
+                key = dumps(key)
+            yield separator + dumps(key) + ":"
+            for chunk in json_iterencode(item):
+                yield chunk
+            separator = ","
+        yield "}"
+        return
+    separator = "["
+    batch = []
+    for item in value:
+        if json_large(item):
+            if batch:
+                yield separator + dumps(batch)[1:-1]
+                separator = ","
+                batch = []
+            yield separator
+            for chunk in json_iterencode(item):
+                yield chunk
+            separator = ","
+        else:
+            batch.append(item)
+            if len(batch) >= JSON_BATCH_LENGTH:
+                yield separator + dumps(batch)[1:-1]
+                separator = ","
+                batch = []
+    if batch:
+        yield separator + dumps(batch)[1:-1]
+    yield "]"
+
+def iter_segments(chunks, size, empty):
+    """
+    Regroup a sequence of string or bytes chunks into segments of the given size.
+    All segments are full except the last, which may be short or empty.
+    Only about one segment of data is held at a time.
+    """
+    pending = []
+    len_pending = 0
+    for chunk in chunks:
+        pending.append(chunk)
+        len_pending += len(chunk)
+        if len_pending > size:
+            data = empty.join(pending)
+            cursor = 0
+            while len_pending - cursor > size:
+                next_cursor = cursor + size
+                yield data[cursor: next_cursor]
+                cursor = next_cursor
+            pending = [data[cursor:]]
+            len_pending -= cursor
+    yield empty.join(pending)
+
+def iter_deflate(text_chunks):
+    "Deflate compress a sequence of unicode text chunks incrementally, generating binary chunks."
+    compressor = zlib.compressobj()
+    for chunk in text_chunks:
+        data = compressor.compress(chunk.encode("utf8"))
+        if data:
+            yield data
+    yield compressor.flush()
+
+def payload_size(payload, buffers=None):
+    "Number of bytes sent for a payload: the JSON text length (counted incrementally) plus buffer sizes."
+    size = sum(len(chunk) for chunk in json_iterencode(payload))
+    for buffer in buffers or ():
+        size += memoryview(buffer).nbytes
+    return size
+
+def call_later(seconds, function):
+    "Call function after a delay on the kernel event loop."
+    ip = IPython.get_ipython()
+    loop = getattr(getattr(ip, "kernel", None), "io_loop", None)
+    if loop is None:
+        from tornado.ioloop import IOLoop
+        loop = IOLoop.current()
+    loop.call_later(seconds, function)
+
+def rate_policy(throttle_ms=None, debounce_ms=None, leading=None, trailing=True, latest_only=False):
+    "Rate limiting options for a proxy callback enforced in the view, or None for no limit."
+    if throttle_ms is None and debounce_ms is None:
+        return None
+    assert throttle_ms is None or debounce_ms is None, "choose throttle_ms or debounce_ms, not both"
+    policy = {"trailing": bool(trailing), "latest_only": bool(latest_only)}
+    if throttle_ms is not None:
+        assert throttle_ms > 0, "throttle_ms must be positive " + repr(throttle_ms)
+        policy["throttle_ms"] = throttle_ms
+    else:
+        assert debounce_ms > 0, "debounce_ms must be positive " + repr(debounce_ms)
+        policy["debounce_ms"] = debounce_ms
+    if leading is not None:
+        policy["leading"] = bool(leading)
+    return policy
+
+def timeout_seconds(timeout):
+    "Convert a timeout in milliseconds to seconds for asyncio.wait_for (None or 0 for no limit)."
+    if not timeout or timeout < 0:
+        return None
+    return timeout / 1000.0
+
+def event_loop():
+    "The asyncio event loop of the kernel, or the current loop outside a kernel."
+    ip = IPython.get_ipython()
+    loop = getattr(getattr(ip, "kernel", None), "io_loop", None)
+    loop = getattr(loop, "asyncio_loop", None)
+    if loop is None:
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            loop = asyncio.get_event_loop()
+    return loop
+
+FRAME_TAG_LENGTH = struct.Struct("<BI")
+FRAME_TAG_INT32 = struct.Struct("<Bi")
+FRAME_TAG_FLOAT64 = struct.Struct("<Bd")
+FRAME_COMMAND_HEAD = struct.Struct("<BBI")
+FRAME_LENGTH = struct.Struct("<I")
+FRAME_INT32_VALUE = struct.Struct("<i")
+FRAME_FLOAT64_VALUE = struct.Struct("<d")
+
+def encode_frame(value):
+    "Encode a validated command payload (with binary data extracted) as a binary command frame."
+    out = bytearray([FRAME_VERSION])
+    pack_tag_length = FRAME_TAG_LENGTH.pack
+    def encode(x):
+        ty = type(x)
+        if ty is str:
+            data = x.encode("utf8")
+            out.extend(pack_tag_length(FRAME_STRING, len(data)))
+            out.extend(data)
+        elif ty is list or ty is tuple:
+            if x and type(x[0]) is str and x[0] in OPCODE:
+                # indicator strings are sent as opcodes
+                out.extend(FRAME_COMMAND_HEAD.pack(FRAME_COMMAND, OPCODE[x[0]], len(x) - 1))
+                for y in x[1:]:
+                    encode(y)
+            else:
+                out.extend(pack_tag_length(FRAME_LIST, len(x)))
+                for y in x:
+                    encode(y)
+        elif ty is int:
+            if -0x80000000 <= x <= 0x7fffffff:
+                out.extend(FRAME_TAG_INT32.pack(FRAME_INT32, x))
+            else:
+                out.extend(FRAME_TAG_FLOAT64.pack(FRAME_FLOAT64, x))
+        elif ty is float:
+            out.extend(FRAME_TAG_FLOAT64.pack(FRAME_FLOAT64, x))
+        elif ty is bool:
+            out.append(FRAME_TRUE if x else FRAME_FALSE)
+        elif x is None:
+            out.append(FRAME_NULL)
+        elif ty is dict:
+            out.extend(pack_tag_length(FRAME_DICT, len(x)))
+            for (key, y) in x.items():
+                data = str(key).encode("utf8")
+                out.extend(FRAME_LENGTH.pack(len(data)))
+                out.extend(data)
+                encode(y)
+        else:
+            # numpy scalars and the like
+            encode(json_default(x))
+    encode(value)
+    return bytes(out)
+
+def decode_frame(frame):
+    "Decode a binary command frame (the inverse of encode_frame)."
+    data = memoryview(frame)
+    assert data[0] == FRAME_VERSION, "unknown frame version " + repr(data[0])
+    cursor = [1]
+    def read(s):
+        result = s.unpack_from(data, cursor[0])[0]
+        cursor[0] += s.size
+        return result
+    def read_string():
+        length = read(FRAME_LENGTH)
+        start = cursor[0]
+        cursor[0] = start + length
+        return str(data[start: start + length], "utf8")
+    def decode():
+        tag = data[cursor[0]]
+        cursor[0] += 1
+        if tag == FRAME_NULL:
+            return None
+        elif tag == FRAME_FALSE or tag == FRAME_TRUE:
+            return tag == FRAME_TRUE
+        elif tag == FRAME_INT32:
+            return read(FRAME_INT32_VALUE)
+        elif tag == FRAME_FLOAT64:
+            return read(FRAME_FLOAT64_VALUE)
+        elif tag == FRAME_STRING:
+            return read_string()
+        elif tag == FRAME_LIST:
+            return [decode() for i in range(read(FRAME_LENGTH))]
+        elif tag == FRAME_DICT:
+            result = {}
+            for i in range(read(FRAME_LENGTH)):
+                key = read_string()
+                result[key] = decode()
+            return result
+        elif tag == FRAME_COMMAND:
+            indicator = OPCODES[data[cursor[0]]]
+            cursor[0] += 1
+            return [indicator] + [decode() for i in range(read(FRAME_LENGTH))]
+        raise ValueError("unknown frame tag " + repr(tag))
+    return decode()
+
+def inflate(chunks):
+    "Decompress the concatenated deflate compressed binary chunks to unicode text."
+    data = b"".join(bytes(chunk) for chunk in chunks)
+    return zlib.decompress(data).decode("utf8")
+
+def restore_buffers(value, buffers):
+    """
+    Replace binary buffer placeholders in a value sent from javascript
+    with numpy arrays (for typed arrays) or memoryviews (for ArrayBuffers and DataViews)
+    which share memory with the message buffers.
+    """
+    def restore(x):
+        ty = type(x)
+        if ty is list:
+            return [restore(y) for y in x]
+        if ty is dict:
+            reference = x.get(BUFFER_REFERENCE)
+            if reference is not None and len(x) == 1:
+                return buffer_value(reference, buffers)
+            return dict((k, restore(v)) for (k, v) in x.items())
+        return x
+    return restore(value)
+
+def buffer_value(reference, buffers):
+    "Convert a [index, dtype_name, shape] buffer placeholder to a numpy array or memoryview."
+    [index, dtype_name, shape] = reference
+    data = memoryview(buffers[index])
+    if dtype_name is None:
+        return data
+    result = np.frombuffer(data, dtype=np.dtype(dtype_name).newbyteorder("<"))
+    if shape:
+        result = result.reshape(shape)
+    return result
+
+
+class SymbolTable(object):
+    """
+    Session symbol table for the compact command encoding.
+
+    Indicators are replaced by OPCODES indices.  Method and attribute names and
+    pure target paths (like ["get", ["element"], "_FRAGILE_THIS"]) are sent once as
+    [OP_SYMBOL, id, value] definitions and afterwards as [OP_SYMBOL, id] references.
+    The javascript model keeps the matching table for the session.
+    """
+
+    def __init__(self, limit=SYMBOL_TABLE_LIMIT):
+        self.limit = limit
+        # batches are tagged with the generation, which changes when the table is reset
+        self.generation = 0
+        self.reset()
+
+    def reset(self):
+        self.ids = {}
+        self.generation += 1
+
+    def intern(self, key, encode_value):
+        "Return a reference to the symbol for key, defining it with encode_value() if needed."
+        ids = self.ids
+        symbol_id = ids.get(key)
+        if symbol_id is not None:
+            return [OP_SYMBOL, symbol_id]
+        value = encode_value()
+        if len(ids) >= self.limit:
+            return value
+        symbol_id = ids[key] = len(ids)
+        return [OP_SYMBOL, symbol_id, value]
+
+    def encode_commands(self, commands):
+        return [self.encode(c) for c in commands]
+
+    def encode(self, command):
+        "Encode a validated command (with binary data already extracted) in compact form."
+        if type(command) is not list:
+            return command
+        encode = self.encode
+        indicator = command[0]
+        code = OPCODE[indicator]
+        if indicator == "method":
+            return ([code, self.encode_target(command[1]), self.encode_name(command[2])] +
+                [encode(x) for x in command[3:]])
+        elif indicator == "get":
+            return [code, self.encode_target(command[1]), self.encode_name(command[2])]
+        elif indicator == "set":
+            return [code, self.encode_target(command[1]), self.encode_name(command[2]), encode(command[3])]
+        elif indicator in ("function", "list", "null"):
+            return [code] + [encode(x) for x in command[1:]]
+        elif indicator == "dict":
+            return [code, dict((k, encode(v)) for (k, v) in command[1].items())]
+        elif indicator == "ndarray":
+            return [code, encode(command[1])] + command[2:]
+        elif indicator == "define":
+            return [code, command[1], command[2], encode(command[3])]
+        elif indicator == "invoke":
+            return [code, command[1]] + [encode(x) for x in command[2:]]
+        elif indicator == "reply":
+            return [code, command[1], encode(command[2]), command[3]]
+        # other commands have no command arguments
+        return [code] + command[1:]
+
+    def encode_name(self, name):
+        if type(name) is str:
+            return self.intern(name, lambda: name)
+        return name
+
+    def encode_target(self, target):
+        key = path_key(target)
+        if key is None or len(key) < 2:
+            # bare element and window opcodes are shorter than symbol references
+            return self.encode(target)
+        return self.intern(key, lambda: self.encode(target))
+
+
+def path_key(command):
+    """
+    Return a hashable key for a pure target path made of element, window and
+    get commands with string names, or None for other commands.
+    """
+    if type(command) is not list:
+        return None
+    indicator = command[0]
+    if indicator == "get":
+        name = command[2]
+        if type(name) is not str:
+            return None
+        prefix = path_key(command[1])
+        if prefix is None:
+            return None
+        return prefix + (name,)
+    if indicator == "element" or indicator == "window":
+        return (indicator,)
+    return None
+
+
 class InvalidCommand(Exception):
     "Invalid command"
 
@@ -1557,15 +3265,15 @@ def debug_check_commands(command):
 
 
 def clean_dict(**kwargs):
-    "Like dict but with no None values and make some values JSON serializable."
+    """
+    Like dict but with no None values and make some values JSON serializable.
+    Numpy arrays are kept so they can be sent as binary typed arrays.
+    """
     # This function is generally useful for passing information to proxy widgets
     result = {}
     for kw in kwargs:
         v = kwargs[kw]
         if v is not None:
-            if isinstance(v, np.ndarray):
-                # listiffy arrays -- maybe should be done elsewhere
-                v = v.tolist()
             if isinstance(v, np.floating):
                 v = float(v)
             if type(v) is tuple:
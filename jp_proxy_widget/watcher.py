@@ -6,6 +6,7 @@ In Jupyter lab list changed files inline.
 
 import os
 import jp_proxy_widget
+from jp_proxy_widget import js_context
 import time
 import sys
 from IPython.display import display
@@ -99,7 +100,6 @@ class FileWatcherWidget(jp_proxy_widget.JSProxyWidget):
                 
     def watch_javascript(self):
         self.check_javascript = True
-        from jp_proxy_widget import js_context
         for path in js_context.LOADED_FILES:
             if os.path.isfile(path):
                 self.add(path)
@@ -129,6 +129,7 @@ class FileWatcherWidget(jp_proxy_widget.JSProxyWidget):
             mod = os.path.getmtime(path)
             if mod > lastmod:
                 result = "Watch file has been modified: " + repr(path)
+                js_context.invalidate_file_cache(path)
             self.paths_to_modification_times[path] = mod
         for folder in self.folder_paths:
             for filename in os.listdir(folder):
@@ -26,14 +26,48 @@ var JSProxyModel = widgets.DOMWidgetModel.extend({
         _view_name : 'JSProxyView',
         _model_module : 'jp_proxy_widget',
         _view_module : 'jp_proxy_widget',
-        _model_module_version : '1.0.10',
-        _view_module_version : '1.0.10',
-    })
+        _model_module_version : '1.0.11',
+        _view_module_version : '1.0.11',
+        compress_threshold : 0,
+    }),
+
+    initialize: function(attributes, options) {
+        widgets.DOMWidgetModel.prototype.initialize.apply(this, arguments);
+        // Session symbol table for compact commands, shared by all views of the model,
+        // with the kernel side table generation it matches.
+        this.symbol_table = {};
+        this.symbol_generation = null;
+        // Batches of this generation or older wait for the kernel to resend them.
+        this.stale_symbol_generation = 0;
+        // Tell the kernel side to forget state shared with any previous model (after page reloads).
+        if (this.comm) {
+            this.send({indicator: "session_reset", payload: null}, {});
+        }
+    }
 });
 
 //var loader_defined = false;
 var JSProxyLoad = "JSProxyLoad";
 
+// Functions compiled from js_init bodies, by content hash, shared by all views in the page.
+var compiled_functions = {};
+
+// Thrown when a command refers to a function or template definition the view does not have.
+function MissingDefinition(kind, key) {
+    this.kind = kind;
+    this.key = key;
+}
+
+// Asset texts by content hash, and callbacks waiting for texts requested from the kernel.
+var assets_by_hash = {};
+var asset_waiters = {};
+var ASSET_DB_NAME = "jp_proxy_widget_assets";
+var asset_db_promise = null;
+
+// Style nodes created for loaded css by name, and [names, action] waiting for javascript loads.
+var css_nodes_by_name = {};
+var js_load_listeners = [];
+
 // Custom View. Renders the widget model.
 var JSProxyView = widgets.DOMWidgetView.extend({
 
@@ -43,6 +77,13 @@ var JSProxyView = widgets.DOMWidgetView.extend({
         this.el.textContent = "Uninitialized Proxy Widget";
 
         that._json_accumulator = [];
+        that._binary_accumulator = [];
+        // Compiled prepared command templates by identifier.  Templates refer to this view
+        // (the element, callbacks, errors) so each view of the model compiles its own.
+        that.templates = {};
+        // Resolvers waiting for definitions requested from the kernel, and definitions it does not have.
+        that.definition_waiters = {};
+        that.unknown_definitions = {};
 
         that.on("displayed", function() {
             that.update();
@@ -109,33 +150,23 @@ var JSProxyView = widgets.DOMWidgetView.extend({
         };
 
         // execute action when vanilla javascript modules have been loaded
-        //  xxxx this duplicates logic in load_js_command below?
+        // (delay is no longer used: loads notify waiting listeners on completion)
         that.$$el.when_loaded = function(names, action, failure, delay, limit) {
-            if (!delay) {
-                delay = 10;
-            }
             if (!limit) {
                 limit = 1000;
             }
-            var counter = 0;
-            var attempt_action = function () {
-                counter += delay;
-                // test for load silently.
-                if (that.$$el.test_js_loaded(names, null, null, true)) {
-                    return action();
-                }
-                // otherwise try again later, maybe
-                if (counter < limit) {
-                    return setTimeout(attempt_action, delay);
+            // test for load silently.
+            var test = function() {
+                return that.$$el.test_js_loaded(names, null, null, true);
+            };
+            var timed_out = function() {
+                if (failure) {
+                    return failure();
                 } else {
-                    if (failure) {
-                        return failure();
-                    } else {
-                        that.set_error_msg("when loaded timed out waiting for " + names);
-                    }
+                    that.set_error_msg("when loaded timed out waiting for " + names);
                 }
-            }
-            attempt_action();
+            };
+            return that.wait_for_js_load(test, action, timed_out, limit);
         };
 
         that.$el.set_error_msg = function(msg) {
@@ -276,6 +307,18 @@ var JSProxyView = widgets.DOMWidgetView.extend({
     COMMANDS: "commands",
     COMMANDS_FRAGMENT: "cm_fragment",
     COMMANDS_FINAL: "cm_final",
+    EVALUATE_RESULT: "evaluate_result",
+    ASSET_REQUEST: "asset_request",
+    ASSET_TEXT: "asset_text",
+    SYMBOL_RESEND: "symbol_resend",
+    DEFINITION_REQUEST: "definition_request",
+    DEFINITION_TEXT: "definition_text",
+    BUFFER_REFERENCE: "__jp_proxy_buffer__",
+    COMPRESSION: "compression",
+    DEFLATE: "deflate",
+    FORMAT: "format",
+    BINARY_FORMAT: "binary",
+    JSON_TEXT_FORMAT: "json_text",
 
     update: function(options) {
         // do nothing.
@@ -284,7 +327,7 @@ var JSProxyView = widgets.DOMWidgetView.extend({
         //return that.execute_commands(commands);
     },
 
-    execute_commands: function(commands) {
+    execute_commands: function(commands, buffers) {
         // cl("execute_commands " + commands.length);
         var that = this;
         var results = [];
@@ -293,9 +336,18 @@ var JSProxyView = widgets.DOMWidgetView.extend({
             // cl("command_counter=" + command_counter)
             var command_list = commands[1];
             var level = commands[2];
+            var options = commands[3] || {};
             level = that.check_level(level);
+            if (options.symbols) {
+                command_list = that.decode_symbol_commands(command_counter, command_list, options.symbols);
+                if (!command_list) {
+                    // the kernel resends the batch encoded for a new table.
+                    return results;
+                }
+            }
+            var wanted = that.result_selection(options.results);
             // resume command execution at the beginning...
-            return that.resume_execute_commands(results, command_list, command_counter, level, 0);
+            return that.resume_execute_commands(results, command_list, command_counter, level, 0, buffers, wanted);
             /*
             try {
                 _.each(command_list, function(command,i) {
@@ -311,15 +363,60 @@ var JSProxyView = widgets.DOMWidgetView.extend({
         } else {
             results.push("no commands sent?");
         }
-        //that.send_custom_message(that.RESULTS, [command_counter, results])
-        // disable sending results for now (not used)
         that.send_custom_message(that.RESULTS, [command_counter, true])
         return results;
     },
 
-    resume_execute_commands: function(results, command_list, command_counter, level, index) {
+    decode_symbol_commands: function(command_counter, command_list, generation) {
+        // Decode compact commands, or return null and ask the kernel to resend them
+        // if they were encoded against a table this model does not have (after a page reload).
+        var that = this;
+        var model = that.model;
+        if (generation <= model.stale_symbol_generation) {
+            // batches following a stale batch wait for the resend to keep their order.
+            return null;
+        }
+        if (generation != model.symbol_generation) {
+            // a new kernel side table generation starts with definitions
+            model.symbol_table = {};
+            model.symbol_generation = generation;
+        }
+        try {
+            return command_list.map(that.decode_command, that);
+        } catch (err) {
+            model.stale_symbol_generation = generation;
+            that.send_custom_message(that.SYMBOL_RESEND, [command_counter, generation]);
+            return null;
+        }
+    },
+
+    result_selection: function(requested) {
+        // Which command results to return for a batch: null for an acknowledgement only.
+        if (!requested) {
+            return null;
+        }
+        var wanted = {all: (requested === true), indices: {}, buffers: []};
+        if (!wanted.all) {
+            for (var i=0; i<requested.length; i++) {
+                wanted.indices[requested[i]] = true;
+            }
+        }
+        return wanted;
+    },
+
+    batch_result: function(wanted, index, result, level) {
+        // json_safe translation for selected results, null for others.
+        if (wanted && (wanted.all || wanted.indices[index])) {
+            return this.json_safe(result, level, wanted.buffers);
+        }
+        return null;
+    },
+
+    resume_execute_commands: function(results, command_list, command_counter, level, index, buffers, wanted) {
         // resume command execution starting at index
         var that = this;
+        // binary message buffers referenced by ["buffer", index] commands in this batch
+        that.message_buffers = buffers || [];
         var evaluator = null;
         var evaluation_index = index;
         var command = null;
@@ -335,9 +432,7 @@ var JSProxyView = widgets.DOMWidgetView.extend({
                     break;
                 } else {
                     // store result now and proceed
-                    //results[i] = that.json_safe(result, level);
-                    // disable return results for now.
-                    results[i] = true;
+                    results[i] = that.batch_result(wanted, i, result, level);
                 }
             }
             if (evaluator) {
@@ -345,56 +440,407 @@ var JSProxyView = widgets.DOMWidgetView.extend({
                 // evaluate at evaluation_index async and resume later
                 var resolver = function(value_for_command) {
                     // store the calculated result
-                    results[evaluation_index] = value_for_command;
+                    results[evaluation_index] = that.batch_result(wanted, evaluation_index, value_for_command, level);
                     // continue evaluating any remaining commands, starting at the next command
                     return that.resume_execute_commands(results, command_list, command_counter, level,
-                        evaluation_index+1)
+                        evaluation_index+1, buffers, wanted)
                 };
                 // call the async evaluator
                 evaluator(resolver);
             } else {
                 // evaluation complete: send results
                 // cl(command_counter + " execute commands done " + results.length);
-                //that.send_custom_message(that.RESULTS, [command_counter, results])
-                // disable sending results for now (not used)
-                that.send_custom_message(that.RESULTS, [command_counter, true]) 
+                // only batches that requested results send them back
+                if (wanted) {
+                    that.send_custom_message(that.RESULTS, [command_counter, results], wanted.buffers);
+                } else {
+                    that.send_custom_message(that.RESULTS, [command_counter, true]);
+                }
                 return results
             }
         } catch (err) {
+            if (err instanceof MissingDefinition) {
+                // This view missed the batch with the definition (it rendered later):
+                // get it from the kernel and retry the command.
+                return that.request_definition(err.kind, err.key).then(function() {
+                    return that.resume_execute_commands(results, command_list, command_counter, level,
+                        evaluation_index, buffers, wanted);
+                });
+            }
             var msg = "" + err;
             results.push(msg);
             that.set_error_msg(msg);
+            // acknowledge the failed batch so the kernel side flow control can proceed
+            that.send_custom_message(that.RESULTS, [command_counter, false]);
         }
     },
 
-    send_custom_message: function(indicator, payload) {
+    send_custom_message: function(indicator, payload, buffers, compression) {
+        // Send the message now unless an asynchronous send is in progress, otherwise after it.
         var that = this;
-        message = {};
+        if (that._send_chain) {
+            that.queue_send(function() {
+                that.send_message_now(indicator, payload, buffers, compression);
+            });
+        } else {
+            that.send_message_now(indicator, payload, buffers, compression);
+        }
+    },
+
+    send_message_now: function(indicator, payload, buffers, compression) {
+        var that = this;
+        var message = {};
         message[that.INDICATOR] = indicator;
         message[that.PAYLOAD] = payload;
-        that.model.send(message)
+        if (compression) {
+            message[that.COMPRESSION] = compression;
+        }
+        that.model.send(message, {}, buffers);
+    },
+
+    queue_send: function(action) {
+        // Chain a (possibly asynchronous) send action so later messages are sent after it.
+        var that = this;
+        var previous = that._send_chain || Promise.resolve();
+        var current = previous.then(action).catch(function(err) {
+            that.set_error_msg("send failed: " + err);
+        });
+        that._send_chain = current;
+        current.then(function() {
+            if (that._send_chain === current) {
+                that._send_chain = null;
+            }
+        });
     },
 
     handle_custom_message: function(content, buffers, widget) {
+        // Messages are handled in arrival order: while an asynchronous step (like
+        // inflating compressed data) is in progress later messages wait in a queue.
+        var that = this;
+        if (content[that.INDICATOR] == that.DEFINITION_TEXT) {
+            // answers a request from the batch holding up the queue.
+            return that.definition_arrived(content[that.PAYLOAD], buffers);
+        }
+        if (that._message_queue) {
+            that._message_queue.push([content, buffers]);
+            return;
+        }
+        var pending = that.dispatch_custom_message(content, buffers);
+        if (pending) {
+            that._message_queue = [];
+            var drain = function() {
+                while (that._message_queue.length > 0) {
+                    var next = that._message_queue.shift();
+                    var next_pending = that.dispatch_custom_message(next[0], next[1]);
+                    if (next_pending) {
+                        return next_pending.then(drain, drain);
+                    }
+                }
+                that._message_queue = null;
+            };
+            pending.then(drain, drain);
+        }
+    },
+
+    dispatch_custom_message: function(content, buffers) {
+        // Handle one message.  Return a promise if handling completes asynchronously.
         var that = this;
         var indicator = content[that.INDICATOR];
         var payload = content[that.PAYLOAD];
+        var compressed = content[that.COMPRESSION];
+        var binary = (content[that.FORMAT] == that.BINARY_FORMAT);
+        // UTF-8 JSON text in the buffers (batches encoded ahead for flow control)
+        var json_text = (content[that.FORMAT] == that.JSON_TEXT_FORMAT);
         if (indicator == that.COMMANDS) {
             that._json_accumulator = [];
-            that.execute_commands(payload);
+            return that.commands_pending(that.execute_commands(payload, buffers));
         } else if (indicator == that.COMMANDS_FRAGMENT) {
-            that._json_accumulator.push(payload);
+            if (compressed || binary || json_text) {
+                that._binary_accumulator.push(buffers[0]);
+            } else {
+                that._json_accumulator.push(payload);
+            }
         } else if (indicator == that.COMMANDS_FINAL) {
+            if (compressed || binary || json_text) {
+                // the first buffer is the last binary fragment: the others are data buffers.
+                var chunks = that._binary_accumulator;
+                that._binary_accumulator = [];
+                chunks.push(buffers[0]);
+                var data_buffers = buffers.slice(1);
+                if (!compressed) {
+                    var bytes = that.concatenate_buffers(chunks);
+                    var frame = json_text ? JSON.parse(new TextDecoder().decode(bytes)) : that.decode_frame(bytes);
+                    return that.commands_pending(that.execute_commands(frame, data_buffers));
+                }
+                var inflated = binary ? that.inflate_binary(chunks) : that.inflate(chunks);
+                return inflated.then(function(data) {
+                    var commands = binary ? that.decode_frame(data) : JSON.parse(data);
+                    return that.execute_commands(commands, data_buffers);
+                }).catch(function(err) {
+                    that.set_error_msg("failed to inflate commands: " + err);
+                });
+            }
             var acc = that._json_accumulator;
             that._json_accumulator = [];
             acc.push(payload);
             var json_str = acc.join("");
             var commands = JSON.parse(json_str);
-            that.execute_commands(commands);
+            return that.commands_pending(that.execute_commands(commands, buffers));
+        } else if (indicator == that.ASSET_TEXT) {
+            for (var key in payload) {
+                that.asset_arrived(key, payload[key]);
+            }
         } else {
             var msg = "invalid custom message indicator " + indicator;
             that.set_error_msg(msg);
         }
+        return null;
+    },
+
+    commands_pending: function(value) {
+        // The promise of a batch waiting for a definition from the kernel, or null.
+        return (value instanceof Promise) ? value : null;
+    },
+
+    missing_definition: function(kind, key) {
+        // Ask for a definition this view does not have, unless the kernel does not know it either.
+        var that = this;
+        if (that.unknown_definitions[kind + " " + key]) {
+            var msg = "undefined " + kind + " " + key;
+            that.set_error_msg(msg);
+            return msg;
+        }
+        throw new MissingDefinition(kind, key);
+    },
+
+    request_definition: function(kind, key) {
+        // Promise the arrival of a definition requested from the kernel.
+        var that = this;
+        var name = kind + " " + key;
+        return new Promise(function(resolve) {
+            var waiting = that.definition_waiters[name];
+            if (waiting) {
+                waiting.push(resolve);
+            } else {
+                that.definition_waiters[name] = [resolve];
+                that.send_custom_message(that.DEFINITION_REQUEST, [kind, key]);
+            }
+        });
+    },
+
+    definition_arrived: function(payload, buffers) {
+        // Install a definition this view requested (all views of the model get the reply).
+        var that = this;
+        var kind = payload[0];
+        var key = payload[1];
+        var definition = payload[2];
+        var name = kind + " " + key;
+        var waiting = that.definition_waiters[name];
+        if (!waiting) {
+            return;
+        }
+        delete that.definition_waiters[name];
+        try {
+            if (definition === null) {
+                that.unknown_definitions[name] = true;
+            } else if (kind == "template") {
+                that.message_buffers = buffers || [];
+                that.templates[key] = that.compile_template(definition[0], definition[1]);
+            } else {
+                compiled_functions[key] = Function.apply(null, definition[0].concat([definition[1]]));
+            }
+        } catch (err) {
+            that.unknown_definitions[name] = true;
+            that.set_error_msg("bad " + name + ": " + err);
+        }
+        waiting.forEach(function(resolve) { resolve(); });
+    },
+
+    inflate: function(chunks) {
+        // Promise the text for deflate (zlib format) compressed binary chunks.
+        var stream = new Blob(chunks).stream().pipeThrough(new DecompressionStream("deflate"));
+        return new Response(stream).text();
+    },
+
+    inflate_binary: function(chunks) {
+        // Promise an ArrayBuffer for deflate (zlib format) compressed binary chunks.
+        var stream = new Blob(chunks).stream().pipeThrough(new DecompressionStream("deflate"));
+        return new Response(stream).arrayBuffer();
+    },
+
+    concatenate_buffers: function(chunks) {
+        // Uint8Array of the concatenated binary chunks (no copy for a single chunk).
+        var that = this;
+        if (chunks.length == 1) {
+            return that.buffer_view(chunks[0]);
+        }
+        var views = chunks.map(that.buffer_view);
+        var length = 0;
+        views.forEach(function(view) { length += view.byteLength; });
+        var result = new Uint8Array(length);
+        var cursor = 0;
+        views.forEach(function(view) {
+            result.set(view, cursor);
+            cursor += view.byteLength;
+        });
+        return result;
+    },
+
+    // Binary command frame tags.  These must match the FRAME_* constants in proxy_widget.py.
+    FRAME_VERSION: 1,
+    FRAME_NULL: 0,
+    FRAME_FALSE: 1,
+    FRAME_TRUE: 2,
+    FRAME_INT32: 3,
+    FRAME_FLOAT64: 4,
+    FRAME_STRING: 5,
+    FRAME_LIST: 6,
+    FRAME_DICT: 7,
+    FRAME_COMMAND: 8,
+
+    decode_frame: function(buffer) {
+        // Decode a binary command frame to the JSON command payload form.
+        var that = this;
+        var bytes = that.buffer_view(buffer);
+        var view = new DataView(bytes.buffer, bytes.byteOffset, bytes.byteLength);
+        var decoder = new TextDecoder();
+        if (view.getUint8(0) != that.FRAME_VERSION) {
+            throw "unknown command frame version " + view.getUint8(0);
+        }
+        var cursor = 1;
+        var read_length = function() {
+            var length = view.getUint32(cursor, true);
+            cursor += 4;
+            return length;
+        };
+        var read_string = function() {
+            var length = read_length();
+            var start = cursor;
+            cursor += length;
+            return decoder.decode(bytes.subarray(start, cursor));
+        };
+        var decode = function() {
+            var tag = view.getUint8(cursor);
+            cursor += 1;
+            var result, length, i;
+            switch (tag) {
+                case that.FRAME_NULL:
+                    return null;
+                case that.FRAME_FALSE:
+                    return false;
+                case that.FRAME_TRUE:
+                    return true;
+                case that.FRAME_INT32:
+                    result = view.getInt32(cursor, true);
+                    cursor += 4;
+                    return result;
+                case that.FRAME_FLOAT64:
+                    result = view.getFloat64(cursor, true);
+                    cursor += 8;
+                    return result;
+                case that.FRAME_STRING:
+                    return read_string();
+                case that.FRAME_LIST:
+                    length = read_length();
+                    result = new Array(length);
+                    for (i=0; i<length; i++) {
+                        result[i] = decode();
+                    }
+                    return result;
+                case that.FRAME_DICT:
+                    length = read_length();
+                    result = {};
+                    for (i=0; i<length; i++) {
+                        var key = read_string();
+                        result[key] = decode();
+                    }
+                    return result;
+                case that.FRAME_COMMAND:
+                    var indicator = that.OPCODES[view.getUint8(cursor)];
+                    cursor += 1;
+                    length = read_length();
+                    result = new Array(length + 1);
+                    result[0] = indicator;
+                    for (i=1; i<=length; i++) {
+                        result[i] = decode();
+                    }
+                    return result;
+            }
+            throw "unknown command frame tag " + tag;
+        };
+        return decode();
+    },
+
+    deflate: function(text) {
+        // Promise a Uint8Array of the deflate (zlib format) compressed text.
+        var stream = new Blob([text]).stream().pipeThrough(new CompressionStream("deflate"));
+        return new Response(stream).arrayBuffer().then(function(buffer) {
+            return new Uint8Array(buffer);
+        });
+    },
+
+    // Compact command encoding: indicator for each opcode.
+    // This list must match OPCODES in proxy_widget.py.
+    OPCODES: [
+        "element", "window", "method", "function", "id", "list", "dict", "callback",
+        "get", "set", "null", "load_css", "load_js", "bytes", "buffer", "ndarray", "symbol",
+        "param", "define", "invoke", "js_function", "load_asset", "reply",
+    ],
+    OP_SYMBOL: 16,
+
+    decode_command: function(command) {
+        // Convert a compact command to the standard form, maintaining the model symbol table.
+        var that = this;
+        if (!Array.isArray(command)) {
+            return command;
+        }
+        var code = command[0];
+        if (code == that.OP_SYMBOL) {
+            var table = that.model.symbol_table;
+            var symbol_id = command[1];
+            if (command.length > 2) {
+                table[symbol_id] = that.decode_command(command[2]);
+            } else if (!(symbol_id in table)) {
+                throw "undefined symbol " + symbol_id;
+            }
+            return table[symbol_id];
+        }
+        var indicator = that.OPCODES[code];
+        var decode = function(x) { return that.decode_command(x); };
+        var decode_name = function(name) {
+            if (Array.isArray(name) && (name[0] == that.OP_SYMBOL)) {
+                return that.decode_command(name);
+            }
+            return name;
+        };
+        if (indicator == "method") {
+            return [indicator, decode(command[1]), decode_name(command[2])].concat(command.slice(3).map(decode));
+        } else if (indicator == "get") {
+            return [indicator, decode(command[1]), decode_name(command[2])];
+        } else if (indicator == "set") {
+            return [indicator, decode(command[1]), decode_name(command[2]), decode(command[3])];
+        } else if ((indicator == "function") || (indicator == "list") || (indicator == "null")) {
+            return [indicator].concat(command.slice(1).map(decode));
+        } else if (indicator == "dict") {
+            var desc = command[1];
+            var result = {};
+            for (var key in desc) {
+                result[key] = decode(desc[key]);
+            }
+            return [indicator, result];
+        } else if (indicator == "ndarray") {
+            return [indicator, decode(command[1])].concat(command.slice(2));
+        } else if (indicator == "define") {
+            return [indicator, command[1], command[2], decode(command[3])];
+        } else if (indicator == "invoke") {
+            return [indicator, command[1]].concat(command.slice(2).map(decode));
+        } else if (indicator == "reply") {
+            return [indicator, command[1], decode(command[2]), command[3]];
+        } else if (indicator) {
+            // other commands have no command arguments
+            return [indicator].concat(command.slice(1));
+        }
+        throw "unknown opcode " + code;
     },
 
     execute_command_result: function(command) {
@@ -459,9 +905,14 @@ var JSProxyView = widgets.DOMWidgetView.extend({
                 var data = remainder.shift();
                 var level = remainder.shift();
                 var segmented = remainder.shift();
+                // optional rate limiting policy
+                var policy = null;
+                if (remainder.length > 0) {
+                    policy = that.execute_command_result(remainder.shift());
+                }
                 // sanity check
                 level = that.check_level(level);
-                result = that.callback_factory(identifier, data, level, segmented);
+                result = that.callback_factory(identifier, data, level, segmented, policy);
             } else if (indicator == "get") {
                 var target_desc = remainder.shift();
                 var target = that.execute_command_result(target_desc);
@@ -494,9 +945,55 @@ var JSProxyView = widgets.DOMWidgetView.extend({
                 js_name = remainder.shift();
                 js_text = remainder.shift();
                 evaluator = that.load_js_async(js_name, js_text);
+            } else if (indicator == "reply") {
+                // evaluate and answer the kernel immediately
+                var request_id = remainder[0];
+                var reply_level = that.check_level(remainder[2]);
+                var reply_buffers = [];
+                try {
+                    result = that.execute_command_result(remainder[1]);
+                    var reply = [request_id, that.json_safe(result, reply_level, reply_buffers), null];
+                    that.send_custom_message(that.EVALUATE_RESULT, reply, reply_buffers);
+                } catch (err) {
+                    if (err instanceof MissingDefinition) {
+                        throw err;
+                    }
+                    result = "evaluation failed: " + err;
+                    that.set_error_msg(result);
+                    that.send_custom_message(that.EVALUATE_RESULT, [request_id, null, result]);
+                }
+            } else if (indicator == "load_asset") {
+                result = "load_asset_async";
+                evaluator = that.load_asset_async(remainder[0], remainder[1], remainder[2], remainder[3]);
+            } else if (indicator == "ndarray") {
+                var bytes = that.execute_command_result(remainder[0]);
+                result = that.typed_array(bytes, remainder[1], remainder[2]);
+            } else if (indicator == "buffer") {
+                result = that.buffer_view(that.message_buffers[remainder[0]]);
             } else if (indicator == "bytes") {
                 var hexstr = remainder[0];
                 result = that.from_hex(hexstr);
+            } else if (indicator == "define") {
+                result = remainder[0];
+                that.templates[result] = that.compile_template(remainder[1], remainder[2]);
+            } else if (indicator == "invoke") {
+                var template = that.templates[remainder.shift()];
+                if (template) {
+                    result = template(remainder.map(that.execute_command_result, that));
+                } else {
+                    result = that.missing_definition("template", command[1]);
+                }
+            } else if (indicator == "js_function") {
+                var key = remainder[0];
+                result = compiled_functions[key];
+                if (!result) {
+                    if (remainder.length > 1) {
+                        result = Function.apply(null, remainder[1].concat([remainder[2]]));
+                        compiled_functions[key] = result;
+                    } else {
+                        result = that.missing_definition("function", key);
+                    }
+                }
             } else {
                 var msg = "Unknown command indicator " + indicator;
                 result = msg;
@@ -507,6 +1004,106 @@ var JSProxyView = widgets.DOMWidgetView.extend({
         return {result: result, evaluator: evaluator};
     },
 
+    compile_template: function(parameters, template) {
+        // Compile a prepared command template to a function(args) executing it for argument values
+        // in parameter order in this view.  Constant leaves (ids, callbacks, binary data) are evaluated once.
+        var that = this;
+        var positions = {};
+        parameters.forEach(function(name, i) { positions[name] = i; });
+        var values = function(functions, args) {
+            var n = functions.length;
+            var result = new Array(n);
+            for (var i=0; i<n; i++) {
+                result[i] = functions[i](args);
+            }
+            return result;
+        };
+        var compile = function(command) {
+            if (!Array.isArray(command)) {
+                return function() { return command; };
+            }
+            var indicator = command[0];
+            var target, name, value, functions;
+            if (indicator == "param") {
+                var position = positions[command[1]];
+                if (position === undefined) {
+                    throw "unknown template parameter " + command[1];
+                }
+                return function(args) { return args[position]; };
+            } else if (indicator == "element") {
+                return function() { return that.$$el; };
+            } else if (indicator == "window") {
+                return function() { return window; };
+            } else if (indicator == "method") {
+                target = compile(command[1]);
+                name = command[2];
+                functions = command.slice(3).map(compile);
+                return function(args) {
+                    var target_value = target(args);
+                    var method = target_value[name];
+                    if (!method) {
+                        var msg = "In " + target_value + " no such method " + name;
+                        that.set_error_msg(msg);
+                        return msg;
+                    }
+                    return method.apply(target_value, values(functions, args));
+                };
+            } else if (indicator == "function") {
+                target = compile(command[1]);
+                functions = command.slice(2).map(compile);
+                return function(args) {
+                    return target(args).apply(that, values(functions, args));
+                };
+            } else if (indicator == "list") {
+                functions = command.slice(1).map(compile);
+                return function(args) { return values(functions, args); };
+            } else if (indicator == "dict") {
+                var keys = Object.keys(command[1]);
+                functions = keys.map(function(key) { return compile(command[1][key]); });
+                return function(args) {
+                    var result = {};
+                    for (var i=0; i<keys.length; i++) {
+                        result[keys[i]] = functions[i](args);
+                    }
+                    return result;
+                };
+            } else if (indicator == "get") {
+                target = compile(command[1]);
+                name = compile(command[2]);
+                return function(args) { return target(args)[name(args)]; };
+            } else if (indicator == "set") {
+                target = compile(command[1]);
+                name = compile(command[2]);
+                value = compile(command[3]);
+                return function(args) {
+                    var target_value = target(args);
+                    target_value[name(args)] = value(args);
+                    return target_value;
+                };
+            } else if (indicator == "null") {
+                target = compile(command[1]);
+                return function(args) {
+                    target(args);
+                    return null;
+                };
+            } else if (indicator == "invoke") {
+                var identifier = command[1];
+                functions = command.slice(2).map(compile);
+                return function(args) {
+                    var template = that.templates[identifier];
+                    if (!template) {
+                        return that.missing_definition("template", identifier);
+                    }
+                    return template(values(functions, args));
+                };
+            }
+            // other commands have constant values
+            var constant = that.execute_command_result(command);
+            return function() { return constant; };
+        };
+        return compile(template);
+    },
+
     load_css_async: function(css_name, css_text) {
         // Return a function evaluator(resolver)
         // which promises to load the css_text and call the
@@ -514,46 +1111,57 @@ var JSProxyView = widgets.DOMWidgetView.extend({
         var that = this;
         var evaluator = function(resolver) {
             // if the sheet already exists, just succeed
-            if (that.sheet_name_exists(css_name)) {
+            var existing = css_nodes_by_name[css_name];
+            if ((existing && existing.isConnected) || that.sheet_name_exists(css_name)) {
                 return resolver(css_name);
             }
             // otherwise create the style and wait for stylesheet
-            that.$$el.jQuery("<style>")
+            var node = that.$$el.jQuery("<style>")
             .prop("type", "text/css")
             //.prop("title", css_name)
             .prop("href", css_name)
             .attr("data-jp-proxy-widget-node","1")
             .html("\n"+css_text)
-            .appendTo("head");
-            // loop a while waiting for the stylesheet to appear.
-            var done_test = function() {
-                return that.sheet_name_exists(css_name);
+            .appendTo("head")[0];
+            css_nodes_by_name[css_name] = node;
+            // inline styles are usually parsed on insertion: otherwise wait for the load event.
+            if (!node || node.sheet) {
+                return resolver(css_name);
+            }
+            node.onload = function() {
+                resolver(css_name);
+            };
+            node.onerror = function() {
+                var message = "failed to load stylesheet " + css_name;
+                that.set_error_msg(message);
+                resolver(message);
             };
-            return that.evaluation_test_polling_loop(done_test, css_name, resolver);
         };
         return evaluator;
     },
 
-    evaluation_test_polling_loop: function(eval_test, resolve_value, resolver) {
-        var that = this;
-        var count = 0;
-        var limit = 100;
-        var wait_milliseconds = 10;
-        var test_poll = function () {
-            count += 1;
-            if (eval_test()) {
-                return resolver(resolve_value)
-            }
-            // otherwise try again, maybe
-            if (count < limit) {
-                setTimeout(test_poll, wait_milliseconds);
-            } else {
-                var message = "timeout awaiting " + resolve_value;
-                that.set_error_msg(message);
-                return resolver(message);
+    wait_for_js_load: function(test, action, failure, limit) {
+        // Call action() when test() is true after a javascript load completes,
+        // or failure() if that does not happen within limit milliseconds.
+        if (test()) {
+            return action();
+        }
+        var listener = {test: test, action: action};
+        js_load_listeners.push(listener);
+        setTimeout(function() {
+            var index = js_load_listeners.indexOf(listener);
+            if (index >= 0) {
+                js_load_listeners.splice(index, 1);
+                failure();
             }
-        };
-        test_poll();
+        }, limit);
+    },
+
+    notify_js_loaded: function() {
+        // A javascript load completed: run the listeners which are now satisfied.
+        var ready = js_load_listeners.filter(function(listener) { return listener.test(); });
+        js_load_listeners = js_load_listeners.filter(function(listener) { return ready.indexOf(listener) < 0; });
+        ready.forEach(function(listener) { listener.action(); });
     },
 
     sheet_name_exists: function(css_name) {
@@ -568,15 +1176,127 @@ var JSProxyView = widgets.DOMWidgetView.extend({
         return false;
     },
 
-    // cache of name to [completion status, text] for loaded javascript
+    load_asset_async: function(indicator, name, key, persist) {
+        // Return a function evaluator(resolver) loading the asset with the given content hash.
+        var that = this;
+        var evaluator = function(resolver) {
+            that.asset_text(key, persist).then(function(text) {
+                var loader;
+                if (indicator == "load_css") {
+                    loader = that.load_css_async(name, text);
+                } else {
+                    loader = that.load_js_async(name, text, key);
+                }
+                return loader(resolver);
+            }).catch(function(err) {
+                var msg = "failed to load asset " + name + ": " + err;
+                that.set_error_msg(msg);
+                return resolver(msg);
+            });
+        };
+        return evaluator;
+    },
+
+    asset_text: function(key, persist) {
+        // Promise the asset text from the page cache, persistent storage, or the kernel.
+        var that = this;
+        if (key in assets_by_hash) {
+            return Promise.resolve(assets_by_hash[key]);
+        }
+        var stored = persist ? that.stored_asset(key) : Promise.resolve(null);
+        return stored.catch(function() { return null; }).then(function(text) {
+            if (text !== null && text !== undefined) {
+                assets_by_hash[key] = text;
+                return text;
+            }
+            if (key in assets_by_hash) {
+                // arrived in the meantime
+                return assets_by_hash[key];
+            }
+            return new Promise(function(resolve, reject) {
+                var waiting = asset_waiters[key];
+                var callback = function(text) {
+                    if (text === null || text === undefined) {
+                        return reject("unknown asset " + key);
+                    }
+                    if (persist) {
+                        that.store_asset(key, text);
+                    }
+                    resolve(text);
+                };
+                if (waiting) {
+                    // already requested by some view in this page
+                    waiting.push(callback);
+                } else {
+                    asset_waiters[key] = [callback];
+                    that.send_custom_message(that.ASSET_REQUEST, [key]);
+                }
+            });
+        });
+    },
+
+    asset_arrived: function(key, text) {
+        if (text !== null && text !== undefined) {
+            assets_by_hash[key] = text;
+        }
+        var waiting = asset_waiters[key];
+        delete asset_waiters[key];
+        if (waiting) {
+            waiting.forEach(function(callback) { callback(text); });
+        }
+    },
+
+    asset_db: function() {
+        // Promise the IndexedDB database for persistent assets.
+        if (!asset_db_promise) {
+            asset_db_promise = new Promise(function(resolve, reject) {
+                if (typeof indexedDB == "undefined") {
+                    return reject("indexedDB is not available");
+                }
+                var request = indexedDB.open(ASSET_DB_NAME, 1);
+                request.onupgradeneeded = function() {
+                    request.result.createObjectStore("assets");
+                };
+                request.onsuccess = function() { resolve(request.result); };
+                request.onerror = function() { reject(request.error); };
+            });
+        }
+        return asset_db_promise;
+    },
+
+    stored_asset: function(key) {
+        // Promise the persisted text for the hash, or undefined.
+        return this.asset_db().then(function(db) {
+            return new Promise(function(resolve, reject) {
+                var request = db.transaction("assets", "readonly").objectStore("assets").get(key);
+                request.onsuccess = function() { resolve(request.result); };
+                request.onerror = function() { reject(request.error); };
+            });
+        });
+    },
+
+    store_asset: function(key, text) {
+        // Persist the text in the background: failure only loses the cache entry.
+        this.asset_db().then(function(db) {
+            db.transaction("assets", "readwrite").objectStore("assets").put(text, key);
+        }).catch(function(err) {
+            console.warn("could not persist asset " + key + ": " + err);
+        });
+    },
+
+    // cache of name to [completion status, key] for loaded javascript
+    // (the key is the content hash for assets, otherwise the text itself)
     loaded_js_by_name: {},
 
-    load_js_async: function(js_name, js_text) {
+    load_js_async: function(js_name, js_text, js_key) {
         // Return a function evaluator(resolver)
         // which promises to load the css_text and call the
         // resolver() when the load is complete.
         console.log("load_js_async " + js_name);
         var that = this;
+        if (js_key === undefined) {
+            js_key = js_text;
+        }
         var evaluator = function(resolver) {
             // we are done when the loaded javascript matches and is marked complete.
             var done_test = function() {
@@ -584,7 +1304,7 @@ var JSProxyView = widgets.DOMWidgetView.extend({
                 if (load_entry) {
                     var status = load_entry[0];
                     var loaded_text = load_entry[1];
-                    if ((status) && (loaded_text == js_text)) {
+                    if ((status) && (loaded_text == js_key)) {
                         return true;
                     }
                 };
@@ -592,8 +1312,14 @@ var JSProxyView = widgets.DOMWidgetView.extend({
             };
             // if the text is already loading, wait for completion
             var load_entry = that.loaded_js_by_name[js_name];
-            if ((load_entry) && (load_entry[1] == js_text)) {
-                return that.evaluation_test_polling_loop(done_test, js_name, resolver);
+            if ((load_entry) && (load_entry[1] == js_key)) {
+                var done = function() { return resolver(js_name); };
+                var timed_out = function() {
+                    var message = "timeout awaiting " + js_name;
+                    that.set_error_msg(message);
+                    return resolver(message);
+                };
+                return that.wait_for_js_load(done_test, done, timed_out, 1000);
             };
             // otherwise install the javascript...
             //var all_done = function() {
@@ -601,7 +1327,7 @@ var JSProxyView = widgets.DOMWidgetView.extend({
             //    that.loaded_js_by_name[js_name] = [true, js_text];
             //};
             // before done, mark the text as loading but not complete
-            that.loaded_js_by_name[js_name] = [false, js_text];
+            that.loaded_js_by_name[js_name] = [false, js_key];
             // compile the text NOT wrapped in an anonymous function
             var function_body = [
                 // "(function() {",
@@ -625,7 +1351,8 @@ var JSProxyView = widgets.DOMWidgetView.extend({
             // Evaluate in global context!
             eval.call(window, function_body);
             // mark as complete.
-            that.loaded_js_by_name[js_name] = [true, js_text];
+            that.loaded_js_by_name[js_name] = [true, js_key];
+            that.notify_js_loaded();
             // cl("resolving load for " + js_name);
             // resolve
             return resolver(js_name);
@@ -643,29 +1370,114 @@ var JSProxyView = widgets.DOMWidgetView.extend({
         return level;
     },
 
-    callback_factory: function(identifier, data, level, segmented) {
+    callback_factory: function(identifier, data, level, segmented, policy) {
         // create a callback which sends a message back to the Jupyter Kernel
         var that = this;
         // Counter makes sure change is noticed even if other arguments don't change.
         var counter = 0;
-        var handler = function () {
+        var send = function (args, batch) {
             counter += 1;
-            var payload = that.json_safe([identifier, data, arguments, counter], level + 1);
+            // typed arrays and ArrayBuffers in the arguments travel as binary message buffers.
+            var buffers = [];
+            var message = [identifier, data, args, counter];
+            var depth = level + 1;
+            if (batch) {
+                // a list of argument lists for held back calls
+                message.push(true);
+                depth += 1;
+            }
+            var payload = that.json_safe(message, depth, buffers);
             //that.model.set("callback_results", payload);
             //that.touch();
             if ((segmented) && (segmented > 0)) {
-                that.send_segmented_message(that.JSON_CB_FRAGMENT, that.JSON_CB_FINAL, payload, segmented);
+                that.send_segmented_message(that.JSON_CB_FRAGMENT, that.JSON_CB_FINAL, payload, segmented, buffers);
             } else {
-                that.send_custom_message("callback_results", payload);
+                that.send_custom_message("callback_results", payload, buffers);
             }
         };
+        if (policy) {
+            return that.rate_limited(send, policy);
+        }
+        var handler = function () {
+            send(arguments, false);
+        };
         return handler;
     },
 
-    send_segmented_message(frag_indicator, final_indicator, payload, segmented) {
+    rate_limited: function(send, policy) {
+        // Throttle or debounce calls before they reach the comm.
+        var debounce = !!policy.debounce_ms;
+        var wait = debounce ? policy.debounce_ms : policy.throttle_ms;
+        var leading = (policy.leading === undefined) ? !debounce : policy.leading;
+        var trailing = policy.trailing;
+        var latest_only = policy.latest_only;
+        var held = [];
+        var timer = null;
+        var send_held = function() {
+            var calls = held;
+            held = [];
+            if (calls.length == 1) {
+                send(calls[0], false);
+            } else if (calls.length > 1) {
+                send(calls, true);
+            }
+            return calls.length;
+        };
+        var hold = function(args) {
+            if (trailing) {
+                if (latest_only) {
+                    held = [args];
+                } else {
+                    held.push(args);
+                }
+            }
+        };
+        if (debounce) {
+            var quiet = function() {
+                timer = null;
+                send_held();
+            };
+            return function () {
+                var burst_start = (timer === null);
+                if (!burst_start) {
+                    clearTimeout(timer);
+                }
+                timer = setTimeout(quiet, wait);
+                if (burst_start && leading) {
+                    send(arguments, false);
+                } else {
+                    hold(arguments);
+                }
+            };
+        }
+        var interval_end = function() {
+            timer = null;
+            // calls sent at the end of an interval start another interval
+            if (send_held() > 0) {
+                timer = setTimeout(interval_end, wait);
+            }
+        };
+        return function () {
+            if (timer === null) {
+                timer = setTimeout(interval_end, wait);
+                if (leading) {
+                    send(arguments, false);
+                    return;
+                }
+            }
+            hold(arguments);
+        };
+    },
+
+    send_segmented_message(frag_indicator, final_indicator, payload, segmented, buffers) {
+        // send the JSON for the payload in fragments, with any binary buffers attached to the final fragment.
         var that = this;
         var json_str = JSON.stringify(payload);
         var json_len = json_str.length;
+        var threshold = that.model.get("compress_threshold");
+        if ((threshold) && (json_len >= threshold) && ((typeof CompressionStream) != "undefined")) {
+            return that.send_compressed_message(frag_indicator, final_indicator, json_str, segmented, buffers);
+        }
         var cursor = 0;
         while ((cursor + segmented) < json_len) {
             var next_cursor = cursor + segmented;
@@ -673,9 +1485,26 @@ var JSProxyView = widgets.DOMWidgetView.extend({
             cursor = next_cursor;
             that.send_custom_message(frag_indicator, fragment);
         }
-        //var tail = json_str.substring(cursor, json_len);
-        //that.send_custom_message(final_indicator, tail);
-        that.send_custom_message(final_indicator, true);  // disable command results for now (not used)
+        var tail = json_str.substring(cursor, json_len);
+        that.send_custom_message(final_indicator, tail, buffers);
+    },
+
+    send_compressed_message(frag_indicator, final_indicator, json_str, segmented, buffers) {
+        // send deflated JSON in binary fragments with the data buffers following the final fragment.
+        var that = this;
+        that.queue_send(function() {
+            return that.deflate(json_str).then(function(data) {
+                // comm serializers send view.buffer whole: copy each fragment into its own buffer.
+                var cursor = 0;
+                while ((cursor + segmented) < data.length) {
+                    var next_cursor = cursor + segmented;
+                    that.send_message_now(frag_indicator, null, [data.slice(cursor, next_cursor)], that.DEFLATE);
+                    cursor = next_cursor;
+                }
+                var final_buffers = [data.slice(cursor)].concat(buffers || []);
+                that.send_message_now(final_indicator, null, final_buffers, that.DEFLATE);
+            });
+        });
     },
 
     to_hex: function(int8) {
@@ -708,13 +1537,95 @@ var JSProxyView = widgets.DOMWidgetView.extend({
         return result;
     },
 
-    json_safe: function(val, depth) {
+    buffer_view: function(buffer) {
+        // Uint8Array view of a message buffer (ArrayBuffer or DataView) without copying.
+        if (buffer instanceof ArrayBuffer) {
+            return new Uint8Array(buffer);
+        }
+        if (ArrayBuffer.isView(buffer)) {
+            return new Uint8Array(buffer.buffer, buffer.byteOffset, buffer.byteLength);
+        }
+        throw "message buffer not found: " + buffer;
+    },
+
+    // Typed array constructors for numpy dtype names.
+    TYPED_ARRAYS: {
+        int8: Int8Array,
+        uint8: Uint8Array,
+        int16: Int16Array,
+        uint16: Uint16Array,
+        int32: Int32Array,
+        uint32: Uint32Array,
+        float32: Float32Array,
+        float64: Float64Array,
+    },
+
+    typed_array: function(bytes, dtype, shape) {
+        // Reinterpret the Uint8Array bytes as a typed array for the dtype, with shape metadata.
+        var constructor = this.TYPED_ARRAYS[dtype];
+        if (!constructor) {
+            throw "unsupported ndarray dtype " + dtype;
+        }
+        var width = constructor.BYTES_PER_ELEMENT;
+        if ((bytes.byteOffset % width) != 0) {
+            // typed arrays require aligned offsets: copy misaligned data.
+            bytes = bytes.slice();
+        }
+        var result = new constructor(bytes.buffer, bytes.byteOffset, bytes.byteLength / width);
+        result.dtype = dtype;
+        result.shape = shape;
+        return result;
+    },
+
+    buffer_reference: function(val, buffers) {
+        // Store binary data in buffers and return a placeholder {BUFFER_REFERENCE: [index, dtype, shape]}.
+        // Typed arrays become numpy arrays and other binary values become memoryviews in Python.
+        var dtype = null;
+        var shape = null;
+        if (!(val instanceof DataView) && ArrayBuffer.isView(val)) {
+            dtype = this.typed_array_dtype(val);
+            shape = val.shape || null;
+        }
+        var result = {};
+        result[this.BUFFER_REFERENCE] = [buffers.length, dtype, shape];
+        // comm serializers send view.buffer whole: copy views which cover only part of their buffer.
+        if (ArrayBuffer.isView(val) && ((val.byteOffset != 0) || (val.byteLength != val.buffer.byteLength))) {
+            val = val.buffer.slice(val.byteOffset, val.byteOffset + val.byteLength);
+        }
+        buffers.push(val);
+        return result;
+    },
+
+    typed_array_dtype: function(val) {
+        // numpy dtype name for a typed array.
+        if (val instanceof Uint8ClampedArray) {
+            return "uint8";
+        }
+        if ((typeof BigInt64Array != "undefined") && (val instanceof BigInt64Array)) {
+            return "int64";
+        }
+        if ((typeof BigUint64Array != "undefined") && (val instanceof BigUint64Array)) {
+            return "uint64";
+        }
+        for (var dtype in this.TYPED_ARRAYS) {
+            if (val instanceof this.TYPED_ARRAYS[dtype]) {
+                return dtype;
+            }
+        }
+        return "uint8";
+    },
+
+    json_safe: function(val, depth, buffers) {
         // maybe expand later as need arises
+        // If buffers is provided binary values are stored there and replaced by placeholders.
         var that = this;
         var ty = (typeof val);
         if ((ty == "number") || (ty == "string") || (ty == "boolean")) {
             return val;
         }
+        if ((buffers) && ((val instanceof ArrayBuffer) || ArrayBuffer.isView(val))) {
+            return that.buffer_reference(val, buffers);
+        }
         if ((val instanceof Uint8Array) || (val instanceof Uint8ClampedArray)) {
             // send as hexidecimal string
             return that.to_hex(val);
@@ -727,7 +1638,7 @@ var JSProxyView = widgets.DOMWidgetView.extend({
             if (jquery_.isArray(val)) {
                 var result = [];
                 _.each(val, function(elt, i) {
-                    var r = that.json_safe(elt, depth-1);
+                    var r = that.json_safe(elt, depth-1, buffers);
                     //if (r != null) {
                     result[i] = r;
                     //}
@@ -736,7 +1647,7 @@ var JSProxyView = widgets.DOMWidgetView.extend({
             } else {
                 var result = {};
                 for (var key in val) {
-                    var jv = that.json_safe(val[key], depth-1);
+                    var jv = that.json_safe(val[key], depth-1, buffers);
                     //if (jv != null) {
                     result[key] = jv;
                     //}
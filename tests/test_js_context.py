@@ -33,10 +33,14 @@ class TestJsContext(unittest.TestCase):
         path="https://raw.githubusercontent.com/AaronWatters/jp_proxy_widget/master/README.md"):
         class response:
             text = "talks about jp_doodle and other things"
-        save = js_context.requests.get
-        js_context.requests.get = MagicMock(return_value=response)
-        content = js_context.get_text_from_file_name(path)
-        js_context.requests.get = save
+            status_code = 200
+            headers = {}
+        session = MagicMock()
+        session.get = MagicMock(return_value=response)
+        with tempfile.TemporaryDirectory() as folder:
+            with patch("jp_proxy_widget.js_context.HTTP_CACHE_DIR", folder), \
+                patch("jp_proxy_widget.js_context.http_session", return_value=session):
+                content = js_context.get_text_from_file_name(path)
         assert "jp_doodle" in content
 
     def test_local_content(self, path="js/simple.js"):
@@ -50,10 +54,145 @@ class TestJsContext(unittest.TestCase):
         m = mock_open(read_data=byte_content)
         open_name = '%s.open' % js_context.__name__
         path = "js/simple.js"
+        js_context.invalidate_file_cache()
         with patch(open_name, m):
             content = js_context.get_text_from_file_name(path)
+        # don't keep the mocked content
+        js_context.invalidate_file_cache()
         self.assertEqual(content, unicode_content)
 
+    def test_file_cache(self):
+        js_context.invalidate_file_cache()
+        with tempfile.TemporaryDirectory() as folder:
+            path = os.path.join(folder, "cached.js")
+            with open(path, "w") as f:
+                f.write("first")
+            self.assertEqual(js_context.get_text_from_file_name(path), "first")
+            self.assertIn(path, js_context.LOADED_FILES)
+            open_name = '%s.open' % js_context.__name__
+            with patch(open_name) as m:
+                self.assertEqual(js_context.get_text_from_file_name(path), "first")
+                assert not m.called
+            # changes are detected by size and modification time
+            with open(path, "w") as f:
+                f.write("second!")
+            self.assertEqual(js_context.get_text_from_file_name(path), "second!")
+            # least recently used entries are evicted beyond the limit
+            other = os.path.join(folder, "other.js")
+            with open(other, "w") as f:
+                f.write("other text")
+            save_limit = js_context.FILE_CACHE_LIMIT
+            js_context.FILE_CACHE_LIMIT = 12
+            try:
+                js_context.get_text_from_file_name(other)
+            finally:
+                js_context.FILE_CACHE_LIMIT = save_limit
+            self.assertNotIn(path, js_context.FILE_CACHE)
+            self.assertIn(other, js_context.FILE_CACHE)
+            js_context.invalidate_file_cache(other)
+            self.assertNotIn(other, js_context.FILE_CACHE)
+            self.assertEqual(js_context.FILE_CACHE_SIZE[0], 0)
+
+    def test_http_cache(self):
+        import threading
+        import functools
+        from http.server import HTTPServer, SimpleHTTPRequestHandler
+        with tempfile.TemporaryDirectory() as served, tempfile.TemporaryDirectory() as cache:
+            for name in ("a.js", "b.js"):
+                with open(os.path.join(served, name), "w") as f:
+                    f.write("content of " + name)
+            requests_seen = []
+            class Handler(SimpleHTTPRequestHandler):
+                def log_message(self, format, *args):
+                    # args are the request line, status code and size
+                    requests_seen.append((self.headers.get("If-Modified-Since"), args[1]))
+            handler = functools.partial(Handler, directory=served)
+            server = HTTPServer(("127.0.0.1", 0), handler)
+            thread = threading.Thread(target=server.serve_forever, daemon=True)
+            thread.start()
+            base = "http://127.0.0.1:%s/" % server.server_port
+            urls = [base + "a.js", base + "b.js"]
+            try:
+                with patch("jp_proxy_widget.js_context.HTTP_CACHE_DIR", cache):
+                    texts = js_context.get_texts_from_file_names(urls)
+                    self.assertEqual(texts, {urls[0]: "content of a.js", urls[1]: "content of b.js"})
+                    # revalidation is answered with 304 not modified
+                    self.assertEqual(js_context.get_text_from_file_name(urls[0]), "content of a.js")
+                    (if_modified_since, status) = requests_seen[-1]
+                    self.assertIsNotNone(if_modified_since)
+                    self.assertEqual(status, "304")
+                    with patch("jp_proxy_widget.js_context.OFFLINE", True):
+                        count = len(requests_seen)
+                        self.assertEqual(js_context.get_text_from_file_name(urls[1]), "content of b.js")
+                        self.assertEqual(len(requests_seen), count)
+                        with self.assertRaises(IOError):
+                            js_context.get_text_from_file_name(base + "missing.js")
+                    # error responses serve the cached copy or raise, never the error page
+                    os.remove(os.path.join(served, "a.js"))
+                    self.assertEqual(js_context.get_text_from_file_name(urls[0]), "content of a.js")
+                    self.assertEqual(requests_seen[-1][1], "404")
+                    with self.assertRaises(js_context.requests.HTTPError):
+                        js_context.get_text_from_file_name(base + "missing.js")
+            finally:
+                server.shutdown()
+                server.server_close()
+
+    def test_http_cache_opt_in(self):
+        url = "https://example.com/lib.js"
+        class response:
+            text = "remote text"
+            status_code = 200
+            headers = {"ETag": "abc"}
+        session = MagicMock()
+        session.get = MagicMock(return_value=response)
+        saved = js_context.HTTP_CACHE_DIR
+        try:
+            with patch("jp_proxy_widget.js_context.http_session", return_value=session):
+                js_context.enable_http_cache(None)
+                self.assertIsNone(js_context.http_cache_path(url))
+                self.assertEqual(js_context.get_text_from_url(url), "remote text")
+                with tempfile.TemporaryDirectory() as folder:
+                    js_context.enable_http_cache(folder)
+                    # nothing was written while the cache was disabled
+                    self.assertIsNone(js_context.read_http_cache(url))
+                    js_context.get_text_from_url(url)
+                    self.assertEqual(js_context.read_http_cache(url)["text"], "remote text")
+        finally:
+            js_context.HTTP_CACHE_DIR = saved
+
+    @patch("jp_proxy_widget.js_context.run_ui_poll_loop")
+    @patch("jp_proxy_widget.js_context.time.sleep")
+    def test_load_acknowledgement(self, sleep, poll):
+        widget = MagicMock()
+        on_loaded = MagicMock()
+        f = tempfile.NamedTemporaryFile(suffix=".js")
+        self.addCleanup(f.close)
+        self.addCleanup(js_context.LOADED_JAVASCRIPT.discard, f.name)
+        # the view acknowledges the batch after the loads
+        widget.flush.side_effect = lambda callback=None: callback and callback(True)
+        js_context.load_if_not_loaded(widget, [f.name], evaluator=js_context.eval_javascript,
+            on_loaded=on_loaded, wait=True)
+        assert widget.window().eval.called
+        assert not sleep.called
+        widget.callable.assert_called_with(on_loaded)
+        assert widget.flush.called
+        assert not poll.called
+        assert not widget.evaluate.called
+        # loads outside the widget are not covered by the acknowledgement: keep the delays
+        evaluator = MagicMock()
+        js_context.load_if_not_loaded(widget, [f.name], evaluator=evaluator, on_loaded=on_loaded, force=True)
+        assert evaluator.called
+        assert sleep.called
+        # a lost acknowledgement times out
+        widget.flush.side_effect = None
+        with self.assertRaises(TimeoutError):
+            js_context.load_if_not_loaded(widget, [f.name], evaluator=evaluator, wait=True, force=True, timeout=0)
+        assert poll.called
+        # an undisplayed widget would never acknowledge
+        widget.rendered = False
+        with self.assertRaises(ValueError):
+            js_context.load_if_not_loaded(widget, [f.name], evaluator=evaluator, wait=True, force=True)
+
     @patch("jp_proxy_widget.js_context.display")
     @patch("jp_proxy_widget.js_context.Javascript")
     def test_display_javacript(self, mock1, mock2):
@@ -1,9 +1,12 @@
 import unittest
 from unittest.mock import patch
 from unittest.mock import MagicMock
+from unittest.mock import call
 from jp_proxy_widget import proxy_widget
 import jp_proxy_widget
 import tempfile
+import json
+import zlib
 import os
 
 class TestProxyWidget(unittest.TestCase):
@@ -141,6 +144,27 @@ class TestProxyWidget(unittest.TestCase):
             widget = proxy_widget.JSProxyWidget()
             widget.handle_custom_message(None, data)
 
+    def test_handle_custom_message_buffers(self, *mocks):
+        import numpy as np
+        i = proxy_widget.INDICATOR
+        p = proxy_widget.PAYLOAD
+        r = proxy_widget.BUFFER_REFERENCE
+        floats = np.array([1.5, 2.5, 3.5, 4.5], dtype="<f4")
+        buffers = [memoryview(floats.tobytes()), memoryview(b"raw")]
+        arguments = {"0": {r: [0, "float32", [2, 2]]}, "1": [{r: [1, None, None]}, "text"]}
+        widget = proxy_widget.JSProxyWidget()
+        m = widget.handle_callback_results = MagicMock()
+        widget.handle_custom_message(None, {i: proxy_widget.CALLBACK_RESULTS, p: [1, "data", arguments, 1]}, buffers)
+        [identifier, data, restored, counter] = m.call_args[0][0]
+        self.assertEqual(restored["0"].tolist(), [[1.5, 2.5], [3.5, 4.5]])
+        self.assertEqual(bytes(restored["1"][0]), b"raw")
+        self.assertEqual(restored["1"][1], "text")
+        # segmented callbacks restore buffers from the final fragment
+        import json
+        widget.handle_custom_message(None, {i: proxy_widget.JSON_CB_FINAL, p: json.dumps([2, "data", arguments, 1])}, buffers)
+        [identifier, data, restored, counter] = m.call_args[0][0]
+        self.assertEqual(restored["0"].shape, (2, 2))
+
     def test_handle_custom_message_error(self, *mocks):
         i = proxy_widget.INDICATOR
         p = proxy_widget.PAYLOAD
@@ -416,6 +440,354 @@ class TestProxyWidget(unittest.TestCase):
         s = widget.send_custom_message = MagicMock()
         widget.send_segmented_message("frag", "final", payload, 100)
         assert s.called
+        calls = [c[0] for c in s.call_args_list]
+        self.assertEqual(calls[-1][0], "final")
+        self.assertTrue(all(c[0] == "frag" and len(c[1]) == 100 for c in calls[:-1]))
+        self.assertEqual(json.loads("".join(c[1] for c in calls)), payload)
+
+    def test_iter_segments(self, *args):
+        segments = list(proxy_widget.iter_segments(["ab", "cdefg", "", "h"], 3, ""))
+        self.assertEqual(segments, ["abc", "def", "gh"])
+        segments = list(proxy_widget.iter_segments([b"abc", b"def"], 3, b""))
+        self.assertEqual(segments, [b"abc", b"def"])
+        self.assertEqual(list(proxy_widget.iter_segments([], 3, "")), [""])
+
+    def test_send_compressed_message(self, *args):
+        import json, zlib
+        payload = ["some repetitive text"] * 1000
+        widget = proxy_widget.JSProxyWidget()
+        widget.compress_threshold = 100
+        s = widget.send_custom_message = MagicMock()
+        data = b"binary data"
+        widget.send_segmented_message("frag", "final", payload, 50, [data])
+        calls = [c[0] for c in s.call_args_list]
+        self.assertEqual(calls[-1][0], "final")
+        self.assertTrue(all(c[0] == "frag" for c in calls[:-1]))
+        self.assertTrue(all(c[3] == proxy_widget.DEFLATE for c in calls))
+        self.assertEqual(calls[-1][2][1:], [data])
+        compressed = b"".join(bytes(c[2][0]) for c in calls)
+        self.assertEqual(json.loads(zlib.decompress(compressed).decode("utf8")), payload)
+        # short messages are not compressed
+        s.reset_mock()
+        widget.send_segmented_message("frag", "final", [1], 50)
+        self.assertEqual(s.call_args[0], ("final", "[1]", None))
+
+    def test_receive_compressed_callback(self, *args):
+        import json, zlib
+        i = proxy_widget.INDICATOR
+        p = proxy_widget.PAYLOAD
+        c = proxy_widget.COMPRESSION
+        results = [3, "data", {"0": "argument " * 100}, 1]
+        compressed = zlib.compress(json.dumps(results).encode("utf8"))
+        widget = proxy_widget.JSProxyWidget()
+        m = widget.handle_callback_results = MagicMock()
+        widget.handle_custom_message(None, {i: proxy_widget.JSON_CB_FRAGMENT, p: None, c: "deflate"}, [compressed[:20]])
+        widget.handle_custom_message(None, {i: proxy_widget.JSON_CB_FINAL, p: None, c: "deflate"}, [compressed[20:]])
+        m.assert_called_with(results)
+
+    def test_receive_compressed_fragment_views(self, *args):
+        import json, zlib
+        i = proxy_widget.INDICATOR
+        p = proxy_widget.PAYLOAD
+        c = proxy_widget.COMPRESSION
+        results = [3, "data", {"0": "argument " * 100}, 1]
+        compressed = zlib.compress(json.dumps(results).encode("utf8"))
+        # fragments arrive as views at non-zero offsets into larger buffers
+        padded = memoryview(b"garbage" + compressed + b"trailing")
+        fragments = [padded[7:27], padded[27:27 + 10], padded[37:7 + len(compressed)]]
+        widget = proxy_widget.JSProxyWidget()
+        m = widget.handle_callback_results = MagicMock()
+        for fragment in fragments[:-1]:
+            widget.handle_custom_message(None, {i: proxy_widget.JSON_CB_FRAGMENT, p: None, c: "deflate"}, [fragment])
+        widget.handle_custom_message(None, {i: proxy_widget.JSON_CB_FINAL, p: None, c: "deflate"}, fragments[-1:])
+        m.assert_called_with(results)
+
+    def test_symbol_table_encoding(self, *args):
+        S = proxy_widget.OP_SYMBOL
+        op = proxy_widget.OPCODE
+        table = proxy_widget.SymbolTable()
+        target = ["get", ["element"], "_FRAGILE_THIS"]
+        command = ["method", target, "update", ["list", 1, 2]]
+        first = table.encode(command)
+        self.assertEqual(first, [op["method"],
+            [S, 1, [op["get"], [op["element"]], [S, 0, "_FRAGILE_THIS"]]],
+            [S, 2, "update"], [op["list"], 1, 2]])
+        second = table.encode(command)
+        self.assertEqual(second, [op["method"], [S, 1], [S, 2], [op["list"], 1, 2]])
+        table.reset()
+        self.assertEqual(table.encode(command), first)
+
+    def test_symbol_table_limit(self, *args):
+        S = proxy_widget.OP_SYMBOL
+        table = proxy_widget.SymbolTable(limit=1)
+        self.assertEqual(table.encode_name("a"), [S, 0, "a"])
+        self.assertEqual(table.encode_name("b"), "b")
+        self.assertEqual(table.encode_name("a"), [S, 0])
+
+    def test_send_commands_with_symbols(self, *args):
+        widget = proxy_widget.JSProxyWidget()
+        widget.rendered = True
+        widget.use_symbol_table = True
+        s = widget.send_custom_message = MagicMock()
+        widget.send_command(proxy_widget.CallMaker("method", widget.get_element(), "focus"))
+        payload = s.call_args[0][1]
+        self.assertEqual(payload[3], {"symbols": 1})
+        self.assertEqual(payload[1][0][2], [proxy_widget.OP_SYMBOL, 0, "focus"])
+        widget.send_command(proxy_widget.CallMaker("method", widget.get_element(), "focus"))
+        payload = s.call_args[0][1]
+        self.assertEqual(payload[1][0][2], [proxy_widget.OP_SYMBOL, 0])
+        # a new view session starts a new table
+        i = proxy_widget.INDICATOR
+        p = proxy_widget.PAYLOAD
+        widget.handle_custom_message(None, {i: proxy_widget.SESSION_RESET, p: None})
+        widget.send_command(proxy_widget.CallMaker("method", widget.get_element(), "focus"))
+        payload = s.call_args[0][1]
+        self.assertEqual(payload[1][0][2], [proxy_widget.OP_SYMBOL, 0, "focus"])
+
+    def test_symbol_resend(self, *args):
+        widget = proxy_widget.JSProxyWidget()
+        widget.rendered = True
+        widget.use_symbol_table = True
+        s = widget.send_custom_message = MagicMock()
+        focus = lambda: widget.send_command(proxy_widget.CallMaker("method", widget.get_element(), "focus"))
+        first = focus()[0]
+        widget.handle_results([first, True])
+        second = focus()[0]
+        third = focus()[0]
+        self.assertEqual(s.call_args[0][1][1][0][2], [proxy_widget.OP_SYMBOL, 0])
+        # a reloaded view cannot decode the references and asks for a resend
+        i = proxy_widget.INDICATOR
+        p = proxy_widget.PAYLOAD
+        s.reset_mock()
+        widget.handle_custom_message(None, {i: proxy_widget.SYMBOL_RESEND, p: [second, 1]})
+        resent = [c[0][1] for c in s.call_args_list]
+        self.assertEqual([b[0] for b in resent], [second, third])
+        self.assertEqual(resent[0][3], {"symbols": 2})
+        self.assertEqual(resent[0][1][0][2], [proxy_widget.OP_SYMBOL, 0, "focus"])
+        self.assertEqual(resent[1][1][0][2], [proxy_widget.OP_SYMBOL, 0])
+        # later requests for the old generation do not resend again
+        widget.handle_custom_message(None, {i: proxy_widget.SYMBOL_RESEND, p: [third, 1]})
+        self.assertEqual(s.call_count, 2)
+        widget.handle_results([second, True])
+        widget.handle_results([third, True])
+        self.assertEqual(len(widget._symbol_batches), 0)
+
+    def test_flow_control_batches(self, *args):
+        widget = proxy_widget.JSProxyWidget()
+        widget.rendered = True
+        widget.max_batches_in_flight = 2
+        s = widget.send_custom_message = MagicMock()
+        counts = [widget.send_command(["id", i])[0] for i in range(5)]
+        self.assertEqual(s.call_count, 2)
+        status = widget.flow_status()
+        self.assertEqual((status["queued"], status["in_flight"]), (3, 2))
+        # acknowledgement releases the next batch
+        widget.handle_results([counts[0], True])
+        self.assertEqual(s.call_count, 3)
+        # queued batches are sent as the UTF-8 JSON text encoded for the size accounting, in a buffer
+        (indicator, payload, [text], compression, format) = s.call_args[0]
+        self.assertEqual((indicator, payload, format), (proxy_widget.COMMANDS_FINAL, None, proxy_widget.JSON_TEXT_FORMAT))
+        self.assertEqual(json.loads(text.decode("utf-8"))[0], counts[2])
+        self.assertEqual(widget._in_flight[counts[2]][0], len(text))
+        # unknown or repeated acknowledgements are ignored
+        widget.handle_results([counts[0], True])
+        self.assertEqual(s.call_count, 3)
+        # session reset forgets unacknowledged batches
+        widget.handle_session_reset()
+        self.assertEqual(s.call_count, 5)
+        self.assertEqual(widget.flow_status()["queued"], 0)
+
+    def test_flow_control_bytes(self, *args):
+        widget = proxy_widget.JSProxyWidget()
+        widget.rendered = True
+        widget.max_bytes_in_flight = 30
+        s = widget.send_custom_message = MagicMock()
+        count = widget.send_command(["id", "x" * 100])[0]
+        widget.send_command(["id", 1])
+        # the large batch is sent alone
+        self.assertEqual(s.call_count, 1)
+        self.assertGreater(widget.flow_status()["bytes_in_flight"], 100)
+        widget.handle_results([count, False])
+        self.assertEqual(s.call_count, 2)
+
+    @patch("jp_proxy_widget.proxy_widget.call_later")
+    def test_flow_control_rate_and_timeout(self, call_later, *args):
+        widget = proxy_widget.JSProxyWidget()
+        widget.rendered = True
+        widget.max_bytes_per_second = 10
+        s = widget.send_custom_message = MagicMock()
+        widget.send_command(["id", "x" * 100])
+        widget.send_command(["id", 1])
+        self.assertEqual(s.call_count, 1)
+        (delay, drain) = call_later.call_args[0]
+        self.assertGreater(delay, 5)
+        widget._rate_time -= delay
+        drain()
+        self.assertEqual(s.call_count, 2)
+        # lost acknowledgements time out
+        widget.max_bytes_per_second = None
+        widget.max_batches_in_flight = 1
+        widget._in_flight.clear()
+        widget.send_command(["id", 2])
+        widget.send_command(["id", 3])
+        self.assertEqual(s.call_count, 3)
+        for count in widget._in_flight:
+            (size, sent) = widget._in_flight[count]
+            widget._in_flight[count] = (size, sent - widget.ack_timeout - 1)
+        widget.drain_send_queue()
+        self.assertEqual(s.call_count, 4)
+
+    @patch("IPython.get_ipython")
+    def test_cell_flush_policy(self, get_ipython, *args):
+        shell = get_ipython.return_value
+        widget = proxy_widget.JSProxyWidget()
+        widget.rendered = True
+        s = widget.send_custom_message = MagicMock()
+        widget.set_flush_policy(proxy_widget.CellFlushPolicy())
+        widget.element.focus()
+        widget.element.blur()
+        self.assertFalse(s.called)
+        shell.events.register.assert_called_with("post_execute", proxy_widget.flush_cell_widgets)
+        proxy_widget.flush_cell_widgets()
+        self.assertEqual(s.call_count, 1)
+        self.assertGreaterEqual(len(s.call_args[0][1][1]), 2)
+
+    @patch("jp_proxy_widget.proxy_widget.call_later")
+    def test_window_flush_policy(self, call_later, *args):
+        widget = proxy_widget.JSProxyWidget()
+        widget.rendered = True
+        s = widget.send_custom_message = MagicMock()
+        widget.flush_policy = proxy_widget.WindowFlushPolicy(5)
+        widget.element.focus()
+        widget.element.blur()
+        self.assertEqual(call_later.call_count, 1)
+        (delay, window_flush) = call_later.call_args[0]
+        self.assertEqual(delay, 0.005)
+        window_flush()
+        self.assertEqual(s.call_count, 1)
+        widget.element.focus()
+        self.assertEqual(call_later.call_count, 2)
+
+    def test_size_flush_policy(self, *args):
+        widget = proxy_widget.JSProxyWidget()
+        widget.rendered = True
+        s = widget.send_custom_message = MagicMock()
+        otherwise = MagicMock()
+        widget.flush_policy = proxy_widget.SizeFlushPolicy(max_commands=3, max_bytes=200, otherwise=otherwise)
+        element = widget.get_element()
+        widget.buffer_command(element.focus())
+        widget.buffer_command(element.blur())
+        self.assertEqual(otherwise.buffered.call_count, 2)
+        widget.buffer_command(element.focus())
+        self.assertEqual(s.call_count, 1)
+        widget.buffer_command(element.text("x" * 300))
+        self.assertEqual(s.call_count, 2)
+        # the size estimate validates once and the flush reuses the validated commands
+        widget.buffer_command(element.text(b"binary"))
+        [buffered] = widget.buffered_commands
+        self.assertIs(type(buffered), proxy_widget.ValidatedCommand)
+        self.assertEqual(buffered.size(), len('["method",["element"],"text",["buffer",0]]') + 6)
+        with patch.object(widget, "validate_command", wraps=widget.validate_command) as validate:
+            widget.flush()
+            self.assertEqual(validate.call_args_list, [call(buffered, True)])
+        self.assertEqual(s.call_args[0][1][1], [["method", ["element"], "text", ["buffer", 0]]])
+
+    def test_encode_frame(self, *args):
+        import numpy as np
+        payload = [3, [["method", ["element"], "text", "h\u00e9llo",
+            ["list", 1, -2, 0.5, 2 ** 40, True, False, None, np.int16(4)],
+            ["dict", {"a": ["list"], "b": "x"}], [2, 3]]], 1, {"symbols": True}]
+        frame = proxy_widget.encode_frame(payload)
+        self.assertEqual(frame[0], proxy_widget.FRAME_VERSION)
+        expected = json.loads(json.dumps(payload, default=proxy_widget.json_default))
+        self.assertEqual(proxy_widget.decode_frame(frame), expected)
+        # indicators are sent as opcodes
+        self.assertNotIn(b"method", frame)
+
+    def test_send_binary_command_frames(self, *args):
+        widget = proxy_widget.JSProxyWidget()
+        widget.rendered = True
+        widget.command_format = proxy_widget.BINARY_FORMAT
+        s = widget.send_custom_message = MagicMock()
+        data = b"binary data"
+        payload = widget.send_command(proxy_widget.CallMaker("method", widget.get_element(), "process", data))
+        (indicator, json_payload, buffers, compression, format) = s.call_args[0]
+        self.assertEqual((indicator, json_payload, compression, format),
+            (proxy_widget.COMMANDS_FINAL, None, None, proxy_widget.BINARY_FORMAT))
+        self.assertEqual(proxy_widget.decode_frame(buffers[0]), payload)
+        self.assertEqual(buffers[1:], [data])
+        # segmented and compressed
+        s.reset_mock()
+        widget.compress_threshold = 100
+        payload = widget.send_commands([proxy_widget.CallMaker("method", widget.get_element(), "text", "x" * 1000)],
+            segmented=10)
+        calls = [c[0] for c in s.call_args_list]
+        self.assertGreater(len(calls), 1)
+        self.assertTrue(all(c[3] == proxy_widget.DEFLATE and c[4] == proxy_widget.BINARY_FORMAT for c in calls))
+        frame = zlib.decompress(b"".join(c[2][0] for c in calls))
+        self.assertEqual(proxy_widget.decode_frame(frame), payload)
+
+    def test_prepare_template(self, *args):
+        widget = proxy_widget.JSProxyWidget()
+        widget.rendered = True
+        s = widget.send_custom_message = MagicMock()
+        Param = proxy_widget.Param
+        update = widget.prepare(widget.get_element().update_point(Param("i"), [Param("x"), Param("i")], Param("y")))
+        self.assertEqual(update.parameters, ["i", "x", "y"])
+        self.assertFalse(s.called)
+        update(1, 2.5, y=b"data")
+        [define, invoke] = s.call_args[0][1][1]
+        self.assertEqual(define, ["define", update.identifier, ["i", "x", "y"],
+            ["method", ["element"], "update_point", ["param", "i"], ["list", ["param", "x"], ["param", "i"]], ["param", "y"]]])
+        self.assertEqual(invoke, ["invoke", update.identifier, 1, 2.5, ["buffer", 0]])
+        self.assertEqual(s.call_args[0][2], [b"data"])
+        # later invocations send only the arguments
+        update(2, [3], 4)
+        self.assertEqual(s.call_args[0][1][1], [["invoke", update.identifier, 2, ["list", 3], 4]])
+        # a new view session gets the definition again
+        widget.handle_session_reset()
+        update(i=3, x=4, y=5)
+        self.assertEqual(s.call_args[0][1][1][0][0], "define")
+        with self.assertRaises(TypeError):
+            update(1, 2)
+        with self.assertRaises(TypeError):
+            update(1, 2, 3, z=4)
+
+    def test_prepare_template_parameters(self, *args):
+        widget = proxy_widget.JSProxyWidget()
+        Param = proxy_widget.Param
+        command = widget.get_element()._set("value", Param("v"))
+        self.assertEqual(widget.prepare(command, ["v", "unused"]).parameters, ["v", "unused"])
+        with self.assertRaises(AssertionError):
+            widget.prepare(command, ["w"])
+
+    def test_send_binary_as_buffers(self, *args):
+        widget = proxy_widget.JSProxyWidget()
+        widget.rendered = True
+        s = widget.send_custom_message = MagicMock()
+        data = bytearray(b"\x00\x01binary")
+        widget.send_command(
+            proxy_widget.CallMaker("method", widget.get_element(), "process", data, b"more"))
+        (indicator, payload, buffers) = s.call_args[0]
+        self.assertEqual(indicator, proxy_widget.COMMANDS)
+        self.assertEqual(buffers, [data, b"more"])
+        [command] = payload[1]
+        self.assertEqual(command[3:], [["buffer", 0], ["buffer", 1]])
+
+    def test_extract_buffers(self, *args):
+        data = b"binary"
+        plain = ["method", ["element"], "f", ["id", [1, 2]]]
+        commands = [
+            plain,
+            ["dict", {"a": ["buffer", data], "b": 3}],
+            ["list", ["buffer", memoryview(data)], "text"],
+        ]
+        (extracted, buffers) = proxy_widget.extract_buffers(commands)
+        self.assertIs(extracted[0], plain)
+        self.assertEqual(extracted[1], ["dict", {"a": ["buffer", 0], "b": 3}])
+        self.assertEqual(extracted[2], ["list", ["buffer", 1], "text"])
+        self.assertEqual(len(buffers), 2)
+        self.assertIs(buffers[0], data)
 
 
     """
@@ -491,6 +863,23 @@ class TestProxyWidget(unittest.TestCase):
         #self.assertEqual(c.args[1], 1)
         #(count, data, level, segmented) = c.args
 
+    def test_rate_limited_callable(self, *args):
+        widget = proxy_widget.JSProxyWidget()
+        f = MagicMock()
+        c = widget.callable(f, throttle_ms=50, latest_only=True)
+        self.assertIsNot(c, widget.callable(f))
+        self.assertIs(c, widget.callable(f, throttle_ms=50, latest_only=True))
+        identifier = c.args[0]
+        policy = {"throttle_ms": 50, "trailing": True, "latest_only": True}
+        self.assertEqual(widget.validate_command(c, top=False)[5], ["dict", policy])
+        widget.strict_validation = True
+        self.assertEqual(widget.validate_command(c, top=False)[5], ["dict", policy])
+        with self.assertRaises(AssertionError):
+            widget.callable(f, throttle_ms=50, debounce_ms=50)
+        # held back calls arrive in one batch
+        widget.handle_callback_results([identifier, "data", [{"0": 1}, {"0": 2}], 3, True])
+        self.assertEqual(f.call_args_list, [call(1), call(2)])
+
     def test_forget_callable(self, *args):
         widget = proxy_widget.JSProxyWidget()
         widget.identifier_to_callback = {1: list, 2: dict}
@@ -536,6 +925,7 @@ class TestProxyWidget(unittest.TestCase):
             ["function", ["element"]] + call_args,
             ["id", "untranslated"],
             ["bytes", u"12ff"],
+            ["buffer", bytearray(b"\x12\xff")],
             ["list"] + call_args,
             ["dict", {"key": ["element"]}],
             ["callback", numerical_identifier, untranslated_data, level, segmented],
@@ -680,35 +1070,357 @@ class TestProxyWidget(unittest.TestCase):
         self.assertIsInstance(call_attribute, proxy_widget.LazyGet)
         self.assertIsInstance(repr(call_attribute), str)  # exercise the repr method
 
+    def test_lazy_chain_fusion(self, *args):
+        widget = proxy_widget.JSProxyWidget()
+        widget.rendered = True
+        s = widget.send_custom_message = MagicMock()
+        get = widget.element.foo.bar
+        # attribute access sends nothing
+        self.assertFalse(s.called)
+        call = get(1)
+        element = ["element"]
+        slot = ["get", element, proxy_widget.FRAGILE_JS_REFERENCE]
+        self.assertEqual(s.call_args[0][1][1], [["set", element, proxy_widget.FRAGILE_JS_REFERENCE,
+            ["method", ["get", element, "foo"], "bar", 1]]])
+        # chains continuing from the latest call use the fragile reference slot
+        call.baz(call.size)
+        self.assertEqual(s.call_args[0][1][1], [["set", element, proxy_widget.FRAGILE_JS_REFERENCE,
+            ["method", slot, "baz", ["get", slot, "size"]]]])
+        self.assertEqual(s.call_count, 2)
+        # stale references execute the chain again
+        self.assertEqual(widget.validate_command(call.reference()), ["method", ["get", element, "foo"], "bar", 1])
+
+    def test_optimize_commands(self, *args):
+        F = proxy_widget.FRAGILE_JS_REFERENCE
+        element = ["element"]
+        slot = ["get", element, F]
+        call1 = ["method", element, "find", "x"]
+        call2 = ["method", slot, "show"]
+        call3 = ["method", element, "hide"]
+        target = ["get", ["window"], "config"]
+        commands = [
+            ["load_js", "a.js", "code"],
+            ["set", element, F, call1],
+            ["set", element, F, call2],    # reads the previous slot value
+            ["set", element, F, ["id", 1]],   # dead and pure: dropped
+            ["set", element, F, call3],
+            ["load_js", "a.js", "code"],   # repeated load: dropped
+            ["set", target, "a", 1],
+            ["set", target, "b", ["get", target, "a"]],
+            ["set", target, "c", 2],
+            ["set", target, "c", 3],   # overwrites c: merged
+        ]
+        (optimized, removed) = proxy_widget.optimize_commands(commands)
+        self.assertEqual(optimized, [
+            ["load_js", "a.js", "code"],
+            ["set", element, F, call1],
+            call2,   # overwritten before any read
+            ["set", element, F, call3],
+            ["set", ["set", ["set", target, "a", 1], "b", ["get", target, "a"]], "c", 3],
+        ])
+        self.assertEqual(removed, 5)
+        # dead writes with side effects keep their value
+        (optimized, removed) = proxy_widget.optimize_commands([["set", element, F, call1], ["set", element, F, call3]])
+        self.assertEqual(optimized, [call1, ["set", element, F, call3]])
+        self.assertEqual(removed, 0)
+        # cached functions sent by hash are scanned through their registered texts
+        widget = proxy_widget.JSProxyWidget()
+        reader = widget.compiled_function(["element"], "return element." + F + ";")
+        reader = widget.compiled_function(["element"], "return element." + F + ";")
+        self.assertEqual(reader._cmd(), ["js_function", reader.key])
+        other = widget.compiled_function(["element"], "return element.width;")
+        read = ["function", reader._cmd(), element]
+        commands = [["set", element, F, call1], read, ["set", element, F, call3]]
+        self.assertEqual(proxy_widget.optimize_commands(commands), (commands, 0))
+        unread = ["function", other._cmd(), element]
+        commands = [["set", element, F, call1], unread, ["set", element, F, call3]]
+        self.assertEqual(proxy_widget.optimize_commands(commands), ([call1, unread, ["set", element, F, call3]], 0))
+        unknown = ["function", ["js_function", "unregistered"], element]
+        commands = [["set", element, F, call1], unknown, ["set", element, F, call3]]
+        self.assertEqual(proxy_widget.optimize_commands(commands), (commands, 0))
+        # texts evicted from the bounded registry are treated as reading anything
+        with patch("jp_proxy_widget.proxy_widget.FUNCTION_NAMES", proxy_widget.collections.OrderedDict()), \
+                patch("jp_proxy_widget.proxy_widget.FUNCTION_NAMES_LIMIT", 1):
+            unread = ["function", widget.compiled_function(["element"], "return element.width;")._cmd(), element]
+            commands = [["set", element, F, call1], unread, ["set", element, F, call3]]
+            self.assertEqual(proxy_widget.optimize_commands(commands)[0][0], call1)
+            widget.compiled_function(["element"], "return element.height;")
+            self.assertNotIn(other.key, proxy_widget.FUNCTION_NAMES)
+            commands = [["set", element, F, call1], unread, ["set", element, F, call3]]
+            self.assertEqual(proxy_widget.optimize_commands(commands), (commands, 0))
+
+    def test_flush_optimization_switch(self, *args):
+        widget = proxy_widget.JSProxyWidget()
+        widget.rendered = True
+        s = widget.send_custom_message = MagicMock()
+        element = widget.get_element()
+        commands = [element._set("a", 1), element._set("b", 2)]
+        widget.send_commands(commands)
+        self.assertEqual(len(s.call_args[0][1][1]), 1)
+        self.assertEqual(widget.commands_optimized_away, 1)
+        widget.optimize_commands = False
+        widget.send_commands(commands)
+        self.assertEqual(len(s.call_args[0][1][1]), 2)
+
+    def test_selected_results(self, *args):
+        widget = proxy_widget.JSProxyWidget()
+        widget.rendered = True
+        widget.auto_flush = False
+        s = widget.send_custom_message = MagicMock()
+        element = widget.get_element()
+        callback = MagicMock()
+        # batches that do not ask for results carry no options
+        widget(element.a)
+        widget.flush(callback)
+        [count, commands, level] = s.call_args[0][1]
+        widget.handle_results([count, True])
+        callback.assert_called_with(True)
+        # selected indices survive the buffered command prefix and skip the optimizer
+        widget(element._set("a", 1))
+        widget(element._set("b", 2))
+        widget.send_commands([element.width, element.height], callback, 2, results=[1])
+        [count, commands, level, options] = s.call_args[0][1]
+        self.assertEqual(len(commands), 4)
+        self.assertEqual(options, {"results": [3]})
+        widget.handle_results([count, [None, None, None, 4]])
+        callback.assert_called_with([None, None, None, 4])
+        widget(element.width)
+        widget.flush(callback, results=True)
+        self.assertEqual(s.call_args[0][1][3], {"results": True})
+
+    def test_trusted_validation(self, *args):
+        widget = proxy_widget.JSProxyWidget()
+        callback = widget.callable(MagicMock())
+        element = widget.get_element()
+        command = element.find(".row").eq(3).css({"color": "red", "items": [1, element.x]})
+        command = proxy_widget.SetMaker(element, "handler", command.on("click", callback))
+        trusted = widget.validate_command(command, top=False)
+        widget.strict_validation = True
+        self.assertEqual(widget.validate_command(command, top=False), trusted)
+        # raw lists are still checked on both paths
+        bad = proxy_widget.SetMaker(["BAD_INDICATOR"], "x", 1)
+        with self.assertRaises(ValueError):
+            widget.validate_command(bad, top=False)
+        widget.strict_validation = False
+        with self.assertRaises(ValueError):
+            widget.validate_command(bad, top=False)
+        # pure attribute paths are validated once and cached
+        path = element.a.b
+        self.assertIs(widget.validate_command(path, top=False), widget.validate_command(path, top=False))
+
+    def test_compact_command_nodes(self, *args):
+        widget = proxy_widget.JSProxyWidget()
+        element = widget.get_element()
+        self.assertIs(element, proxy_widget.JSProxyWidget().get_element())
+        self.assertIs(widget.window(), proxy_widget.WINDOW)
+        widget.rendered = False
+        lazy = widget.element.foo
+        nodes = [element.a, element.f(1), element._set("x", [1]), proxy_widget.LiteralMaker([1]),
+            proxy_widget.Param("p"), lazy, lazy(1), lazy.bar]
+        for node in nodes:
+            # no per instance __dict__
+            self.assertNotIn("__dict__", dir(type(node)))
+        self.assertEqual(widget.validate_command(element.a, top=False), ["get", ["element"], "a"])
+
+    def test_js_init_function_cache(self, *args):
+        widget = proxy_widget.JSProxyWidget()
+        widget.rendered = True
+        s = widget.send_custom_message = MagicMock()
+        body = "element.html(x);"
+        def sent():
+            return [c[0][1][1] for c in s.call_args_list if c[0][1][1]][-1]
+        key = proxy_widget.function_hash(["element", "x"], body)
+        widget.js_init(body, x=1)
+        self.assertEqual(sent(), [["function", ["js_function", key, ["element", "x"], body], ["element"], 1]])
+        # the body is sent once per session
+        widget.js_init(body, x=2)
+        self.assertEqual(sent(), [["function", ["js_function", key], ["element"], 2]])
+        widget.handle_session_reset()
+        widget.js_init(body, x=3)
+        self.assertEqual(sent(), [["function", ["js_function", key, ["element", "x"], body], ["element"], 3]])
+        widget.cache_js_functions = False
+        widget.js_init(body, x=4)
+        self.assertEqual(sent()[0][1][0], "method")
+
+    def test_content_addressed_assets(self, *args):
+        widget = proxy_widget.JSProxyWidget()
+        widget.cache_assets = True
+        text = "window.loaded = 1;"
+        key = proxy_widget.asset_hash(text)
+        command = widget.load_js_command("loaded.js", text)
+        self.assertEqual(widget.validate_command(command), ["load_asset", "load_js", "loaded.js", key, False])
+        widget.persist_assets = True
+        command = widget.load_css_command("style.css", "")
+        self.assertEqual(widget.validate_command(command)[-1], True)
+        # the view asks for the texts it does not have
+        s = widget.send_custom_message = MagicMock()
+        widget.handle_custom_message(widget, {"indicator": proxy_widget.ASSET_REQUEST, "payload": [key, "unknown"]})
+        s.assert_called_with(proxy_widget.ASSET_TEXT, {key: text, "unknown": None})
+
+    def test_asset_registry_limit(self, *args):
+        widget = proxy_widget.JSProxyWidget()
+        widget.cache_assets = True
+        texts = ["window.a = %s;" % i for i in range(3)]
+        keys = [proxy_widget.asset_hash(text) for text in texts]
+        with patch("jp_proxy_widget.proxy_widget.ASSETS", proxy_widget.collections.OrderedDict()), \
+                patch("jp_proxy_widget.proxy_widget.ASSETS_SIZE", [0]), \
+                patch("jp_proxy_widget.proxy_widget.ASSETS_LIMIT", 2 * len(texts[0])):
+            for text in texts[:2]:
+                widget.load_js_command("a.js", text)
+            # registering again refreshes the entry
+            widget.load_js_command("a.js", texts[0])
+            widget.load_js_command("a.js", texts[2])
+            self.assertEqual(list(proxy_widget.ASSETS), [keys[0], keys[2]])
+            self.assertEqual(proxy_widget.ASSETS_SIZE[0], 2 * len(texts[0]))
+
+    def test_definition_request(self, *args):
+        widget = proxy_widget.JSProxyWidget()
+        widget.buffer_commands = MagicMock()
+        update = widget.prepare(widget.get_element().update(proxy_widget.Param("x")))
+        update(1)
+        function = widget.compiled_function(["element"], "return element;")
+        key = function.key
+        # a view rendered after the definitions were sent asks for them again
+        s = widget.send_custom_message = MagicMock()
+        request = {"indicator": proxy_widget.DEFINITION_REQUEST, "payload": ["template", update.identifier]}
+        widget.handle_custom_message(widget, request)
+        s.assert_called_with(proxy_widget.DEFINITION_TEXT,
+            ["template", update.identifier, [["x"], update.template]], [])
+        request["payload"] = ["function", key]
+        widget.handle_custom_message(widget, request)
+        s.assert_called_with(proxy_widget.DEFINITION_TEXT, ["function", key, [["element"], "return element;"]], None)
+        # definitions are forgotten with the view session
+        widget.handle_session_reset()
+        widget.handle_custom_message(widget, request)
+        s.assert_called_with(proxy_widget.DEFINITION_TEXT, ["function", key, None], None)
+
     def test_clean_dict(self, *args):
         import numpy as np
         A = np.array([1.1, 2.2], dtype=np.float32)
         a1 = A[1]
         assert type(a1) is not float
         D = proxy_widget.clean_dict(tuple=(1,2,3), array=A, np_float=a1, missing=None)
-        self.assertEqual(D, dict(tuple=[1,2,3], array=A.tolist(), np_float=float(a1)))
+        self.assertIs(D.pop("array"), A)  # arrays are sent as typed arrays
+        self.assertEqual(D, dict(tuple=[1,2,3], np_float=float(a1)))
         self.assertEqual(type(D["np_float"]), float)
 
     @patch("jp_proxy_widget.proxy_widget.run_ui_poll_loop")
     def test_evaluate_success(self, *args):
         widget = proxy_widget.JSProxyWidget()
         def fake_poll(*args):
-            widget._synced_command_evaluated = True
-            widget._synced_command_result = 42
+            widget.handle_evaluate_result([widget.evaluation_counter, 42, None])
         proxy_widget.run_ui_poll_loop = fake_poll
-        get_value = widget.element["AnyAttribute"].sync_value(ms_delay=10)
+        get_value = widget.element["AnyAttribute"].sync_value()
+        self.assertEqual(get_value, 42)
+        # the reply does not wait for a delay any more
+        with self.assertWarns(DeprecationWarning):
+            get_value = widget.element["AnyAttribute"].sync_value(ms_delay=10)
         self.assertEqual(get_value, 42)
 
     @patch("jp_proxy_widget.proxy_widget.run_ui_poll_loop")
     def test_evaluate_exception(self, *args):
         widget = proxy_widget.JSProxyWidget()
         def fake_poll(*args):
-            widget._synced_command_evaluated = True
-            widget._synced_command_result = "SOMETHING WENT WRONG"
+            widget.handle_evaluate_result([widget.evaluation_counter, "SOMETHING WENT WRONG", None])
             widget.error_msg = "SOMETHING WENT WRONG"
         proxy_widget.run_ui_poll_loop = fake_poll
         with self.assertRaises(proxy_widget.JavascriptException):
-            get_value = widget.element["AnyAttribute"].sync_value(ms_delay=10)
+            get_value = widget.element["AnyAttribute"].sync_value()
+
+    def test_evaluate_request(self, *args):
+        widget = proxy_widget.JSProxyWidget()
+        widget.rendered = True
+        s = widget.send_custom_message = MagicMock()
+        def last_command():
+            return [c[0][1][1] for c in s.call_args_list if c[0][1][1]][-1][-1]
+        def reply(complete, sleep):
+            # the view answers the latest request right away
+            request = last_command()
+            self.assertEqual(request[0], "reply")
+            self.assertIsNone(complete())
+            widget.handle_custom_message(widget, {"indicator": proxy_widget.EVALUATE_RESULT, "payload": [request[1], 99, None]})
+            self.assertTrue(complete())
+        with patch("jp_proxy_widget.proxy_widget.run_ui_poll_loop", reply):
+            self.assertEqual(widget.element.width().sync_value(), 99)
+        # the lazy call executed once: the evaluation reads the cached slot
+        request = last_command()
+        self.assertEqual(request[2], ["get", ["element"], proxy_widget.FRAGILE_JS_REFERENCE])
+        # stale replies are ignored
+        widget.handle_evaluate_result([request[1] - 1, 7, None])
+        self.assertEqual(widget._evaluations, {})
+
+    def test_concurrent_evaluations(self, *args):
+        widget = proxy_widget.JSProxyWidget()
+        widget.rendered = True
+        s = widget.send_custom_message = MagicMock()
+        first = widget.request_evaluation(widget.get_element().a)
+        second = widget.request_evaluation(widget.get_element().b)
+        widget.handle_evaluate_result([second, "b", None])
+        widget.handle_evaluate_result([first, "a", None])
+        self.assertEqual(widget.wait_for_evaluation(first), "a")
+        self.assertEqual(widget.wait_for_evaluation(second), "b")
+        # errors reported by the view raise
+        third = widget.request_evaluation(widget.get_element().c)
+        widget.handle_evaluate_result([third, None, "evaluation failed"])
+        with self.assertRaises(proxy_widget.JavascriptException):
+            widget.wait_for_evaluation(third)
+        # several values in one request
+        def reply(complete, sleep):
+            request = s.call_args_list[-1][0][1][1][-1]
+            self.assertEqual(request[2], ["list", ["get", ["element"], "x"], ["get", ["element"], "y"]])
+            self.assertEqual(request[3], 4)
+            widget.handle_evaluate_result([request[1], [1, 2], None])
+        with patch("jp_proxy_widget.proxy_widget.run_ui_poll_loop", reply):
+            element = widget.get_element()
+            self.assertEqual(widget.evaluate_many([element.x, element.y]), [1, 2])
+
+    def test_async_api(self, *args):
+        import asyncio
+        widget = proxy_widget.JSProxyWidget()
+        widget.send_custom_message = MagicMock()
+        calls = []
+        async def on_event(x):
+            await asyncio.sleep(0)
+            calls.append(x)
+        async def main():
+            loop = asyncio.get_running_loop()
+            # the render event resolves rendered_async
+            with self.assertRaises(TimeoutError):
+                await widget.rendered_async(timeout=10)
+            self.assertEqual(widget._render_futures, [])
+            loop.call_soon(setattr, widget, "rendered", True)
+            await widget.rendered_async()
+            # replies arrive as comm messages while evaluations are awaited
+            evaluations = [asyncio.ensure_future(widget.evaluate_async(widget.get_element().a)) for i in range(2)]
+            await asyncio.sleep(0)
+            for request_id in list(widget._evaluations):
+                widget.handle_evaluate_result([request_id, request_id * 10, None])
+            values = await asyncio.gather(*evaluations)
+            self.assertEqual(sorted(values), [10, 20])
+            with self.assertRaises(TimeoutError):
+                await widget.evaluate_async(widget.get_element().b, timeout=10)
+            self.assertEqual(widget._evaluation_futures, {})
+            # the acknowledgement wait is bounded too
+            widget(widget.get_element().b)
+            with self.assertRaises(TimeoutError):
+                await widget.flush_async(timeout=10)
+            # flush_async resolves with the acknowledgement of the batch
+            widget(widget.get_element().c)
+            existing = set(widget.identifier_to_callback)
+            def acknowledge():
+                [identifier] = set(widget.identifier_to_callback) - existing
+                widget.handle_results([identifier, True])
+            loop.call_soon(acknowledge)
+            self.assertEqual(await widget.flush_async(), True)
+            # async callbacks are scheduled on the loop
+            with patch("jp_proxy_widget.proxy_widget.event_loop", return_value=loop):
+                existing = set(widget.identifier_to_callback)
+                widget.callable(on_event)
+                [identifier] = set(widget.identifier_to_callback) - existing
+                widget.handle_callback_results([identifier, None, {"0": "clicked"}, 1])
+                await asyncio.sleep(0.01)
+            self.assertEqual(calls, ["clicked"])
+        asyncio.run(asyncio.wait_for(main(), 5))
 
     def test_on_rendered(self, *args):
         widget = proxy_widget.JSProxyWidget()
@@ -737,20 +1449,54 @@ class TestProxyWidget(unittest.TestCase):
 
     def test_quote_numpy_array(self, *args):
         import numpy as np
-        a = np.array([1, 2, 3], dtype=np.int)
+        a = np.array([[1, 2, 3], [4, 5, 6]], dtype=np.int32)
         q = proxy_widget.quoteIfNeeded(a)
-        c = q._cmd()
-        c2 = proxy_widget.quoteIfNeeded([1,2,3])._cmd()
-        self.assertEqual(c, c2)
+        [indicator, [buffer_indicator, data], dtype_name, shape] = q._cmd()
+        self.assertEqual(indicator, "ndarray")
+        self.assertEqual(buffer_indicator, "buffer")
+        self.assertEqual(dtype_name, "int32")
+        self.assertEqual(shape, [2, 3])
+        self.assertEqual(bytes(data), a.astype("<i4").tobytes())
+
+    def test_quote_numpy_array_conversions(self, *args):
+        import numpy as np
+        a = np.array([1, 2, 3], dtype=np.int64)
+        c = proxy_widget.quoteIfNeeded(a)._cmd()
+        self.assertEqual(c[2], "float64")
+        self.assertEqual(np.frombuffer(c[1][1], dtype="<f8").tolist(), [1.0, 2.0, 3.0])
+        big = np.array([1.5, 2.5], dtype=">f8")
+        c = proxy_widget.quoteIfNeeded(big)._cmd()
+        self.assertEqual(np.frombuffer(c[1][1], dtype="<f8").tolist(), [1.5, 2.5])
+        # extended precision (float128 or float96 depending on the platform)
+        extended = np.array([0.25, 4.0], dtype=np.longdouble)
+        c = proxy_widget.quoteIfNeeded(extended)._cmd()
+        self.assertEqual(c[0], "ndarray")
+        self.assertEqual(c[2], "float64")
+        self.assertEqual(np.frombuffer(c[1][1], dtype="<f8").tolist(), [0.25, 4.0])
+        save = proxy_widget.LiteralMaker.downcast_float64
+        proxy_widget.LiteralMaker.downcast_float64 = True
+        try:
+            c = proxy_widget.quoteIfNeeded(big)._cmd()
+        finally:
+            proxy_widget.LiteralMaker.downcast_float64 = save
+        self.assertEqual(c[2], "float32")
+        self.assertEqual(len(c[1][1]), 8)
+        # non numeric arrays are still sent as lists
+        strings = np.array(["a", "b"])
+        self.assertEqual(proxy_widget.quoteIfNeeded(strings)._cmd(), ["list", "a", "b"])
 
     def test_quote_numpy_array_in_dict(self, *args):
         import numpy as np
         widget = proxy_widget.JSProxyWidget()
-        a = {"array": np.array([1, 2, 3], dtype=np.int), "string": "whatever"}
-        b = {"array": [1, 2, 3], "string": "whatever"}
-        ca = widget.validate_command(proxy_widget.quoteIfNeeded(a))
-        cb = widget.validate_command(proxy_widget.quoteIfNeeded(b))
-        self.assertEqual(ca, cb)
+        widget.rendered = True
+        s = widget.send_custom_message = MagicMock()
+        a = {"array": np.array([1.0, 2.0, 3.0]), "string": "whatever"}
+        widget.send_command(proxy_widget.CallMaker("function", widget.get_element(), a))
+        (indicator, payload, buffers) = s.call_args[0]
+        [command] = payload[1]
+        literal = command[2]
+        self.assertEqual(literal, ["dict", {"array": ["ndarray", ["buffer", 0], "float64", [3]], "string": "whatever"}])
+        self.assertEqual(np.frombuffer(buffers[0]).tolist(), [1.0, 2.0, 3.0])
 
     def test_quote_numpy_array_elt(self, *args):
         import numpy as np
@@ -758,9 +1504,53 @@ class TestProxyWidget(unittest.TestCase):
         a1 = a[1] # numpy int
         b1 = 2  # standard int
         self.assertNotEqual(type(a1), type(b1))
+        # numpy scalars are passed through and converted by the JSON encoders
         q = proxy_widget.quoteIfNeeded(a1)
-        self.assertEqual(type(q), type(b1))
-        self.assertEqual(q, b1)
+        self.assertIs(q, a1)
+        self.assertEqual(proxy_widget.JSON_BACKEND.dumps([q, np.float32(0.5)]), "[2,0.5]")
+        self.assertEqual(proxy_widget.to_javascript(q), "2")
+
+    def test_json_backends(self, *args):
+        import numpy as np
+        value = [1, {"a": list(range(2000)), "b": [[i, "x"] for i in range(100)]},
+            np.int64(3), np.float64(0.25), {"c": None}, [], {}]
+        expected = json.loads(json.dumps([1, {"a": list(range(2000)), "b": [[i, "x"] for i in range(100)]},
+            3, 0.25, {"c": None}, [], {}]))
+        saved = proxy_widget.JSON_BACKEND
+        try:
+            for name in ("json", "orjson"):
+                try:
+                    backend = proxy_widget.set_json_backend(name)
+                except ImportError:
+                    continue  # optional backend not installed
+                self.assertEqual(backend.name, name)
+                self.assertEqual(backend.loads(backend.dumps(value)), expected)
+                chunks = list(proxy_widget.json_iterencode(value))
+                self.assertGreater(len(chunks), 3)
+                self.assertEqual(json.loads("".join(chunks)), expected)
+        finally:
+            proxy_widget.JSON_BACKEND = saved
+
+    def test_json_backend_limits(self, *args):
+        # deep nesting like long lazy chains and ints wider than 64 bits
+        deep = ["element"]
+        for i in range(400):
+            deep = ["get", deep, "x"]
+        big = [2 ** 70, -2 ** 65]
+        saved = proxy_widget.JSON_BACKEND
+        try:
+            for name in ("json", "orjson"):
+                try:
+                    backend = proxy_widget.set_json_backend(name)
+                except ImportError:
+                    continue  # optional backend not installed
+                self.assertEqual(json.loads(backend.dumps(deep)), deep)
+                self.assertEqual(json.loads(backend.dumps(big)), big)
+                payload = [1, [deep], 1]
+                self.assertEqual(json.loads("".join(proxy_widget.json_iterencode(payload))), payload)
+                self.assertEqual(proxy_widget.payload_size(payload), len(json.dumps(payload, separators=(",", ":"))))
+        finally:
+            proxy_widget.JSON_BACKEND = saved
 
 class RequireMockElement:
     "Used for mocking the element when testing loading requirejs"